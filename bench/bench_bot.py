@@ -0,0 +1,258 @@
+"""End-to-end benchmark of the bot's Telegram handlers.
+
+Starts a FakeRouter (bench/fake_routeros.py) on localhost, points a
+throwaway config.json at it, imports bot.py and drives the real handlers
+with synthetic Telegram Updates. Replies go to a recording Bot instead of
+the Telegram API, so the numbers cover handler + RouterOS API work only.
+
+For every table size it reports latency percentiles, throughput and router
+commands per call for approvals, rejections and the listing commands:
+
+    python bench/bench_bot.py --sizes 10 1000 10000 --latency 0.02 --requests 200
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import numpy as np
+from telegram import Bot, CallbackQuery, Chat, Message, Update, User
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_routeros import FakeRouter
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_CHAT_ID = 1
+
+
+class RecordingBot(Bot):
+    """Bot whose API calls are recorded instead of sent."""
+
+    def __init__(self):
+        super().__init__("1:bench")
+        with self._unfrozen():
+            self.sent = []
+
+    async def answer_callback_query(self, *args, **kwargs):
+        return True
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        self.sent.append(text)
+
+    async def edit_message_caption(self, *args, caption=None, **kwargs):
+        self.sent.append(caption)
+        return True
+
+    async def edit_message_text(self, text, *args, **kwargs):
+        self.sent.append(text)
+        return True
+
+
+class Synthetic:
+    """Builds Updates the way python-telegram-bot would deliver them."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.ids = itertools.count(1)
+        self.user = User(ADMIN_CHAT_ID, "admin", False)
+        self.chat = Chat(ADMIN_CHAT_ID, Chat.PRIVATE)
+
+    def _message(self, text=None, caption=None):
+        message = Message(
+            next(self.ids), datetime.datetime.now(datetime.timezone.utc), self.chat,
+            from_user=self.user, text=text, caption=caption
+        )
+        message.set_bot(self.bot)
+        return message
+
+    def command(self, *words):
+        """(update, context) for a "/command arg..." message."""
+        update = Update(next(self.ids), message=self._message(text=" ".join(words)))
+        update.set_bot(self.bot)
+        return update, types.SimpleNamespace(args=list(words[1:]), bot=self.bot)
+
+    def callback(self, data):
+        """(update, context) for an inline button press on a request photo."""
+        query = CallbackQuery(
+            str(next(self.ids)), self.user, "bench", data=data, message=self._message(caption="request")
+        )
+        query.set_bot(self.bot)
+        update = Update(next(self.ids), callback_query=query)
+        update.set_bot(self.bot)
+        return update, types.SimpleNamespace(args=None, bot=self.bot)
+
+
+def start_router(args):
+    """Run the fake router on its own event loop thread so its simulated
+    latency never shares a loop with the bot under test."""
+    router = FakeRouter(latency=args.latency, jitter=args.jitter)
+    loop = asyncio.new_event_loop()
+    port = loop.run_until_complete(router.start())
+    threading.Thread(target=loop.run_forever, name="fake-routeros", daemon=True).start()
+    return router, port
+
+
+def import_bot(port, workdir, args):
+    config = {
+        "mikrotik": {"host": "127.0.0.1", "user": "bench", "pass": "bench", "port": port},
+        "router_pool": {"max_sessions": args.sessions},
+        "telegram": {"bot_token": "1:bench", "admin_chat_id": ADMIN_CHAT_ID},
+        "bkash_number": "01700000000",
+    }
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump(config, f)
+    # bot.py reads config.json and creates its data files in the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    import bot
+    logging.getLogger("hotspot_bot").setLevel(logging.WARNING)
+    return bot
+
+
+async def measure(name, calls, concurrency, router, check=None):
+    """Run ``calls`` (zero-argument coroutine factories) with bounded
+    concurrency and return one result row."""
+    gate = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def timed(call):
+        nonlocal failures
+        async with gate:
+            started = time.perf_counter()
+            result = await call()
+            latencies.append(time.perf_counter() - started)
+            if check is not None and not check(result):
+                failures += 1
+
+    commands_before = router.commands
+    started = time.perf_counter()
+    await asyncio.gather(*(timed(call) for call in calls))
+    elapsed = time.perf_counter() - started
+    ms = np.array(latencies) * 1000
+    return {
+        "scenario": name,
+        "calls": len(calls),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+        "per_sec": len(calls) / elapsed,
+        "router_cmds": (router.commands - commands_before) / len(calls),
+        "failures": failures,
+    }
+
+
+async def run_size(bot, router, synthetic, size, args):
+    router.seed(size, int(size * args.active_ratio))
+    # Forget sessions from the previous size so the first listing is cold
+    for index in bot.ACTIVE_SESSIONS.values():
+        index.apply_snapshot([])
+        index.updated_at = None
+    rows = []
+    requests = args.requests
+
+    def pending(prefix):
+        names = []
+        for i in range(requests):
+            username = f"{prefix}{size}x{i}"
+            router.add_pending_user(username, "123456", "7_days", "01711111111")
+            bot.PENDING_STORE.add(username, "123456", "10.9.0.1", "7_days", "01711111111")
+            names.append(username)
+        return names
+
+    def press(data):
+        handler = bot.approve_inline if data.startswith("approve|") else bot.reject_inline
+        update, context = synthetic.callback(data)
+
+        async def call():
+            await handler(update, context)
+            return synthetic.bot.sent[-1]
+        return call
+
+    def send(handler, *words, cold=False):
+        async def call():
+            if cold:
+                for index in bot.ACTIVE_SESSIONS.values():
+                    index.updated_at = None
+            update, context = synthetic.command(*words)
+            await handler(update, context)
+            return synthetic.bot.sent[-1]
+        return call
+
+    approve = [press(f"approve|01711111111|{name}|10.9.0.1|7_days") for name in pending("ap")]
+    rows.append(await measure("approve", approve, args.concurrency, router, lambda r: r.startswith("✅")))
+    reject = [press(f"reject|01711111111|{name}|10.9.0.1|7_days") for name in pending("rj")]
+    rows.append(await measure("reject", reject, args.concurrency, router, lambda r: r.startswith("❌ *User")))
+
+    listings = max(requests // 10, 5)
+    ok = lambda r: not r.startswith("❌")
+    # Serial on purpose: concurrent callers would share one refresh
+    rows.append(await measure("activeusers cold", [send(bot.active_users, "/activeusers", cold=True)] * listings, 1, router, ok))
+    rows.append(await measure("activeusers cached", [send(bot.active_users, "/activeusers")] * requests, args.concurrency, router, ok))
+    rows.append(await measure("activeusers traffic", [send(bot.active_users, "/activeusers", "traffic")] * listings, args.concurrency, router, ok))
+    rows.append(await measure("usage cached", [send(bot.usage, "/usage", "seed0")] * requests, args.concurrency, router, ok))
+    rows.append(await measure("pending", [send(bot.pending_requests, "/pending")] * listings, args.concurrency, router, ok))
+    for row in rows:
+        row["users"] = size
+    return rows
+
+
+def print_table(rows):
+    header = f"{'users':>6} {'scenario':<20} {'calls':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'req/s':>8} {'cmds':>5} {'fail':>4}"
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        print(
+            f"{r['users']:>6} {r['scenario']:<20} {r['calls']:>6} {r['p50_ms']:>8.1f} {r['p90_ms']:>8.1f} "
+            f"{r['p99_ms']:>8.1f} {r['max_ms']:>8.1f} {r['per_sec']:>8.1f} {r['router_cmds']:>5.1f} {r['failures']:>4}"
+        )
+
+
+async def run(bot, router, args):
+    synthetic = Synthetic(RecordingBot())
+    for pool in bot.ROUTERS.values():
+        pool.start()
+    rows = []
+    try:
+        for size in args.sizes:
+            rows.extend(await run_size(bot, router, synthetic, size, args))
+    finally:
+        for pool in bot.ROUTERS.values():
+            pool.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bot handlers against a fake RouterOS")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000], help="users on the router")
+    parser.add_argument("--active-ratio", type=float, default=0.5, help="fraction of users logged in")
+    parser.add_argument("--requests", type=int, default=100, help="approvals/rejections per size")
+    parser.add_argument("--concurrency", type=int, default=8, help="handlers in flight at once")
+    parser.add_argument("--sessions", type=int, default=4, help="router_pool.max_sessions")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the router adds to every reply")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)  # the run chdirs into a scratch directory
+
+    router, port = start_router(args)
+    bot = import_bot(port, tempfile.mkdtemp(prefix="hotspot-bench-"), args)
+    rows = asyncio.run(run(bot, router, args))
+    print_table(rows)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""Local stand-in for the RouterOS API service.
+
+Speaks the binary API protocol (length-prefixed words, tagged sentences)
+closely enough for bot.py and routeros_api: login, print/add/set/remove on
+the hotspot, script and scheduler tables, .proplist, query stacks (?#|&!)
+and concurrent tagged commands. Every reply is delayed by a configurable
+latency so WAN round-trips can be reproduced on localhost.
+
+    python bench/fake_routeros.py --port 8728 --users 1000 --active 500 --latency 0.05
+"""
+import argparse
+import asyncio
+import itertools
+import random
+
+
+def encode_length(length):
+    if length < 0x80:
+        return bytes([length])
+    if length < 0x4000:
+        return (length | 0x8000).to_bytes(2, "big")
+    if length < 0x200000:
+        return (length | 0xC00000).to_bytes(3, "big")
+    if length < 0x10000000:
+        return (length | 0xE0000000).to_bytes(4, "big")
+    return b"\xf0" + length.to_bytes(4, "big")
+
+
+async def read_length(reader):
+    first = (await reader.readexactly(1))[0]
+    if first < 0x80:
+        return first
+    if first < 0xC0:
+        rest = await reader.readexactly(1)
+        return int.from_bytes(bytes([first & 0x3F]) + rest, "big")
+    if first < 0xE0:
+        rest = await reader.readexactly(2)
+        return int.from_bytes(bytes([first & 0x1F]) + rest, "big")
+    if first < 0xF0:
+        rest = await reader.readexactly(3)
+        return int.from_bytes(bytes([first & 0x0F]) + rest, "big")
+    return int.from_bytes(await reader.readexactly(4), "big")
+
+
+async def read_sentence(reader):
+    words = []
+    while True:
+        length = await read_length(reader)
+        if length == 0:
+            return words
+        words.append((await reader.readexactly(length)).decode("utf-8", "replace"))
+
+
+def encode_sentence(words):
+    out = bytearray()
+    for word in words:
+        raw = word.encode()
+        out += encode_length(len(raw)) + raw
+    out += b"\x00"
+    return bytes(out)
+
+
+class Table:
+    def __init__(self, prefix="*"):
+        self.rows = {}
+        self.ids = itertools.count(1)
+        self.prefix = prefix
+
+    def add(self, row):
+        row_id = f"{self.prefix}{next(self.ids):X}"
+        self.rows[row_id] = dict(row, **{".id": row_id})
+        return row_id
+
+    def resolve(self, ref):
+        if ref in self.rows:
+            return ref
+        for row_id, row in self.rows.items():
+            if row.get("name") == ref:
+                return row_id
+        return None
+
+
+def match_queries(row, queries):
+    stack = []
+    for q in queries:
+        if q.startswith("?#"):
+            for op in q[2:]:
+                if op == "!" and stack:
+                    stack.append(not stack.pop())
+                elif op in "|&" and len(stack) >= 2:
+                    b, a = stack.pop(), stack.pop()
+                    stack.append(a or b if op == "|" else a and b)
+            continue
+        body = q[1:]
+        if body.startswith("-"):
+            stack.append(body[1:] not in row)
+        elif body.startswith("<") or body.startswith(">"):
+            key, _, value = body[1:].partition("=")
+            try:
+                left, right = float(row.get(key, "nan")), float(value)
+            except ValueError:
+                left, right = row.get(key, ""), value
+            stack.append(left < right if body[0] == "<" else left > right)
+        elif "=" in body:
+            key, _, value = body.partition("=")
+            stack.append(row.get(key) == value)
+        else:
+            stack.append(body in row)
+    return all(stack)
+
+
+class FakeRouter:
+    def __init__(self, users=0, active=0, latency=0.0, jitter=0.0, identity="FakeRouter"):
+        self.latency = latency
+        self.jitter = jitter
+        self.identity = identity
+        self.tables = {
+            "/ip/hotspot/user": Table(),
+            "/ip/hotspot/active": Table(),
+            "/ip/hotspot/user/profile": Table(),
+            "/system/script": Table(),
+            "/system/scheduler": Table(),
+        }
+        self.commands = 0
+        for name in ("1_day", "7_days", "30_days"):
+            self.tables["/ip/hotspot/user/profile"].add({"name": name})
+        self.seed(users, active)
+
+    def seed(self, users, active):
+        """Replace the user and active tables with ``users`` enabled users,
+        the first ``active`` of which are logged in."""
+        self.tables["/ip/hotspot/user"] = Table()
+        self.tables["/ip/hotspot/active"] = Table()
+        for i in range(users):
+            self.tables["/ip/hotspot/user"].add({
+                "name": f"seed{i}", "password": str(100000 + i),
+                "profile": "30_days", "disabled": "false", "comment": f"017{i:08d} | seeded",
+            })
+        for i in range(min(active, users) if users else active):
+            self.tables["/ip/hotspot/active"].add({
+                "user": f"seed{i}", "address": f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}",
+                "mac-address": "02:00:%02X:%02X:%02X:%02X" % ((i >> 24) & 255, (i >> 16) & 255, (i >> 8) & 255, i & 255),
+                "uptime": f"{i % 24}h{i % 60}m{i % 60}s",
+                "bytes-in": str(random.randint(0, 10**9)), "bytes-out": str(random.randint(0, 10**8)),
+            })
+
+    def add_pending_user(self, username, password, profile, bkash="01700000000"):
+        return self.tables["/ip/hotspot/user"].add({
+            "name": username, "password": str(password), "profile": profile,
+            "disabled": "true", "comment": f"{bkash} | pending",
+        })
+
+    def execute(self, command, attrs, queries):
+        path, _, verb = command.rpartition("/")
+        if command == "/login":
+            return [], {}
+        if command == "/system/identity/print":
+            return [{"name": self.identity}], {}
+        table = self.tables.get(path)
+        if table is None:
+            raise LookupError("no such command prefix")
+        if verb == "print":
+            proplist = attrs.get(".proplist")
+            keys = proplist.split(",") if proplist else None
+            rows = [r for r in table.rows.values() if match_queries(r, queries)]
+            if keys:
+                rows = [{k: r[k] for k in keys if k in r} for r in rows]
+            return rows, {}
+        if verb == "add":
+            if "name" in attrs and table.resolve(attrs["name"]):
+                raise ValueError("failure: item with such name already exists")
+            return [], {"ret": table.add(attrs)}
+        refs = attrs.pop(".id", None) or attrs.pop("numbers", None)
+        if not refs:
+            raise ValueError("no such item")
+        for ref in refs.split(","):
+            row_id = table.resolve(ref)
+            if row_id is None:
+                raise ValueError("no such item")
+            if verb == "set":
+                table.rows[row_id].update(attrs)
+            elif verb == "remove":
+                del table.rows[row_id]
+            else:
+                raise LookupError("no such command")
+        return [], {}
+
+    async def handle(self, reader, writer):
+        lock = asyncio.Lock()
+        pending = set()
+
+        async def respond(words):
+            tag = None
+            attrs, queries = {}, []
+            for word in words[1:]:
+                if word.startswith(".tag="):
+                    tag = word[5:]
+                elif word.startswith("="):
+                    key, _, value = word[1:].partition("=")
+                    attrs[key] = value
+                elif word.startswith("?"):
+                    queries.append(word)
+            delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+            if delay:
+                await asyncio.sleep(delay)
+            self.commands += 1
+            suffix = [f".tag={tag}"] if tag is not None else []
+            try:
+                rows, done = self.execute(words[0], attrs, queries)
+                out = b"".join(
+                    encode_sentence(["!re"] + [f"={k}={v}" for k, v in row.items()] + suffix) for row in rows
+                )
+                out += encode_sentence(["!done"] + [f"={k}={v}" for k, v in done.items()] + suffix)
+            except (LookupError, ValueError) as e:
+                out = encode_sentence(["!trap", f"=message={e}"] + suffix)
+                out += encode_sentence(["!done"] + suffix)
+            async with lock:
+                writer.write(out)
+                await writer.drain()
+
+        try:
+            while True:
+                words = await read_sentence(reader)
+                if not words:
+                    continue
+                if words[0] == "/quit":
+                    break
+                task = asyncio.ensure_future(respond(words))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in pending:
+                task.cancel()
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake RouterOS API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8728)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--active", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every reply")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    args = parser.parse_args()
+
+    async def serve():
+        router = FakeRouter(args.users, args.active, args.latency, args.jitter)
+        port = await router.start(args.host, args.port)
+        print(f"Fake RouterOS listening on {args.host}:{port}")
+        await router.server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,488 +1,3853 @@
-import asyncio
-import datetime
-import json
-import os
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.ext import (
-    ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes
-)
-from routeros_api import RouterOsApiPool
-
-# Load config
-with open("config.json", "r") as f:
-    config = json.load(f)
-
-API_TOKEN = config["telegram"]["bot_token"]
-ADMIN_CHAT_ID = config["telegram"]["admin_chat_id"]
-
-MIKROTIK_IP = config["mikrotik"]["host"]
-MIKROTIK_USER = config["mikrotik"]["user"]
-MIKROTIK_PASS = config["mikrotik"]["pass"]
-MIKROTIK_API_PORT = config["mikrotik"]["port"]
-
-PENDING_DIR = "pending_users"
-
-def get_expiry(package, approval_time=None):
-    durations = {
-        "1_day": 1,
-        "7_days": 7,
-        "30_days": 30
-    }
-    days = durations.get(package.lower(), 1)  # Normalize case, default to 1 day
-    if package.lower() not in durations:
-        print(f"Warning: Unknown package '{package}', defaulting to 1 day")
-        with open("error_log.txt", "a") as f:
-            f.write(f"{datetime.datetime.now()}: Warning: Unknown package '{package}', defaulting to 1 day\n")
-    # Use provided approval time or current time
-    approval_time = approval_time or datetime.datetime.now()
-    expiry_time = approval_time + datetime.timedelta(days=days)
-    # Format for MikroTik scheduler (e.g., jun/23/2025 13:00:00)
-    mikrotik_format = expiry_time.strftime("%b/%d/%Y %H:%M:%S").lower()
-    # Format for display (e.g., 2025-06-23 13:00)
-    display_format = expiry_time.strftime("%Y-%m-%d %H:%M")
-    return expiry_time, mikrotik_format, display_format
-
-async def approve_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-
-    try:
-        # Expected format: approve|bkash|username|ip|package
-        data = query.data.split('|')
-        if len(data) != 5:
-            error_msg = "❌ Invalid approval data format."
-            print(error_msg)
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-            await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-            return
-
-        _, bkash, username, ip, package = data
-        json_file = os.path.join(PENDING_DIR, f"{username}.json")
-
-        # Step 1: Load user data from file
-        if not os.path.exists(json_file):
-            error_msg = f"❌ No pending user found for username: {username}"
-            print(error_msg)
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-            await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-            return
-
-        with open(json_file, 'r') as f:
-            user_data = json.load(f)
-
-        file_username = user_data["username"]
-        password = str(user_data["password"])  # Ensure string
-        file_ip = user_data["ip"]
-        file_package = user_data["package"]
-
-        # Verify input data matches file
-        if ip != file_ip or package.lower() != file_package.lower() or username != file_username:
-            error_msg = f"❌ Mismatch in user data: Username ({username} vs {file_username}), IP ({ip} vs {file_ip}) or Package ({package} vs {file_package})"
-            print(error_msg)
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-            await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-            return
-
-        # Step 2: Connect to MikroTik
-        api_pool = RouterOsApiPool(
-            MIKROTIK_IP,
-            username=MIKROTIK_USER,
-            password=MIKROTIK_PASS,
-            port=MIKROTIK_API_PORT,
-            plaintext_login=True
-        )
-        api = api_pool.get_api()
-        user_resource = api.get_resource("/ip/hotspot/user")
-        script_resource = api.get_resource("/system/script")
-        scheduler_resource = api.get_resource("/system/scheduler")
-
-        # Fetch user by username
-        users = user_resource.get(name=username)
-        print(f"Users found for {username}: {users}")
-        with open("error_log.txt", "a") as f:
-            f.write(f"{datetime.datetime.now()}: Users found for {username}: {users}\n")
-        if not users:
-            error_msg = f"❌ User {username} not found in MikroTik."
-            print(error_msg)
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-            await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-            api_pool.disconnect()
-            return
-
-        user = users[0]
-        user_id = user.get('id')
-        if not user_id:
-            error_msg = f"❌ Could not retrieve user ID for {username}. User data: {user}"
-            print(error_msg)
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-            await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-            api_pool.disconnect()
-            return
-
-        # Verify user is disabled (accept 'true' or 'yes')
-        if user.get("disabled") not in ["true", "yes"]:
-            error_msg = f"❌ User {username} is already enabled or in an unexpected state: {user.get('disabled')}"
-            print(error_msg)
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-            await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-            api_pool.disconnect()
-            return
-
-        # Verify user data matches (case-insensitive)
-        mikrotik_password = user.get("password") or ""  # Handle missing password
-        mikrotik_profile = user.get("profile") or ""    # Handle missing profile
-        if mikrotik_password != password or mikrotik_profile.lower() != package.lower():
-            error_msg = (
-                f"❌ User data mismatch for {username}: "
-                f"Password (MikroTik: '{mikrotik_password}' vs JSON: '{password}'), "
-                f"Profile (MikroTik: '{mikrotik_profile}' vs JSON: '{package}')"
-            )
-            print(error_msg)
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-            await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-            api_pool.disconnect()
-            return
-
-        # Step 3: Calculate expiry time
-        approval_time = datetime.datetime.now()
-        expiry_time, mikrotik_expiry, display_expiry = get_expiry(package, approval_time)
-
-        # Clean up existing script and scheduler if they exist
-        try:
-            existing_scripts = script_resource.get(name=f"remove-user-{username}")
-            if existing_scripts:
-                script_resource.remove(id=existing_scripts[0].get("id"))
-        except:
-            pass  # Ignore if script doesn't exist
-        try:
-            existing_schedulers = scheduler_resource.get(name=f"expire-user-{username}")
-            if existing_schedulers:
-                scheduler_resource.remove(id=existing_schedulers[0].get("id"))
-        except:
-            pass  # Ignore if scheduler doesn't exist
-
-        # Create removal script
-        script_name = f"remove-user-{username}"
-        script_content = f"/ip hotspot user remove [find name={username}]"
-        try:
-            script_resource.add(
-                **{
-                    "name": script_name,
-                    "source": script_content,
-                    "policy": "read,write",
-                    "dont-require-permissions": "yes"
-                }
-            )
-        except Exception as e:
-            error_msg = f"❌ Failed to create script for {username}: {str(e)}"
-            print(error_msg)
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-            await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-            api_pool.disconnect()
-            return
-
-        # Create scheduler
-        scheduler_name = f"expire-user-{username}"
-        try:
-            scheduler_resource.add(
-                **{
-                    "name": scheduler_name,
-                    "start-date": mikrotik_expiry.split(" ")[0],  # e.g., jun/23/2025
-                    "start-time": mikrotik_expiry.split(" ")[1],  # e.g., 13:00:00
-                    "interval": "0",  # Run once
-                    "on-event": script_name,
-                    "policy": "read,write",
-                    "disabled": "no"
-                }
-            )
-        except Exception as e:
-            # Cleanup script if scheduler creation fails
-            try:
-                script_resource.remove(name=script_name)
-            except:
-                pass
-            error_msg = f"❌ Failed to create scheduler for {username}: {str(e)}"
-            print(error_msg)
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-            await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-            api_pool.disconnect()
-            return
-
-        # Get scheduler ID
-        schedulers = scheduler_resource.get(name=scheduler_name)
-        scheduler_id = schedulers[0].get("id") if schedulers else ""
-
-        # Step 4: Enable user and update comment
-        try:
-            user_resource.set(
-                **{
-                    "id": user_id,
-                    "disabled": "false",
-                    "comment": f"{bkash} | {display_expiry} | scheduler={scheduler_id}"
-                }
-            )
-        except Exception as e:
-            # Cleanup script and scheduler if user update fails
-            try:
-                script_resource.remove(name=script_name)
-            except:
-                pass
-            try:
-                if scheduler_id:
-                    scheduler_resource.remove(id=scheduler_id)
-            except:
-                pass
-            error_msg = f"❌ Failed to enable user {username}: {str(e)}"
-            print(error_msg)
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-            await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-            api_pool.disconnect()
-            return
-
-        # Verify update
-        updated_user = user_resource.get(name=username)
-        api_pool.disconnect()
-
-        if updated_user and updated_user[0].get("disabled") in ["false", "no"]:
-            # Delete pending file only if update was successful
-            os.remove(json_file)
-            success_msg = (
-                f"✅ *User Approved!*\n\n"
-                f"👤 *Username:* `{username}`\n"
-                f"🔐 *Password:* `{password}`\n"
-                f"📦 *Package:* `{package}`\n"
-                f"📅 *Valid Till:* `{display_expiry}`\n"
-                f"🌐 *IP:* `{ip}`"
-            )
-            print(f"User {username} approved successfully")
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: User {username} approved successfully\n")
-            await query.edit_message_caption(caption=success_msg, parse_mode="Markdown")
-        else:
-            # Cleanup script and scheduler if verification fails
-            try:
-                script_resource.remove(name=script_name)
-            except:
-                pass
-            try:
-                if scheduler_id:
-                    scheduler_resource.remove(id=scheduler_id)
-            except:
-                pass
-            error_msg = f"❌ Failed to verify user {username} enablement. Updated data: {updated_user}"
-            print(error_msg)
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-            await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-
-    except Exception as e:
-        error_msg = f"❌ Error approving user: {str(e)}"
-        print(error_msg)
-        with open("error_log.txt", "a") as f:
-            f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-        await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-
-async def reject_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-
-    try:
-        # Expected format: reject|bkash|username|ip|package
-        data = query.data.split('|')
-        if len(data) != 5:
-            error_msg = "❌ Invalid reject data format."
-            print(error_msg)
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-            await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-            return
-
-        _, bkash, username, ip, package = data
-        json_file = os.path.join(PENDING_DIR, f"{username}.json")
-
-        # Check if pending user exists
-        if not os.path.exists(json_file):
-            error_msg = f"❌ No pending user found for username: {username}"
-            print(error_msg)
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-            await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-            return
-
-        # Connect to MikroTik
-        api_pool = RouterOsApiPool(
-            MIKROTIK_IP,
-            username=MIKROTIK_USER,
-            password=MIKROTIK_PASS,
-            port=MIKROTIK_API_PORT,
-            plaintext_login=True
-        )
-        api = api_pool.get_api()
-        user_resource = api.get_resource("/ip/hotspot/user")
-
-        # Delete user from MikroTik
-        users = user_resource.get(name=username)
-        if users:
-            user_resource.remove(id=users[0].get("id"))
-
-        # Delete pending file
-        os.remove(json_file)
-        api_pool.disconnect()
-
-        success_msg = f"❌ *User Rejected!*\n\n👤 *Username:* `{username}`\n🌐 *IP:* `{ip}`\n📦 *Package:* `{package}`"
-        print(f"User {username} rejected successfully")
-        with open("error_log.txt", "a") as f:
-            f.write(f"{datetime.datetime.now()}: User {username} rejected successfully\n")
-        await query.edit_message_caption(caption=success_msg, parse_mode="Markdown")
-
-    except Exception as e:
-        error_msg = f"❌ Error rejecting user: {str(e)}"
-        print(error_msg)
-        with open("error_log.txt", "a") as f:
-            f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-        await query.edit_message_caption(caption=error_msg, parse_mode="Markdown")
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "⚙️ *Commands:*\n"
-        "/activeusers - List connected users\n"
-        "/usage <username> - Show traffic\n"
-        "/help - Show this message",
-        parse_mode='Markdown'
-    )
-
-async def active_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        api_pool = RouterOsApiPool(
-            MIKROTIK_IP,
-            username=MIKROTIK_USER,
-            password=MIKROTIK_PASS,
-            port=MIKROTIK_API_PORT,
-            plaintext_login=True
-        )
-        api = api_pool.get_api()
-        active_users = api.get_resource('/ip/hotspot/active').get()
-        api_pool.disconnect()
-
-        if not active_users:
-            await update.message.reply_text("No active users.")
-            return
-
-        msg = "*📶 Active Users:*\n"
-        for u in active_users:
-            user = u.get('user')
-            ip = u.get('address')
-            uptime = u.get('uptime')
-            msg += f"• `{user}` - IP: {ip}, Uptime: {uptime}\n"
-
-        await update.message.reply_text(msg, parse_mode='Markdown')
-    except Exception as e:
-        error_msg = f"❌ Error: {str(e)}"
-        print(error_msg)
-        with open("error_log.txt", "a") as f:
-            f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-        await update.message.reply_text(error_msg)
-
-async def usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not context.args:
-        await update.message.reply_text("Usage: /usage <username>")
-        return
-
-    username = context.args[0]
-
-    try:
-        api_pool = RouterOsApiPool(
-            MIKROTIK_IP,
-            username=MIKROTIK_USER,
-            password=MIKROTIK_PASS,
-            port=MIKROTIK_API_PORT,
-            plaintext_login=True
-        )
-        api = api_pool.get_api()
-        active_users = api.get_resource('/ip/hotspot/active').get()
-        api_pool.disconnect()
-
-        for u in active_users:
-            if u.get('user') == username:
-                tx = int(u.get('bytes-out', 0))
-                rx = int(u.get('bytes-in', 0))
-
-                tx_mb = tx / (1024 * 1024)
-                rx_mb = rx / (1024 * 1024)
-
-                await update.message.reply_text(
-                    f"📊 Usage for `{username}`:\n"
-                    f"⬆️ Upload: {tx_mb:.2f} MB\n"
-                    f"⬇️ Download: {rx_mb:.2f} MB",
-                    parse_mode='Markdown'
-                )
-                return
-
-        await update.message.reply_text(f"User `{username}` is not active.", parse_mode='Markdown')
-
-    except Exception as e:
-        error_msg = f"❌ Error: {str(e)}"
-        print(error_msg)
-        with open("error_log.txt", "a") as f:
-            f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-        await update.message.reply_text(error_msg)
-
-async def startup_notify(app):
-    try:
-        # Attempt to connect and perform a simple API call
-        api_pool = RouterOsApiPool(
-            MIKROTIK_IP,
-            username=MIKROTIK_USER,
-            password=MIKROTIK_PASS,
-            port=MIKROTIK_API_PORT,
-            plaintext_login=True
-        )
-        api = api_pool.get_api()
-        # Test connection by querying system identity
-        identity = api.get_resource('/system/identity').get()
-        api_pool.disconnect()
-
-        if identity:
-            await app.bot.send_message(
-                chat_id=ADMIN_CHAT_ID,
-                text="✅ Bot is running and connected to MikroTik."
-            )
-            print("Bot started and connected to MikroTik successfully")
-            with open("error_log.txt", "a") as f:
-                f.write(f"{datetime.datetime.now()}: Bot started and connected to MikroTik successfully\n")
-        else:
-            raise Exception("No identity data returned from MikroTik")
-
-    except Exception as e:
-        error_msg = f"⚠️ Bot is running but failed to connect to MikroTik: {str(e)}"
-        print(error_msg)
-        with open("error_log.txt", "a") as f:
-            f.write(f"{datetime.datetime.now()}: {error_msg}\n")
-        await app.bot.send_message(chat_id=ADMIN_CHAT_ID, text=error_msg)
-
-def main():
-    app = ApplicationBuilder().token(API_TOKEN).build()
-
-    app.add_handler(CallbackQueryHandler(approve_inline, pattern="^approve\\|"))
-    app.add_handler(CallbackQueryHandler(reject_inline, pattern="^reject\\|"))
-    app.add_handler(CommandHandler("activeusers", active_users))
-    app.add_handler(CommandHandler("usage", usage))
-    app.add_handler(CommandHandler("help", help_command))
-
-    asyncio.get_event_loop().create_task(startup_notify(app))
-
-    print("🤖 Bot is running...")
-    app.run_polling()
-
-if __name__ == "__main__":
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import datetime
+import functools
+import heapq
+import ipaddress
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import socket
+import sqlite3
+import threading
+import time
+import numpy as np
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import (
+    ApplicationBuilder, BaseRateLimiter, CommandHandler, CallbackQueryHandler, ContextTypes, filters
+)
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
+from routeros_api import RouterOsApiPool
+from routeros_api.query import IsEqualQuery, OrQuery
+from routeros_api.exceptions import (
+    RouterOsApiCommunicationError, RouterOsApiConnectionError, FatalRouterOsApiError
+)
+
+# Load config
+with open("config.json", "r") as f:
+    config = json.load(f)
+
+API_TOKEN = config["telegram"]["bot_token"]
+ADMIN_CHAT_ID = config["telegram"]["admin_chat_id"]
+# Updates handled at once; a slow router call must not hold up other taps
+CONCURRENT_UPDATES = config["telegram"].get("concurrent_updates", 32)
+
+# "mikrotik" is either a single router or a list of named routers
+# ({"name": ..., "host": ..., "user": ..., "pass": ..., "port": ...})
+if isinstance(config["mikrotik"], list):
+    ROUTER_CONFIGS = config["mikrotik"]
+else:
+    ROUTER_CONFIGS = [dict(config["mikrotik"], name="default")]
+DEFAULT_ROUTER = ROUTER_CONFIGS[0]["name"]
+
+# Connection pool settings (kept outside "mikrotik" because the PHP client
+# rejects unknown keys in that section)
+POOL_CONFIG = config.get("router_pool", {})
+FANOUT_TIMEOUT = POOL_CONFIG.get("fanout_timeout", 10)  # per-router bound for multi-router queries
+BULK_BATCH_SIZE = POOL_CONFIG.get("bulk_batch_size", 50)  # users per pipelined bulk approve/renew call
+
+# Pending purchase requests, shared with submit_trx.php
+PENDING_CONFIG = config.get("pending_store", {})
+PENDING_DB = PENDING_CONFIG.get("path", "pending.db")
+PENDING_TTL = PENDING_CONFIG.get("ttl", 48 * 3600)  # seconds before an unanswered request expires
+PENDING_RETENTION = PENDING_CONFIG.get("retention", 90 * 86400)  # keep finished requests this long
+PENDING_CLEANUP_INTERVAL = PENDING_CONFIG.get("cleanup_interval", 3600)
+PENDING_DIR = "pending_users"  # legacy one-file-per-request directory, imported on startup
+CALLBACK_RESULT_TTL = PENDING_CONFIG.get("callback_result_ttl", 60)  # repeat taps answered from cache
+
+# In-bot expiry engine (replaces the per-user router script + scheduler)
+EXPIRY_CONFIG = config.get("expiry", {})
+EXPIRY_QUEUE_FILE = EXPIRY_CONFIG.get("queue_file", "expiry_queue.json")
+EXPIRY_SWEEP_INTERVAL = EXPIRY_CONFIG.get("sweep_interval", 30)
+EXPIRY_BATCH_SIZE = EXPIRY_CONFIG.get("batch_size", 100)
+EXPIRY_ACTION = EXPIRY_CONFIG.get("action", "remove")  # "remove" or "disable"
+
+# Background clean-up of orphans left by failed or abandoned requests
+RECONCILE_CONFIG = config.get("reconcile", {})
+RECONCILE_INTERVAL = RECONCILE_CONFIG.get("interval", 1800)
+RECONCILE_ORPHAN_AGE = RECONCILE_CONFIG.get("orphan_age", 86400)  # router rows must be unchanged this long
+RECONCILE_ROW_GRACE = RECONCILE_CONFIG.get("row_grace", 3600)  # requests younger than this may still be queued
+RECONCILE_BATCH_SIZE = RECONCILE_CONFIG.get("batch_size", 50)
+RECONCILE_TIMEOUT = RECONCILE_CONFIG.get("timeout", 120)  # per-router bound for one pass
+
+# Package catalog built from the routers' hotspot user profiles
+PACKAGES_CONFIG = config.get("packages", {})
+PACKAGES_OVERRIDE_FILE = PACKAGES_CONFIG.get("override_file", "packages.json")  # labels, prices, extra durations
+PACKAGES_EXPORT_FILE = PACKAGES_CONFIG.get("export_file", "package_catalog.json")  # read by the PHP pages
+PACKAGES_TTL = PACKAGES_CONFIG.get("ttl", 600)
+
+# Live index of /ip/hotspot/active
+SESSIONS_CONFIG = config.get("sessions", {})
+SESSION_POLL_INTERVAL = SESSIONS_CONFIG.get("poll_interval", 15)
+SESSION_MAX_AGE = SESSIONS_CONFIG.get("max_age", 30)  # freshness bound for /usage and /activeusers
+
+# /activeusers paging
+ACTIVE_PAGE_SIZE = SESSIONS_CONFIG.get("page_size", 30)
+ACTIVE_PAGE_TTL = SESSIONS_CONFIG.get("page_ttl", 600)  # seconds a listing stays pageable
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Per-user traffic history sampled from the active table
+USAGE_CONFIG = config.get("usage_history", {})
+USAGE_SAMPLE_INTERVAL = USAGE_CONFIG.get("sample_interval", 300)
+USAGE_RING_SPAN = USAGE_CONFIG.get("ring_span", 86400)  # seconds kept in memory
+USAGE_RETENTION = USAGE_CONFIG.get("retention", 400 * 86400)
+USAGE_HISTORY_FILE = USAGE_CONFIG.get("history_file", "usage_history.bin")
+USAGE_USERS_FILE = USAGE_CONFIG.get("users_file", "usage_users.json")
+
+# Append-only sales ledger behind /report and /customer
+LEDGER_CONFIG = config.get("ledger", {})
+LEDGER_FILE = LEDGER_CONFIG.get("file", "sales_ledger.bin")
+LEDGER_NAMES_FILE = LEDGER_CONFIG.get("names_file", "sales_ledger_names.jsonl")
+LEDGER_INDEX_FILE = LEDGER_CONFIG.get("index_file", "sales_ledger_index.npz")
+LEDGER_COMPACT_EVERY = LEDGER_CONFIG.get("compact_every", 5000)  # records between index snapshots
+
+# Prometheus-format metrics on a local HTTP port (port 0 disables the endpoint)
+METRICS_CONFIG = config.get("metrics", {})
+METRICS_HOST = METRICS_CONFIG.get("host", "127.0.0.1")
+METRICS_PORT = METRICS_CONFIG.get("port", 9108)
+
+# Local purchase intake: submit_trx.php queues new requests here instead of
+# calling the router and Telegram itself (port 0 disables the endpoint)
+INTAKE_CONFIG = config.get("intake", {})
+INTAKE_HOST = INTAKE_CONFIG.get("host", "127.0.0.1")
+INTAKE_PORT = INTAKE_CONFIG.get("port", 9109)
+INTAKE_QUEUE_SIZE = INTAKE_CONFIG.get("queue_size", 100)  # submissions held before PHP is told to back off
+INTAKE_WORKERS = INTAKE_CONFIG.get("workers", 2)
+INTAKE_RETRIES = INTAKE_CONFIG.get("retries", 3)  # router/Telegram attempts per submission
+INTAKE_RETRY_AFTER = INTAKE_CONFIG.get("retry_after", 2)  # seconds suggested to PHP when the queue is full
+INTAKE_PROOF_DIR = INTAKE_CONFIG.get("proof_dir", "proof_images")
+INTAKE_RECOVER_DELAY = INTAKE_CONFIG.get("recover_delay", 30)  # let PHP finish requests it made while the bot was down
+INTAKE_MAX_BODY = 16 * 1024
+
+# Outbound Telegram traffic: per-chat rate limits and the admin notice digest
+OUTBOX_CONFIG = config.get("outbox", {})
+
+# Logging: records are handed to a queue and written by a background thread,
+# so disk I/O never delays a Telegram reply
+LOG_CONFIG = config.get("logging", {})
+LOG_FILE = LOG_CONFIG.get("file", "error_log.txt")
+LOG_CONTEXT = contextvars.ContextVar("log_context", default={})
+
+log = logging.getLogger("hotspot_bot")
+
+class JsonLineFormatter(logging.Formatter):
+    """One JSON object per line: time, level, handler, username, message."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "handler": getattr(record, "handler", None),
+            "username": getattr(record, "username", None),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class LogContextFilter(logging.Filter):
+    """Copy the current handler/username context onto each record."""
+
+    def filter(self, record):
+        for key, value in LOG_CONTEXT.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+def log_context(**fields):
+    """Attach fields (e.g. username) to every log record from this task."""
+    LOG_CONTEXT.set({**LOG_CONTEXT.get(), **fields})
+
+def logged(handler):
+    """Tag log records emitted while ``handler`` runs with its name, and
+    record its latency and outcome in METRICS."""
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        LOG_CONTEXT.set({"handler": handler.__name__})
+        started = time.perf_counter()
+        outcome = None
+        try:
+            return await handler(*args, **kwargs)
+        except Exception:
+            outcome = "exception"
+            raise
+        finally:
+            outcome = outcome or LOG_CONTEXT.get().get("outcome", "success")
+            METRICS.observe("handler_seconds", time.perf_counter() - started, handler=handler.__name__)
+            METRICS.inc("handler_calls_total", handler=handler.__name__, outcome=outcome)
+    return wrapper
+
+def handler_outcome(outcome):
+    """Record why the current handler did not succeed (e.g. "mismatch").
+
+    @logged counts the call under this outcome instead of "success"; the
+    value is also attached to the handler's later log records.
+    """
+    log_context(outcome=outcome)
+
+def setup_logging():
+    """Route the bot's records through a queue to a rotating JSON-lines file
+    and the console. Returns the started QueueListener."""
+    if LOG_CONFIG.get("rotation", "size") == "time":
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE,
+            when=LOG_CONFIG.get("when", "midnight"),
+            backupCount=LOG_CONFIG.get("backup_count", 7),
+            encoding="utf-8"
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE,
+            maxBytes=LOG_CONFIG.get("max_bytes", 10 * 1024 * 1024),
+            backupCount=LOG_CONFIG.get("backup_count", 5),
+            encoding="utf-8"
+        )
+    file_handler.setFormatter(JsonLineFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    console_handler.setLevel(LOG_CONFIG.get("console_level", "INFO"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    log.addHandler(queue_handler)
+    log.setLevel(LOG_CONFIG.get("level", "INFO"))
+    log.propagate = False
+
+    listener = logging.handlers.QueueListener(
+        log_queue, file_handler, console_handler, respect_handler_level=True
+    )
+    listener.start()
+    return listener
+
+class Metrics:
+    """Counters, gauges and latency histograms, exposed in Prometheus text format.
+
+    Recording is a dict update under one lock, cheap enough to leave on for
+    every handler, router call and storage operation. Histograms use fixed
+    buckets; gauges are callables evaluated when the metrics are rendered.
+    """
+
+    PREFIX = "hotspot_bot_"
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    HELP = {
+        "handler_seconds": ("histogram", "Telegram handler latency"),
+        "handler_calls_total": ("counter", "Handler calls by outcome"),
+        "approval_mismatches_total": ("counter", "Approvals refused because a field did not match"),
+        "routeros_call_seconds": ("histogram", "RouterOS API work per run_router() call, excluding pool waits"),
+        "routeros_errors_total": ("counter", "Failed run_router() calls by error type"),
+        "routeros_roundtrip_seconds": ("histogram", "Pipelined RouterOS round-trips inside an approval"),
+        "telegram_request_seconds": ("histogram", "Telegram Bot API request latency"),
+        "telegram_queue_seconds": ("histogram", "Time Bot API requests waited for the per-chat rate limit"),
+        "telegram_retry_after_total": ("counter", "Bot API requests refused by Telegram flood control"),
+        "storage_seconds": ("histogram", "Pending store and expiry queue disk operations"),
+        "singleflight_total": ("counter", "Approve/reject callbacks that ran, joined an in-flight run or hit the cache"),
+        "intake_submissions_total": ("counter", "Purchase submissions from the portal by outcome"),
+        "intake_seconds": ("histogram", "Time from an intake submission being queued to the admin being notified"),
+        "intake_queue_size": ("gauge", "Intake submissions waiting for a worker"),
+        "reconcile_removed_total": ("counter", "Orphaned router rows removed and requests closed by the reconciler"),
+        "pending_requests": ("gauge", "Purchase requests waiting for approval"),
+        "active_sessions": ("gauge", "Hotspot sessions in the active-session index"),
+        "expiry_queue_size": ("gauge", "Users with a scheduled expiry"),
+        "routeros_pool_sessions": ("gauge", "Pooled RouterOS sessions"),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [per-bucket counts..., +Inf count, sum]
+        self._gauges = {}      # name -> callable returning {labels: value}
+        self.started_at = time.time()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect.bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            values[bucket] += 1
+            values[-1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name, **labels):
+        """Decorator form of timer() for plain functions."""
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def gauge(self, name, read):
+        """Register ``read()``, returning a number or ``{labels_tuple: value}``."""
+        self._gauges[name] = read
+
+    def counters(self, name):
+        """{labels: value} for every series of counter ``name``."""
+        with self._lock:
+            return {labels: value for (metric, labels), value in self._counters.items() if metric == name}
+
+    def histograms(self, name):
+        """{labels: bucket counts + sum} for every series of histogram ``name``."""
+        with self._lock:
+            return {labels: list(values) for (metric, labels), values in self._histograms.items() if metric == name}
+
+    def quantile(self, values, q):
+        """Estimate a quantile from bucket counts (linear within a bucket)."""
+        total = sum(values[:-1])
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(values[:-1]):
+            if seen + count >= rank and count:
+                lower = self.BUCKETS[i - 1] if i > 0 else 0.0
+                upper = self.BUCKETS[i] if i < len(self.BUCKETS) else self.BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.BUCKETS[-1]
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        """The Prometheus text exposition of every metric."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+        series = collections.defaultdict(list)
+        for (name, labels), value in counters.items():
+            series[name].append(f"{self.PREFIX}{name}{self._labels(labels)} {value}")
+        for (name, labels), values in histograms.items():
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ("+Inf",), values[:-1]):
+                cumulative += count
+                series[name].append(f"{self.PREFIX}{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            series[name].append(f"{self.PREFIX}{name}_sum{self._labels(labels)} {values[-1]:.6f}")
+            series[name].append(f"{self.PREFIX}{name}_count{self._labels(labels)} {cumulative}")
+        for name, read in self._gauges.items():
+            try:
+                value = read()
+            except Exception as e:
+                log.warning(f"Metrics gauge {name} failed: {str(e)}")
+                continue
+            for labels, number in (value.items() if isinstance(value, dict) else [((), value)]):
+                series[name].append(f"{self.PREFIX}{name}{self._labels(labels)} {number}")
+        lines = []
+        for name in sorted(series):
+            kind, text = self.HELP.get(name, ("untyped", name))
+            lines.append(f"# HELP {self.PREFIX}{name} {text}")
+            lines.append(f"# TYPE {self.PREFIX}{name} {kind}")
+            lines.extend(series[name])
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+class TimedRequest(HTTPXRequest):
+    """Bot API transport that records per-method latency in METRICS."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        with METRICS.timer("telegram_request_seconds", method=url.rsplit("/", 1)[-1]):
+            return await super().do_request(url, method, *args, **kwargs)
+
+class TokenBucket:
+    """``rate`` tokens per second, holding at most ``burst``."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # flood wait imposed by a RetryAfter
+
+    def delay(self):
+        """Seconds until a token is available; 0 when one can be taken now."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class OutboundScheduler(BaseRateLimiter):
+    """Rate limiter for every Bot API call the application makes.
+
+    Each chat has a token bucket (Telegram allows about one message per
+    second in a private chat and 20 per minute in a group) and all chats
+    share a global bucket. Requests waiting on the same chat are released
+    in priority order, so a tap on an Approve button is answered before a
+    queued startup notice or digest. A RetryAfter blocks the chat for as
+    long as Telegram asks and the request is retried.
+    """
+
+    PRIORITIES = {"interactive": 0, "reply": 1, "background": 2}
+    INTERACTIVE_METHODS = {"answerCallbackQuery", "editMessageCaption", "editMessageText", "editMessageReplyMarkup"}
+
+    def __init__(self, chat_rate=1.0, chat_burst=3, group_rate=20 / 60, global_rate=30, max_retries=3):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}     # chat_id -> TokenBucket
+        self._waiting = {}     # chat_id -> heap of [priority, seq]
+        self._conditions = {}  # chat_id -> asyncio.Condition guarding the heap
+        self._seq = itertools.count()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Negative ids and @usernames are groups and channels
+            group = isinstance(chat_id, str) or chat_id < 0
+            bucket = self._buckets[chat_id] = (
+                TokenBucket(self.group_rate, 1) if group else TokenBucket(self.chat_rate, self.chat_burst)
+            )
+        return bucket
+
+    async def _acquire(self, chat_id, entry):
+        """Wait until ``entry`` is the most urgent request for its chat and
+        both the chat and the global bucket have a token."""
+        if chat_id is None:
+            # answerCallbackQuery and friends are only bound by the global limit
+            while (delay := self._global.delay()) > 0:
+                await asyncio.sleep(delay)
+            self._global.take()
+            return
+        bucket = self._bucket(chat_id)
+        heap = self._waiting.setdefault(chat_id, [])
+        condition = self._conditions.setdefault(chat_id, asyncio.Condition())
+        async with condition:
+            heapq.heappush(heap, entry)
+            condition.notify_all()  # a more urgent entry takes over the head
+            try:
+                while True:
+                    if heap[0] is not entry:
+                        await condition.wait()
+                        continue
+                    delay = max(bucket.delay(), self._global.delay())
+                    if delay <= 0:
+                        bucket.take()
+                        self._global.take()
+                        return
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(condition.wait(), delay)
+            finally:
+                heap.remove(entry)
+                heapq.heapify(heap)
+                condition.notify_all()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in self.INTERACTIVE_METHODS:
+            priority = "interactive"
+        else:
+            priority = (rate_limit_args or {}).get("priority", "reply")
+        chat_id = data.get("chat_id")
+        entry = [self.PRIORITIES[priority], next(self._seq)]
+        for attempt in range(self.max_retries + 1):
+            with METRICS.timer("telegram_queue_seconds", priority=priority):
+                await self._acquire(chat_id, entry)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                wait = e.retry_after
+                if isinstance(wait, datetime.timedelta):
+                    wait = wait.total_seconds()
+                METRICS.inc("telegram_retry_after_total", method=endpoint)
+                if attempt == self.max_retries:
+                    raise
+                log.warning(f"Telegram flood limit on {endpoint} for chat {chat_id}, retrying in {wait}s")
+                bucket = self._global if chat_id is None else self._bucket(chat_id)
+                bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + wait)
+
+OUTBOX = OutboundScheduler(
+    chat_rate=OUTBOX_CONFIG.get("chat_rate", 1.0),
+    chat_burst=OUTBOX_CONFIG.get("chat_burst", 3),
+    group_rate=OUTBOX_CONFIG.get("group_rate", 20 / 60),
+    global_rate=OUTBOX_CONFIG.get("global_rate", 30),
+    max_retries=OUTBOX_CONFIG.get("max_retries", 3),
+)
+BACKGROUND = {"priority": "background"}  # rate_limit_args for messages nobody is waiting on
+
+class AdminDigest:
+    """Low-priority admin notices (background errors, expiry sweeps),
+    coalesced into one message every ``interval`` seconds.
+
+    Repeated notices are counted instead of listed again, and at most
+    ``limit`` distinct notices are kept between flushes.
+    """
+
+    def __init__(self, interval, limit=200):
+        self.interval = interval
+        self.limit = limit
+        self._notices = collections.Counter()  # insertion ordered
+        self._dropped = 0
+        self._since = time.time()
+
+    def add(self, text):
+        if text not in self._notices and len(self._notices) >= self.limit:
+            self._dropped += 1
+            return
+        self._notices[text] += 1
+
+    def take(self):
+        """Return the pending digest as message texts and start a new one."""
+        if not self._notices and not self._dropped:
+            return []
+        lines = [
+            f"• {text}" + (f" (×{count})" if count > 1 else "") for text, count in self._notices.items()
+        ]
+        if self._dropped:
+            lines.append(f"• …and {self._dropped} more")
+        header = f"🗒 Notices since {datetime.datetime.fromtimestamp(self._since).strftime('%H:%M')}:"
+        self._notices.clear()
+        self._dropped = 0
+        self._since = time.time()
+        messages = [header]
+        for line in lines:
+            line = line[:TELEGRAM_MESSAGE_LIMIT - 1]
+            if len(messages[-1]) + len(line) + 1 > TELEGRAM_MESSAGE_LIMIT:
+                messages.append(line)
+            else:
+                messages[-1] += "\n" + line
+        return messages
+
+    async def flush(self, bot):
+        for text in self.take():
+            await bot.send_message(chat_id=ADMIN_CHAT_ID, text=text, rate_limit_args=BACKGROUND)
+
+    async def run(self, app):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush(app.bot)
+            except Exception as e:
+                log.error(f"Sending admin digest failed: {str(e)}")
+
+ADMIN_DIGEST = AdminDigest(OUTBOX_CONFIG.get("digest_interval", 60))
+
+class RouterConnectionPool:
+    """Long-lived, bounded pool of logged-in RouterOS API sessions.
+
+    One pool per router. Handlers borrow a session through run_router()
+    instead of connecting and logging in for every command. A background
+    thread probes idle sessions with ``/system/identity`` and re-establishes
+    them with exponential backoff when the router goes away. Each pool has
+    its own worker threads, so a hung router cannot starve the others.
+    """
+
+    CONNECTION_ERRORS = (RouterOsApiConnectionError, FatalRouterOsApiError, OSError)
+
+    def __init__(self, name, host, username, password, port, max_sessions=4,
+                 keepalive_interval=60, max_backoff=60, acquire_timeout=30):
+        self.name = name
+        self.host = host
+        self.username = username
+        self.password = password
+        self.port = port
+        self.max_sessions = max_sessions
+        self.keepalive_interval = keepalive_interval
+        self.max_backoff = max_backoff
+        self.acquire_timeout = acquire_timeout
+
+        # Router I/O runs in a bounded thread pool so a slow reply never
+        # blocks the event loop; one worker per pooled session.
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_sessions, thread_name_prefix=f"routeros-{name}"
+        )
+        self._idle = []  # [(RouterOsApiPool, last_used_monotonic)]
+        self._borrowed = {}  # id(api) -> RouterOsApiPool, for abort()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_sessions)
+        self._stop = threading.Event()
+        self._thread = None
+        self._backoff = 0
+        self._retry_at = 0.0
+        self._lost = 0  # sessions dropped since the last successful login
+
+        self.stats = {
+            "hits": 0,          # requests served by an already logged-in session
+            "connects": 0,      # fresh TCP connect + login
+            "reconnects": 0,    # logins that replaced a dropped session
+            "failures": 0,      # failed connect/login attempts
+            "dropped": 0,       # sessions discarded after an error or failed probe
+            "probes": 0,        # keepalive probes sent
+            "waits": 0,         # acquisitions that had to wait for a free slot
+            "wait_time": 0.0,   # total seconds spent waiting for a slot
+            "max_wait": 0.0,
+            "in_use": 0,
+        }
+
+    def _new_session(self):
+        now = time.monotonic()
+        if now < self._retry_at:
+            raise RouterOsApiConnectionError(
+                f"MikroTik {self.name} unreachable, next reconnect attempt in {self._retry_at - now:.0f}s"
+            )
+        session = RouterOsApiPool(
+            self.host,
+            username=self.username,
+            password=self.password,
+            port=self.port,
+            plaintext_login=True
+        )
+        try:
+            session.get_api()
+            # routeros_api writes every word with its own send(); without
+            # TCP_NODELAY each command waits on a delayed ACK (~40 ms)
+            session.socket.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except Exception:
+            with self._lock:
+                self.stats["failures"] += 1
+                self._backoff = min(max(self._backoff * 2, 1), self.max_backoff)
+                self._retry_at = time.monotonic() + self._backoff
+            raise
+        with self._lock:
+            self.stats["connects"] += 1
+            if self._lost:
+                self.stats["reconnects"] += 1
+                self._lost -= 1
+            self._backoff = 0
+            self._retry_at = 0.0
+        return session
+
+    def _drop(self, session):
+        with self._lock:
+            self.stats["dropped"] += 1
+            self._lost = min(self._lost + 1, self.max_sessions)
+        try:
+            session.disconnect()
+        except Exception:
+            pass
+
+    def _probe(self, session):
+        with self._lock:
+            self.stats["probes"] += 1
+        try:
+            session.get_api().get_resource("/system/identity").get()
+            return True
+        except Exception:
+            return False
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a logged-in API object for the duration of the block."""
+        start = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            if not self._slots.acquire(timeout=self.acquire_timeout):
+                raise TimeoutError(f"No free MikroTik session after {self.acquire_timeout}s")
+            waited = time.monotonic() - start
+            with self._lock:
+                self.stats["waits"] += 1
+                self.stats["wait_time"] += waited
+                self.stats["max_wait"] = max(self.stats["max_wait"], waited)
+        session = None
+        try:
+            with self._lock:
+                if self._idle:
+                    session, last_used = self._idle.pop()
+                else:
+                    last_used = None
+            # A session idle for longer than the keepalive interval may have
+            # been cut by a router reboot; check it before handing it out.
+            if session is not None and time.monotonic() - last_used > self.keepalive_interval:
+                if not self._probe(session):
+                    self._drop(session)
+                    session = None
+            if session is None:
+                session = self._new_session()
+            else:
+                with self._lock:
+                    self.stats["hits"] += 1
+            api = session.get_api()
+            with self._lock:
+                self.stats["in_use"] += 1
+                self._borrowed[id(api)] = session
+            try:
+                yield api
+            except self.CONNECTION_ERRORS:
+                self._drop(session)
+                session = None
+                raise
+            finally:
+                with self._lock:
+                    self.stats["in_use"] -= 1
+                    self._borrowed.pop(id(api), None)
+            if session is not None:
+                if session.connected:
+                    with self._lock:
+                        self._idle.append((session, time.monotonic()))
+                else:
+                    self._drop(session)
+        finally:
+            self._slots.release()
+
+    def abort(self, api):
+        """Interrupt a blocking call on a borrowed session from another thread.
+
+        The socket is shut down, so the worker's pending read fails, the
+        session is dropped and its slot is released.
+        """
+        with self._lock:
+            session = self._borrowed.get(id(api))
+        if session is None:
+            return
+        try:
+            session.socket.socket.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+
+    def _keepalive_loop(self):
+        while not self._stop.wait(self.keepalive_interval):
+            with self._lock:
+                idle, self._idle = self._idle, []
+            alive = []
+            for session, last_used in idle:
+                if time.monotonic() - last_used < self.keepalive_interval:
+                    alive.append((session, last_used))
+                elif self._probe(session):
+                    alive.append((session, time.monotonic()))
+                else:
+                    self._drop(session)
+            # Keep one warm session around so the next handler skips the login
+            if not alive and self.stats["in_use"] == 0:
+                try:
+                    alive.append((self._new_session(), time.monotonic()))
+                except Exception as e:
+                    log.warning(f"MikroTik {self.name} keepalive reconnect failed (backoff {self._backoff}s): {str(e)}")
+            with self._lock:
+                self._idle.extend(alive)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._keepalive_loop, name=f"routeros-keepalive-{self.name}", daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session, _ in idle:
+            try:
+                session.disconnect()
+            except Exception:
+                pass
+
+    def format_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            idle = len(self._idle)
+        requests = stats["hits"] + stats["connects"]
+        hit_rate = (stats["hits"] / requests * 100) if requests else 0.0
+        avg_wait = (stats["wait_time"] / stats["waits"]) if stats["waits"] else 0.0
+        return (
+            f"*🔌 MikroTik Pool {self.name}:*\n"
+            f"Sessions: {stats['in_use']} in use, {idle} idle, max {self.max_sessions}\n"
+            f"Hits: {stats['hits']} ({hit_rate:.1f}%)\n"
+            f"Connects: {stats['connects']}, Reconnects: {stats['reconnects']}, Failures: {stats['failures']}\n"
+            f"Dropped: {stats['dropped']}, Probes: {stats['probes']}\n"
+            f"Waits: {stats['waits']} (avg {avg_wait * 1000:.0f} ms, max {stats['max_wait'] * 1000:.0f} ms)"
+        )
+
+ROUTERS = {
+    router["name"]: RouterConnectionPool(
+        router["name"],
+        router["host"],
+        router["user"],
+        router["pass"],
+        router["port"],
+        max_sessions=POOL_CONFIG.get("max_sessions", 4),
+        keepalive_interval=POOL_CONFIG.get("keepalive_interval", 60),
+        max_backoff=POOL_CONFIG.get("max_backoff", 60),
+        acquire_timeout=POOL_CONFIG.get("acquire_timeout", 30),
+    )
+    for router in ROUTER_CONFIGS
+}
+ROUTER_CALL_TIMEOUT = POOL_CONFIG.get("call_timeout", 20)
+METRICS.gauge("routeros_pool_sessions", lambda: {
+    (("router", name), ("state", state)): count
+    for name, pool in ROUTERS.items()
+    for state, count in (("in_use", pool.stats["in_use"]), ("idle", len(pool._idle)))
+})
+
+async def run_router(func, *args, router=None, timeout=None):
+    """Run ``func(api, *args)`` on a pooled session without blocking the event loop.
+
+    ``router`` names the target router (default: the first one configured).
+    Raises asyncio.TimeoutError when the call takes longer than ``timeout``
+    seconds (default ``router_pool.call_timeout``). On timeout or
+    cancellation the in-flight socket is shut down so the worker thread does
+    not keep talking to the router on behalf of a caller that has gone away.
+    """
+    router = router or DEFAULT_ROUTER
+    if router not in ROUTERS:
+        raise KeyError(f"Unknown router '{router}'")
+    pool = ROUTERS[router]
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+    borrowed = {}
+
+    def work():
+        with pool.connection() as api:
+            if cancelled.is_set():
+                return None
+            borrowed["api"] = api
+            with METRICS.timer("routeros_call_seconds", router=router, call=func.__name__):
+                return func(api, *args)
+
+    def stop():
+        cancelled.set()
+        if "api" in borrowed:
+            pool.abort(borrowed["api"])
+
+    timeout = timeout or ROUTER_CALL_TIMEOUT
+    # Run in a copy of the caller's context so worker log records keep
+    # the handler/username fields
+    future = loop.run_in_executor(pool.executor, contextvars.copy_context().run, work)
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        stop()
+        METRICS.inc("routeros_errors_total", router=router, call=func.__name__, error="timeout")
+        raise asyncio.TimeoutError(f"MikroTik {router} did not respond within {timeout}s") from None
+    except asyncio.CancelledError:
+        stop()
+        raise
+    except ApprovalError:
+        raise  # an expected refusal, not a router failure
+    except Exception as e:
+        METRICS.inc("routeros_errors_total", router=router, call=func.__name__, error=type(e).__name__)
+        raise
+
+async def fan_out(make_call, timeout=None):
+    """Await ``make_call(router_name)`` for every router concurrently.
+
+    Returns ``{router_name: result}``. A router that fails or takes longer
+    than ``timeout`` (default ``router_pool.fanout_timeout``) gets its
+    exception as the result, so one unreachable site never holds up or
+    breaks the answer from the others.
+    """
+    names = list(ROUTERS)
+    results = await asyncio.gather(
+        *(asyncio.wait_for(make_call(name), timeout or FANOUT_TIMEOUT) for name in names),
+        return_exceptions=True
+    )
+    return dict(zip(names, results))
+
+def fan_out_warnings(results):
+    """Lines naming the routers that failed in a fan_out() result."""
+    return "".join(
+        f"\n⚠️ {name}: {str(result) or type(result).__name__}"
+        for name, result in results.items() if isinstance(result, BaseException)
+    )
+
+class PendingStore:
+    """SQLite (WAL) store of purchase requests written by submit_trx.php.
+
+    A request moves from ``pending`` to exactly one of ``approved``,
+    ``rejected`` or ``expired``; ``transition`` only succeeds while the row
+    is still pending, so two writers can never both finish the same request.
+    The schema is created by whichever side opens the database first and
+    must stay in sync with submit_trx.php.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pending_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            password TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            package TEXT NOT NULL,
+            bkash TEXT NOT NULL,
+            router TEXT NOT NULL DEFAULT '',
+            state TEXT NOT NULL DEFAULT 'pending',
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            notified INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_pending_username_open
+            ON pending_requests(username) WHERE state = 'pending';
+        CREATE INDEX IF NOT EXISTS idx_pending_state_created ON pending_requests(state, created_at);
+        CREATE INDEX IF NOT EXISTS idx_pending_username ON pending_requests(username);
+        CREATE INDEX IF NOT EXISTS idx_pending_bkash ON pending_requests(bkash);
+        CREATE INDEX IF NOT EXISTS idx_pending_ip ON pending_requests(ip);
+    """
+    STATES = ("pending", "approved", "rejected", "expired")
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("PRAGMA busy_timeout=5000")
+        self._db.executescript(self.SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(pending_requests)")}
+        if "router" not in columns:
+            # Databases created before multi-router support
+            self._db.execute("ALTER TABLE pending_requests ADD COLUMN router TEXT NOT NULL DEFAULT ''")
+        if "notified" not in columns:
+            # Databases created before admin notifications were tracked; the
+            # requests already in them were sent to the admin
+            self._db.execute("ALTER TABLE pending_requests ADD COLUMN notified INTEGER NOT NULL DEFAULT 0")
+            self._db.execute("UPDATE pending_requests SET notified = 1")
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self._db.execute(sql, params)]
+
+    @METRICS.timed("storage_seconds", op="pending_add")
+    def add(self, username, password, ip, package, bkash, router="", created_at=None, notified=False):
+        now = int(created_at or time.time())
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO pending_requests "
+                "(username, password, ip, package, bkash, router, state, created_at, updated_at, notified) "
+                "VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, ?, ?)",
+                (username, str(password), ip, package, bkash, router, now, now, int(notified))
+            )
+
+    @METRICS.timed("storage_seconds", op="pending_mark_notified")
+    def mark_notified(self, username):
+        """Record that the admin was sent the open request for ``username``."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE pending_requests SET notified = 1 WHERE username = ? AND state = 'pending'", (username,)
+            )
+
+    @METRICS.timed("storage_seconds", op="pending_get")
+    def get_pending(self, username):
+        rows = self._query(
+            "SELECT * FROM pending_requests WHERE username = ? AND state = 'pending'", (username,)
+        )
+        return rows[0] if rows else None
+
+    @METRICS.timed("storage_seconds", op="pending_transition")
+    def transition(self, username, state):
+        """Atomically move the open request for ``username`` to ``state``.
+
+        Returns False when there is no pending request (already handled).
+        """
+        if state not in self.STATES[1:]:
+            raise ValueError(f"Invalid target state: {state}")
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE pending_requests SET state = ?, updated_at = ? WHERE username = ? AND state = 'pending'",
+                (state, int(time.time()), username)
+            )
+            return cursor.rowcount == 1
+
+    @METRICS.timed("storage_seconds", op="pending_get_many")
+    def get_pending_many(self, usernames):
+        """Open requests for ``usernames``, keyed by username."""
+        usernames = list(usernames)
+        rows = []
+        for start in range(0, len(usernames), 500):  # stay under SQLite's variable limit
+            chunk = usernames[start:start + 500]
+            rows += self._query(
+                f"SELECT * FROM pending_requests WHERE state = 'pending' AND username IN ({','.join('?' * len(chunk))})",
+                chunk
+            )
+        return {row["username"]: row for row in rows}
+
+    @METRICS.timed("storage_seconds", op="pending_transition_many")
+    def transition_many(self, usernames, state):
+        """transition() for many users in one transaction; returns those moved."""
+        if state not in self.STATES[1:]:
+            raise ValueError(f"Invalid target state: {state}")
+        now = int(time.time())
+        moved = []
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for username in usernames:
+                    cursor = self._db.execute(
+                        "UPDATE pending_requests SET state = ?, updated_at = ? WHERE username = ? AND state = 'pending'",
+                        (state, now, username)
+                    )
+                    if cursor.rowcount == 1:
+                        moved.append(username)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return moved
+
+    @METRICS.timed("storage_seconds", op="pending_list")
+    def list_pending(self, limit=50):
+        return self._query(
+            "SELECT * FROM pending_requests WHERE state = 'pending' ORDER BY created_at LIMIT ?", (limit,)
+        )
+
+    @METRICS.timed("storage_seconds", op="pending_count")
+    def count_pending(self):
+        return self._query("SELECT COUNT(*) AS n FROM pending_requests WHERE state = 'pending'")[0]["n"]
+
+    @METRICS.timed("storage_seconds", op="pending_find")
+    def find(self, field, value, limit=20):
+        """Most recent requests (any state) by username, bkash or ip."""
+        if field not in ("username", "bkash", "ip"):
+            raise ValueError(f"Unsupported lookup field: {field}")
+        return self._query(
+            f"SELECT * FROM pending_requests WHERE {field} = ? ORDER BY created_at DESC LIMIT ?", (value, limit)
+        )
+
+    @METRICS.timed("storage_seconds", op="pending_expire")
+    def expire_stale(self, ttl, retention):
+        """Expire requests left pending longer than ``ttl`` and purge finished
+        ones older than ``retention``. Returns ``(username, router)`` pairs
+        for the expired requests (router is '' for the default router)."""
+        now = int(time.time())
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                stale = [
+                    (row[0], row[1]) for row in self._db.execute(
+                        "SELECT username, router FROM pending_requests WHERE state = 'pending' AND created_at < ?",
+                        (now - ttl,)
+                    )
+                ]
+                self._db.execute(
+                    "UPDATE pending_requests SET state = 'expired', updated_at = ? "
+                    "WHERE state = 'pending' AND created_at < ?",
+                    (now, now - ttl)
+                )
+                self._db.execute(
+                    "DELETE FROM pending_requests WHERE state != 'pending' AND updated_at < ?",
+                    (now - retention,)
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return stale
+
+    def import_legacy_dir(self, directory):
+        """Move pending_users/*.json files into the store; returns the count."""
+        if not os.path.isdir(directory):
+            return 0
+        imported = 0
+        for name in os.listdir(directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                if not self.get_pending(data["username"]):
+                    self.add(data["username"], data["password"], data["ip"], data["package"],
+                             data.get("bkash", ""), created_at=os.path.getmtime(path), notified=True)
+                os.remove(path)
+                imported += 1
+            except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+                log.warning(f"Could not import legacy pending file {path}: {str(e)}")
+        return imported
+
+PENDING_STORE = PendingStore(PENDING_DB)
+METRICS.gauge("pending_requests", PENDING_STORE.count_pending)
+
+class ApprovalError(Exception):
+    """Expected approval failure; the message is shown to the admin as-is.
+
+    ``reason`` is a short machine-readable cause used as the metrics outcome.
+    """
+
+    def __init__(self, message, reason="refused"):
+        super().__init__(message)
+        self.reason = reason
+
+# Used until the first catalog is built or exported; prices in taka
+DEFAULT_PACKAGES = {
+    "1_day": {"days": 1, "label": "1 Day", "price": 10},
+    "7_days": {"days": 7, "label": "7 Days", "price": 30},
+    "30_days": {"days": 30, "label": "30 Days", "price": 100},
+}
+
+def fetch_profiles(api):
+    return api.get_resource("/ip/hotspot/user/profile").call("print", {".proplist": "name"})
+
+def write_json_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+class PackageCatalog:
+    """Sellable packages: name -> {"days", "label", "price"}.
+
+    A package is a hotspot user profile present on at least one router
+    whose duration is known, either from its name ("7_days", "12_hours",
+    "1_month") or from the override file, which can also set the label and
+    price or hide a profile with ``"hidden": true``. The catalog lives in
+    memory, so lookups never touch the router or the disk. ``refresh``
+    rebuilds it at most every ``ttl`` seconds, or right away when the
+    override file changed or ``force`` is set, and writes it to
+    ``export_file`` for the PHP pages whenever it changes, together with
+    the packages each router has so a portal only sells what its own
+    router can create.
+    """
+
+    NAME_PATTERN = re.compile(r"^(\d+)_?(hour|day|week|month)s?$")
+    UNIT_DAYS = {"hour": 1 / 24, "day": 1, "week": 7, "month": 30}
+
+    def __init__(self, override_file, export_file, ttl):
+        self.override_file = override_file
+        self.export_file = export_file
+        self.ttl = ttl
+        self.packages = dict(DEFAULT_PACKAGES)
+        self.routers = {}  # router -> names of the packages it has
+        self.updated_at = None  # monotonic time of the last router listing
+        self._profiles = None  # profile names from the last successful listing
+        self._router_profiles = {}  # router -> profile names from its last successful listing
+        self._overrides = {}
+        self._override_mtime = None
+        self._lock = asyncio.Lock()
+
+    def __contains__(self, package):
+        return self.resolve(package) is not None
+
+    def __iter__(self):
+        return iter(self.packages)
+
+    def resolve(self, package):
+        """Catalog name matching ``package`` case-insensitively, or None.
+
+        Keys keep the router's spelling ("3_Days") because that is the
+        profile name a user is set to; only matching ignores case.
+        """
+        if package in self.packages:
+            return package
+        wanted = package.lower()
+        return next((name for name in self.packages if name.lower() == wanted), None)
+
+    def days(self, package):
+        entry = self.packages.get(self.resolve(package))
+        return entry["days"] if entry else None
+
+    def price(self, package):
+        entry = self.packages.get(self.resolve(package))
+        return entry["price"] if entry else None
+
+    def load_export(self):
+        """Start from the last exported catalog so a restart while the
+        routers are unreachable keeps selling the same packages."""
+        try:
+            with open(self.export_file) as f:
+                export = json.load(f)
+            packages = export["packages"]
+        except (OSError, ValueError, KeyError) as e:
+            if not isinstance(e, FileNotFoundError):
+                log.warning(f"Ignoring unreadable package catalog {self.export_file}: {str(e)}")
+            return 0
+        self.packages = packages
+        self.routers = export.get("routers", {})
+        self._router_profiles = {router: set(names) for router, names in self.routers.items()}
+        return len(packages)
+
+    def _read_overrides(self):
+        """Reload the override file if its mtime changed; returns True if it did."""
+        try:
+            mtime = os.stat(self.override_file).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._override_mtime:
+            return False
+        self._override_mtime = mtime
+        if mtime is None:
+            self._overrides = {}
+        else:
+            with open(self.override_file) as f:
+                self._overrides = json.load(f)
+        return True
+
+    def build(self, profiles):
+        catalog = {}
+        for name in profiles:
+            entry = dict(DEFAULT_PACKAGES.get(name, {}))
+            match = self.NAME_PATTERN.match(name.lower())
+            if match and "days" not in entry:
+                count, unit = int(match[1]), match[2]
+                entry = {
+                    "days": count * self.UNIT_DAYS[unit],
+                    "label": f"{count} {unit.capitalize()}{'s' if count != 1 else ''}",
+                    "price": None,
+                }
+            entry.update(self._overrides.get(name, {}))
+            if entry.get("hidden") or "days" not in entry:
+                continue
+            entry.setdefault("label", name.replace("_", " "))
+            entry.setdefault("price", None)
+            catalog[name] = {key: entry[key] for key in ("days", "label", "price")}
+        return dict(sorted(catalog.items(), key=lambda item: (item[1]["days"], item[0])))
+
+    async def refresh(self, force=False):
+        """Rebuild the catalog if it is stale; returns True if it changed."""
+        async with self._lock:
+            overrides_changed = await asyncio.to_thread(self._read_overrides)
+            stale = self.updated_at is None or time.monotonic() - self.updated_at >= self.ttl
+            if not (force or stale or overrides_changed):
+                return False
+            if force or stale:
+                results = await fan_out(lambda name: run_router(fetch_profiles, router=name))
+                listings = {
+                    router: {row["name"] for row in rows if row.get("name")}
+                    for router, rows in results.items() if not isinstance(rows, BaseException)
+                }
+                if listings:
+                    # A router that did not answer keeps its last known profiles
+                    self._router_profiles.update(listings)
+                    self._profiles = sorted(set().union(*(
+                        profiles for router, profiles in self._router_profiles.items() if router in ROUTERS
+                    )))
+                    self.updated_at = time.monotonic()
+                for name, result in results.items():
+                    if isinstance(result, BaseException):
+                        log.warning(f"Could not list hotspot profiles on {name}: {str(result) or type(result).__name__}")
+            if self._profiles is None:
+                return False  # no router answered yet; keep the exported or default catalog
+            catalog = self.build(self._profiles)
+            routers = {
+                router: [name for name in catalog if name in profiles]
+                for router, profiles in sorted(self._router_profiles.items()) if router in ROUTERS
+            }
+            if catalog == self.packages and routers == self.routers:
+                return False
+            self.packages, self.routers = catalog, routers
+            await asyncio.to_thread(write_json_atomic, self.export_file, {
+                "updated": datetime.datetime.now().isoformat(timespec="seconds"), "packages": catalog,
+                "routers": routers,
+            })
+            log.info(f"Package catalog updated: {', '.join(catalog) or 'empty'}")
+            return True
+
+PACKAGES = PackageCatalog(PACKAGES_OVERRIDE_FILE, PACKAGES_EXPORT_FILE, PACKAGES_TTL)
+
+def get_expiry(package, approval_time=None):
+    # Resolved from the in-memory catalog; unknown packages are refused
+    # instead of silently getting one day
+    days = PACKAGES.days(package)
+    if days is None:
+        raise ApprovalError(f"❌ Unknown package '{package}'. See /packages.", reason="unknown_package")
+    # Use provided approval time or current time
+    approval_time = approval_time or datetime.datetime.now()
+    expiry_time = approval_time + datetime.timedelta(days=days)
+    # Format for MikroTik scheduler (e.g., jun/23/2025 13:00:00)
+    mikrotik_format = expiry_time.strftime("%b/%d/%Y %H:%M:%S").lower()
+    # Format for display (e.g., 2025-06-23 13:00)
+    display_format = expiry_time.strftime("%Y-%m-%d %H:%M")
+    return expiry_time, mikrotik_format, display_format
+
+def pipeline(*promises):
+    """Wait for replies to requests that were all sent before the first read.
+
+    Each request is written with its own tag as soon as ``call_async`` is
+    called, so N pipelined requests cost one round-trip instead of N. Every
+    promise is drained (errors are returned in place, not raised) so no
+    stray replies are left behind on the pooled session.
+    """
+    results = []
+    for promise in promises:
+        try:
+            results.append(promise.get())
+        except RouterOsApiCommunicationError as e:
+            results.append(e)
+    return results
+
+def legacy_expiry_lookups(api, usernames):
+    """Start the prints for legacy remove-user-* scripts and expire-user-*
+    schedulers of ``usernames``, to be pipelined with the caller's own
+    lookup. Returns the (scripts, schedulers) promises; scheduler rows carry
+    their start date and time, which is the old expiry."""
+    return (
+        api.get_resource("/system/script").call_async(
+            "print", {".proplist": ".id,name"}, additional_queries=name_filter(f"remove-user-{u}" for u in usernames)
+        ),
+        api.get_resource("/system/scheduler").call_async(
+            "print", {".proplist": ".id,name,start-date,start-time"},
+            additional_queries=name_filter(f"expire-user-{u}" for u in usernames)
+        ),
+    )
+
+def legacy_removals(api, legacy_scripts, legacy_schedulers, usernames):
+    """Start removing the legacy entries (as read by legacy_expiry_lookups)
+    of ``usernames``; returns the promises for the caller to pipeline. A
+    leftover scheduler would remove the user at its old expiry, so it goes
+    whenever the user is enabled or renewed."""
+    removals = []
+    for path, rows, prefix in (("/system/scheduler", legacy_schedulers, "expire-user-"),
+                               ("/system/script", legacy_scripts, "remove-user-")):
+        if not isinstance(rows, list):
+            continue
+        ids = [row["id"] for row in rows if row.get("name", "")[len(prefix):] in usernames]
+        if ids:
+            removals.append(api.get_resource(path).call_async("remove", {"id": ",".join(ids)}))
+    return removals
+
+def approve_on_router(api, username, password, package, bkash):
+    """Enable a pending hotspot user.
+
+    Runs in a router worker thread and needs two round-trips: a pipelined
+    lookup of the user plus any legacy remove-user/expire-user entries, then
+    a pipelined user update and legacy cleanup. Expiry is handled by the
+    bot's EXPIRY_QUEUE, so nothing is created in /system/script or
+    /system/scheduler. Returns ``(expiry_time, display_expiry)`` on success
+    and raises ApprovalError with an admin-facing message on expected
+    failures.
+    """
+    user_resource = api.get_resource("/ip/hotspot/user")
+    timings = {}
+    started = phase_start = time.perf_counter()
+
+    # Round-trip 1: fetch user and any legacy per-user script/scheduler together
+    users, legacy_scripts, legacy_schedulers = pipeline(
+        user_resource.call_async(
+            "print", {".proplist": ".id,name,password,profile,disabled"}, {"name": username}
+        ),
+        *legacy_expiry_lookups(api, [username]),
+    )
+    timings["lookup"] = time.perf_counter() - phase_start
+    METRICS.observe("routeros_roundtrip_seconds", timings["lookup"], phase="lookup")
+    if isinstance(users, Exception):
+        raise users
+    log.debug("Users found for %s: %s", username, users)
+    user = check_pending_user(users[0] if users else None, username, password, package)
+    user_id = user["id"]
+
+    # Calculate expiry time
+    approval_time = datetime.datetime.now()
+    expiry_time, mikrotik_expiry, display_expiry = get_expiry(package, approval_time)
+
+    # Round-trip 2: enable user and update comment. A leftover scheduler
+    # from before the migration would remove the user at the old expiry,
+    # so it is deleted in the same batch. A trap-free reply to "set"
+    # confirms the change, so the user is not read back.
+    phase_start = time.perf_counter()
+    legacy = legacy_removals(api, legacy_scripts, legacy_schedulers, {username})
+    enabled, *_ = pipeline(
+        user_resource.call_async(
+            "set", {"id": user_id, "disabled": "false", "comment": f"{bkash} | {display_expiry}"}
+        ),
+        *legacy
+    )
+    if isinstance(enabled, Exception):
+        raise ApprovalError(f"❌ Failed to enable user {username}: {str(enabled)}", reason="enable_failed")
+    timings["enable"] = time.perf_counter() - phase_start
+    METRICS.observe("routeros_roundtrip_seconds", timings["enable"], phase="enable")
+
+    total = time.perf_counter() - started
+    breakdown = " ".join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in timings.items())
+    log.info(f"Approval timing for {username}: {breakdown} total={total * 1000:.1f}ms (2 round-trips)")
+
+    return expiry_time, display_expiry
+
+def check_pending_user(user, username, password, package):
+    """Return the router row if it is the disabled user created for this
+    request; raise ApprovalError otherwise."""
+    if not user:
+        raise ApprovalError(f"❌ User {username} not found in MikroTik.", reason="not_found")
+
+    user_id = user.get('id')
+    if not user_id:
+        raise ApprovalError(f"❌ Could not retrieve user ID for {username}. User data: {user}", reason="missing_id")
+
+    # Verify user is disabled (accept 'true' or 'yes')
+    if user.get("disabled") not in ["true", "yes"]:
+        raise ApprovalError(
+            f"❌ User {username} is already enabled or in an unexpected state: {user.get('disabled')}",
+            reason="already_enabled"
+        )
+
+    # Verify user data matches (case-insensitive)
+    mikrotik_password = user.get("password") or ""  # Handle missing password
+    mikrotik_profile = user.get("profile") or ""    # Handle missing profile
+    if mikrotik_password != password or mikrotik_profile.lower() != package.lower():
+        if mikrotik_password != password:
+            METRICS.inc("approval_mismatches_total", field="router_password")
+        if mikrotik_profile.lower() != package.lower():
+            METRICS.inc("approval_mismatches_total", field="router_profile")
+        raise ApprovalError(
+            f"❌ User data mismatch for {username}: "
+            f"Password (MikroTik: '{mikrotik_password}' vs JSON: '{password}'), "
+            f"Profile (MikroTik: '{mikrotik_profile}' vs JSON: '{package}')",
+            reason="mismatch"
+        )
+    return user
+
+class SingleFlight:
+    """Coalesce concurrent runs of the same keyed operation.
+
+    The first caller for a key runs the operation; callers arriving while
+    it is in flight await the same future instead of repeating the router
+    work. The operation returns ``(result, cacheable)``; cacheable results
+    are kept for ``ttl`` seconds so a late double-tap is answered from
+    cache, while refusals are only shared with callers already waiting.
+    Exceptions are shared the same way and never cached, so a retry after
+    a timeout or a fixed mismatch runs again.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._inflight = {}  # key -> asyncio.Future
+        self._results = collections.OrderedDict()  # key -> (monotonic expiry, result), oldest first
+
+    def in_flight(self, key):
+        return key in self._inflight
+
+    async def run(self, key, operation):
+        now = time.monotonic()
+        while self._results and next(iter(self._results.values()))[0] <= now:
+            self._results.popitem(last=False)
+        if key in self._results:
+            METRICS.inc("singleflight_total", result="cached")
+            handler_outcome("cached")
+            return self._results[key][1]
+        future = self._inflight.get(key)
+        if future is not None:
+            METRICS.inc("singleflight_total", result="joined")
+            handler_outcome("coalesced")
+            # shield: a cancelled waiter must not cancel the shared run
+            return await asyncio.shield(future)
+
+        METRICS.inc("singleflight_total", result="run")
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            result, cacheable = await operation()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()  # mark retrieved; nobody may be waiting
+            raise
+        else:
+            future.set_result(result)
+            self._results.pop(key, None)
+            if cacheable:
+                self._results[key] = (time.monotonic() + self.ttl, result)
+            return result
+        finally:
+            del self._inflight[key]
+
+# Approve/reject callbacks per pending request: double taps and two admins
+# pressing at once share one run and its resulting caption
+CALLBACK_FLIGHTS = SingleFlight(CALLBACK_RESULT_TTL)
+
+def request_key(username, bkash, ip, package):
+    """Single-flight key for one pending request.
+
+    Built from the callback data minus the action, so approve and reject
+    for the same request share a key and never run at the same time, while
+    a later request that reuses the username gets a fresh key.
+    """
+    return (username, bkash, ip, package.lower())
+
+async def edit_caption(query, caption):
+    try:
+        await query.edit_message_caption(caption=caption, parse_mode="Markdown")
+    except BadRequest as e:
+        # A coalesced tap on the same message sets the same caption again
+        if "not modified" not in str(e).lower():
+            raise
+
+async def approve_request(bkash, username, ip, package):
+    """Approve one pending request; returns ``(caption, approved)``.
+
+    Expected refusals are returned as captions with ``approved`` False.
+    Unexpected errors (router timeouts, lost connections) propagate.
+    """
+    # Step 1: Load the pending request
+    user_data = await asyncio.to_thread(PENDING_STORE.get_pending, username)
+    if not user_data:
+        handler_outcome("not_pending")
+        error_msg = f"❌ No pending user found for username: {username}"
+        log.error(error_msg)
+        return error_msg, False
+
+    file_username = user_data["username"]
+    password = str(user_data["password"])  # Ensure string
+    file_ip = user_data["ip"]
+    file_package = user_data["package"]
+    router = user_data["router"] or DEFAULT_ROUTER
+
+    # Verify input data matches file
+    if ip != file_ip or package.lower() != file_package.lower() or username != file_username:
+        handler_outcome("mismatch")
+        for field, matches in (("ip", ip == file_ip), ("package", package.lower() == file_package.lower()),
+                               ("username", username == file_username)):
+            if not matches:
+                METRICS.inc("approval_mismatches_total", field=field)
+        error_msg = f"❌ Mismatch in user data: Username ({username} vs {file_username}), IP ({ip} vs {file_ip}) or Package ({package} vs {file_package})"
+        log.error(error_msg)
+        return error_msg, False
+
+    # Step 2: Enable the user on MikroTik off the event loop
+    try:
+        expiry_time, display_expiry = await run_router(
+            approve_on_router, username, password, package, bkash, router=router
+        )
+    except ApprovalError as e:
+        handler_outcome(e.reason)
+        error_msg = str(e)
+        log.error(error_msg)
+        return error_msg, False
+
+    # Step 3: Queue the expiry and close the request only if update was successful
+    await EXPIRY_QUEUE.schedule(username, expiry_time, router)
+    # Only the caller that closes the request records the sale
+    if await asyncio.to_thread(PENDING_STORE.transition, username, "approved"):
+        await record_sales("approved", [(username, user_data["bkash"], file_package, expiry_time)])
+    success_msg = (
+        f"✅ *User Approved!*\n\n"
+        f"👤 *Username:* `{username}`\n"
+        f"🔐 *Password:* `{password}`\n"
+        f"📦 *Package:* `{package}`\n"
+        f"📅 *Valid Till:* `{display_expiry}`\n"
+        f"🌐 *IP:* `{ip}`"
+    )
+    if len(ROUTERS) > 1:
+        success_msg += f"\n📡 *Router:* `{router}`"
+    log.info(f"User {username} approved successfully")
+    return success_msg, True
+
+@logged
+async def approve_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    try:
+        # Expected format: approve|bkash|username|ip|package
+        data = query.data.split('|')
+        if len(data) != 5:
+            handler_outcome("invalid_data")
+            error_msg = "❌ Invalid approval data format."
+            log.error(error_msg)
+            await edit_caption(query, error_msg)
+            return
+
+        _, bkash, username, ip, package = data
+        log_context(username=username)
+        caption = await CALLBACK_FLIGHTS.run(
+            request_key(username, bkash, ip, package),
+            functools.partial(approve_request, bkash, username, ip, package),
+        )
+        await edit_caption(query, caption)
+
+    except Exception as e:
+        handler_outcome("timeout" if isinstance(e, asyncio.TimeoutError) else "error")
+        error_msg = f"❌ Error approving user: {str(e)}"
+        log.error(error_msg)
+        await edit_caption(query, error_msg)
+
+async def reject_request(username, ip, package):
+    """Reject one pending request; returns ``(caption, rejected)``."""
+    # Check if pending user exists
+    user_data = await asyncio.to_thread(PENDING_STORE.get_pending, username)
+    if not user_data:
+        handler_outcome("not_pending")
+        error_msg = f"❌ No pending user found for username: {username}"
+        log.error(error_msg)
+        return error_msg, False
+
+    # Delete user from MikroTik off the event loop; a same-named enabled
+    # customer (username collision) is left alone
+    await run_router(remove_pending_on_router, [username], router=user_data["router"] or DEFAULT_ROUTER)
+
+    # Close the pending request
+    if await asyncio.to_thread(PENDING_STORE.transition, username, "rejected"):
+        await record_sales("rejected", [(username, user_data["bkash"], user_data["package"], None)])
+
+    success_msg = f"❌ *User Rejected!*\n\n👤 *Username:* `{username}`\n🌐 *IP:* `{ip}`\n📦 *Package:* `{package}`"
+    log.info(f"User {username} rejected successfully")
+    return success_msg, True
+
+@logged
+async def reject_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    try:
+        # Expected format: reject|bkash|username|ip|package
+        data = query.data.split('|')
+        if len(data) != 5:
+            handler_outcome("invalid_data")
+            error_msg = "❌ Invalid reject data format."
+            log.error(error_msg)
+            await edit_caption(query, error_msg)
+            return
+
+        _, bkash, username, ip, package = data
+        log_context(username=username)
+        # Same key as the approve button, so approve and reject taps for
+        # the same request never run against the router at the same time
+        caption = await CALLBACK_FLIGHTS.run(
+            request_key(username, bkash, ip, package),
+            functools.partial(reject_request, username, ip, package),
+        )
+        await edit_caption(query, caption)
+
+    except Exception as e:
+        handler_outcome("timeout" if isinstance(e, asyncio.TimeoutError) else "error")
+        error_msg = f"❌ Error rejecting user: {str(e)}"
+        log.error(error_msg)
+        await edit_caption(query, error_msg)
+
+class ExpiryQueue:
+    """Heap-ordered queue of (expiry_timestamp, router, username), persisted to JSON.
+
+    Re-scheduling a user pushes a new heap entry; the old one is skipped
+    when it reaches the top (lazy deletion), so every operation stays
+    O(log n). The file is rewritten atomically after each change.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._heap = []
+        self._expiries = {}  # (router, username) -> expiry timestamp (latest wins)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # concurrent approvals save from several threads
+        self._wakeup = None
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, "r") as f:
+            entries = json.load(f)
+        with self._lock:
+            # [ts, username, router]; entries written before multi-router
+            # support have no router and belong to the default one
+            self._expiries = {
+                (entry[2] if len(entry) > 2 else DEFAULT_ROUTER, entry[1]): float(entry[0]) for entry in entries
+            }
+            self._heap = [(ts, router, username) for (router, username), ts in self._expiries.items()]
+            heapq.heapify(self._heap)
+        return len(self._expiries)
+
+    @METRICS.timed("storage_seconds", op="expiry_save")
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        # Copy under the save lock too, so a later copy is never overwritten
+        # on disk by an earlier one still waiting to be written
+        with self._save_lock:
+            with self._lock:
+                entries = sorted((ts, username, router) for (router, username), ts in self._expiries.items())
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.path)
+
+    async def save(self):
+        await asyncio.to_thread(self._save)
+
+    def add(self, username, expiry_time, router=None):
+        ts = expiry_time.timestamp() if isinstance(expiry_time, datetime.datetime) else float(expiry_time)
+        router = router or DEFAULT_ROUTER
+        with self._lock:
+            self._expiries[(router, username)] = ts
+            heapq.heappush(self._heap, (ts, router, username))
+            is_next = self._heap[0] == (ts, router, username)
+        # Wake the sweeper if this is now the earliest expiry
+        if is_next and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def schedule(self, username, expiry_time, router=None):
+        self.add(username, expiry_time, router)
+        await self.save()
+
+    def expiry_of(self, username, router=None):
+        """Scheduled expiry timestamp of ``username``, or None."""
+        with self._lock:
+            return self._expiries.get((router or DEFAULT_ROUTER, username))
+
+    def pop_due(self, now=None, limit=None):
+        """Remove and return up to ``limit`` (ts, router, username) entries whose expiry has passed."""
+        now = now or time.time()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now and (limit is None or len(due) < limit):
+                ts, router, username = heapq.heappop(self._heap)
+                if self._expiries.get((router, username)) == ts:
+                    del self._expiries[(router, username)]
+                    due.append((ts, router, username))
+        return due
+
+    async def wait(self, timeout):
+        """Sleep up to ``timeout`` seconds, returning early if an earlier expiry is added."""
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def next_due(self):
+        with self._lock:
+            while self._heap and self._expiries.get(self._heap[0][1:]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            return self._heap[0][0] if self._heap else None
+
+    def __len__(self):
+        return len(self._expiries)
+
+EXPIRY_QUEUE = ExpiryQueue(EXPIRY_QUEUE_FILE)
+METRICS.gauge("expiry_queue_size", lambda: len(EXPIRY_QUEUE))
+
+def name_filter(names):
+    """RouterOS query stack matching any of ``names`` (one OR'ed print)."""
+    queries = [IsEqualQuery("name", name) for name in names]
+    # "?#" with no operator is not a valid stack, so one name is a plain query
+    return (OrQuery(*queries),) if len(queries) > 1 else tuple(queries)
+
+def expire_on_router(api, usernames, action):
+    """Remove or disable a batch of expired users in two round-trips.
+
+    Returns the usernames that were found on the router.
+    """
+    user_resource = api.get_resource("/ip/hotspot/user")
+    rows = user_resource.call(
+        "print", {".proplist": ".id,name"}, additional_queries=name_filter(usernames)
+    )
+    if not rows:
+        return []
+    ids = ",".join(row["id"] for row in rows)
+    if action == "disable":
+        user_resource.call("set", {"id": ids, "disabled": "true"})
+    else:
+        user_resource.call("remove", {"id": ids})
+    return [row["name"] for row in rows]
+
+def remove_pending_on_router(api, usernames):
+    """Delete the users of closed requests in two round-trips, but only while
+    they are still disabled and marked ``| pending``.
+
+    A user that was approved or renewed in the meantime is a paying
+    customer and is left alone. Returns ``(removed, kept)``; usernames in
+    neither list were not on the router.
+    """
+    user_resource = api.get_resource("/ip/hotspot/user")
+    rows = user_resource.call(
+        "print", {".proplist": ".id,name,disabled,comment"}, additional_queries=name_filter(usernames)
+    )
+    pending = [
+        row for row in rows
+        if row.get("disabled") in ("true", "yes") and (row.get("comment") or "").endswith("| pending")
+    ]
+    if pending:
+        user_resource.call("remove", {"id": ",".join(row["id"] for row in pending)})
+    removed = {row["name"] for row in pending}
+    return sorted(removed), sorted({row["name"] for row in rows} - removed)
+
+async def expiry_sweeper(app):
+    """Expire due users in batches; on startup this also catches up on
+    anything that fell due while the bot was down."""
+    log_context(handler="expiry_sweeper")
+    while True:
+        due = EXPIRY_QUEUE.pop_due(limit=EXPIRY_BATCH_SIZE)
+        if due:
+            by_router = collections.defaultdict(list)
+            for ts, router, username in due:
+                by_router[router].append((ts, username))
+            results = await asyncio.gather(
+                *(
+                    run_router(expire_on_router, [username for _, username in batch], EXPIRY_ACTION, router=router)
+                    for router, batch in by_router.items()
+                ),
+                return_exceptions=True
+            )
+            expired, failed = [], 0
+            for (router, batch), result in zip(by_router.items(), results):
+                if isinstance(result, Exception):
+                    # Put this router's batch back and retry on the next sweep
+                    for ts, username in batch:
+                        EXPIRY_QUEUE.add(username, ts, router)
+                    failed += len(batch)
+                    log.error(f"❌ Expiry sweep failed for {len(batch)} users on {router}: {str(result)}")
+                    ADMIN_DIGEST.add(f"❌ Expiry sweep failed on {router}: {str(result) or type(result).__name__}")
+                else:
+                    expired.extend(result)
+            await EXPIRY_QUEUE.save()
+            verb = "Disabled" if EXPIRY_ACTION == "disable" else "Removed"
+            log.info(f"Expiry sweep: {verb.lower()} {len(expired)} of {len(due) - failed} due users: {', '.join(expired)}")
+            await record_sales("expired", [(username, None, None, None) for username in expired])
+            if expired:
+                ADMIN_DIGEST.add(f"⌛ {verb} {len(expired)} expired user(s): {', '.join(expired)}")
+            if failed:
+                # The failed batches are due again right away; back off instead of spinning
+                await asyncio.sleep(EXPIRY_SWEEP_INTERVAL)
+                continue
+            if len(due) == EXPIRY_BATCH_SIZE:
+                continue  # more may be due; keep draining
+        next_due = EXPIRY_QUEUE.next_due()
+        delay = EXPIRY_SWEEP_INTERVAL if next_due is None else min(max(next_due - time.time(), 0), EXPIRY_SWEEP_INTERVAL)
+        await EXPIRY_QUEUE.wait(delay)
+
+def parse_scheduler_time(start_date, start_time):
+    """Parse a scheduler start-date/start-time (RouterOS 6 "jun/23/2025" or 7 "2025-06-23")."""
+    for fmt in ("%b/%d/%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.datetime.strptime(f"{start_date.capitalize()} {start_time}", fmt)
+        except ValueError:
+            continue
+    return None
+
+def fetch_legacy_expiry(api):
+    """Read every expire-user-* scheduler and remove-user-* script."""
+    schedulers = api.get_resource("/system/scheduler").call(
+        "print", {".proplist": ".id,name,start-date,start-time"}
+    )
+    scripts = api.get_resource("/system/script").call("print", {".proplist": ".id,name"})
+    return (
+        [row for row in schedulers if row.get("name", "").startswith("expire-user-")],
+        [row for row in scripts if row.get("name", "").startswith("remove-user-")],
+    )
+
+def remove_legacy_expiry(api, scheduler_ids, script_ids):
+    """Delete migrated schedulers and scripts, one pipelined round-trip."""
+    pipeline(*(
+        api.get_resource(path).call_async("remove", {"id": ",".join(ids)})
+        for path, ids in (("/system/scheduler", scheduler_ids), ("/system/script", script_ids))
+        if ids
+    ))
+
+async def migrate_router_expiry(router):
+    """Import one router's legacy schedulers into EXPIRY_QUEUE and delete them.
+
+    Returns ``(migrated, skipped, deleted_schedulers, deleted_scripts)``.
+    """
+    schedulers, scripts = await run_router(fetch_legacy_expiry, router=router)
+    migrated, skipped = [], []
+    scheduler_ids = []
+    for row in schedulers:
+        username = row["name"][len("expire-user-"):]
+        expiry_time = parse_scheduler_time(row.get("start-date", ""), row.get("start-time", ""))
+        if expiry_time is None:
+            skipped.append(username)
+            continue
+        EXPIRY_QUEUE.add(username, expiry_time, router)
+        migrated.append(username)
+        scheduler_ids.append(row["id"])
+    # Persist the queue before touching the router so no expiry is lost
+    await EXPIRY_QUEUE.save()
+    migrated_set = set(migrated)
+    script_ids = [row["id"] for row in scripts if row["name"][len("remove-user-"):] in migrated_set]
+    await run_router(remove_legacy_expiry, scheduler_ids, script_ids, router=router)
+    return migrated, skipped, len(scheduler_ids), len(script_ids)
+
+@logged
+async def migrate_expiry(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        # Two router calls per site, so allow more than the default fan-out bound
+        results = await fan_out(migrate_router_expiry, timeout=ROUTER_CALL_TIMEOUT * 2)
+        done = [result for result in results.values() if not isinstance(result, BaseException)]
+        migrated = [username for result in done for username in result[0]]
+        skipped = [username for result in done for username in result[1]]
+        deleted_schedulers = sum(result[2] for result in done)
+        deleted_scripts = sum(result[3] for result in done)
+
+        msg = (
+            f"✅ *Expiry migration done*\n"
+            f"Imported: {len(migrated)} schedulers\n"
+            f"Deleted: {deleted_schedulers} schedulers, {deleted_scripts} scripts\n"
+            f"Queue size: {len(EXPIRY_QUEUE)}"
+        )
+        if skipped:
+            msg += f"\nSkipped (unparseable start time): {', '.join(skipped)}"
+        msg += fan_out_warnings(results)
+        log.info(f"Expiry migration: imported {len(migrated)}, skipped {len(skipped)}")
+        await update.message.reply_text(msg, parse_mode='Markdown')
+    except Exception as e:
+        handler_outcome("error")
+        error_msg = f"❌ Error migrating expiries: {str(e)}"
+        log.error(error_msg)
+        await update.message.reply_text(error_msg)
+
+async def pending_cleanup(app):
+    """Expire abandoned requests and delete their disabled router users."""
+    log_context(handler="pending_cleanup")
+    while True:
+        try:
+            stale = await asyncio.to_thread(PENDING_STORE.expire_stale, PENDING_TTL, PENDING_RETENTION)
+            by_router = collections.defaultdict(list)
+            for username, router in stale:
+                by_router[router or DEFAULT_ROUTER].append(username)
+            for router, usernames in by_router.items():
+                for start in range(0, len(usernames), EXPIRY_BATCH_SIZE):
+                    _, kept = await run_router(
+                        remove_pending_on_router, usernames[start:start + EXPIRY_BATCH_SIZE], router=router
+                    )
+                    if kept:
+                        log.warning(f"Kept enabled users of expired requests on {router}: {', '.join(kept)}")
+                        ADMIN_DIGEST.add(f"⚠️ Requests expired but their users are enabled on {router}, left alone: {', '.join(kept)}")
+            if stale:
+                log.info(f"Expired {len(stale)} abandoned pending requests: {', '.join(username for username, _ in stale)}")
+        except Exception as e:
+            log.error(f"❌ Pending cleanup failed: {str(e)}")
+            ADMIN_DIGEST.add(f"❌ Pending cleanup failed: {str(e)}")
+        await asyncio.sleep(PENDING_CLEANUP_INTERVAL)
+
+class TableSnapshot:
+    """Last listing of one router table keyed by .id, with the time each row
+    was first seen in its current form.
+
+    Each reconcile pass diffs a fresh ``.proplist`` listing against it, so a
+    row's age is how long it has been unchanged, not how long the bot has
+    been running.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.first_seen = {}
+
+    def apply(self, rows, now):
+        """Replace the snapshot; returns (added, removed, changed)."""
+        fresh = {row["id"]: row for row in rows if row.get("id")}
+        added = changed = 0
+        for row_id, row in fresh.items():
+            current = self.rows.get(row_id)
+            if current == row:
+                continue
+            if current is None:
+                added += 1
+            else:
+                changed += 1
+            self.first_seen[row_id] = now
+        removed = self.rows.keys() - fresh.keys()
+        for row_id in removed:
+            del self.first_seen[row_id]
+        self.rows = fresh
+        return added, len(removed), changed
+
+    def aged(self, min_age, now):
+        """Rows unchanged for at least ``min_age`` seconds."""
+        return [row for row_id, row in self.rows.items() if now - self.first_seen[row_id] >= min_age]
+
+RECONCILE_TABLES = ("/ip/hotspot/user", "/system/script", "/system/scheduler")
+RECONCILE_SNAPSHOTS = {name: {path: TableSnapshot() for path in RECONCILE_TABLES} for name in ROUTERS}
+
+def fetch_reconcile_snapshot(api):
+    """Disabled hotspot users plus every script and scheduler, in one
+    pipelined round-trip and only the columns the reconciler reads."""
+    return pipeline(
+        api.get_resource("/ip/hotspot/user").call_async(
+            "print", {".proplist": ".id,name,comment"}, {"disabled": "true"}
+        ),
+        api.get_resource("/system/script").call_async("print", {".proplist": ".id,name"}),
+        api.get_resource("/system/scheduler").call_async("print", {".proplist": ".id,name"}),
+    )
+
+def existing_users(api, usernames):
+    rows = api.get_resource("/ip/hotspot/user").call(
+        "print", {".proplist": "name"}, additional_queries=name_filter(usernames)
+    )
+    return {row["name"] for row in rows}
+
+def remove_ids(api, path, ids):
+    api.get_resource(path).call("remove", {"id": ",".join(ids)})
+
+async def reconcile_router(router):
+    """One reconcile pass over ``router``; returns what was cleaned up.
+
+    Orphans are disabled users with a ``pending`` comment and no open
+    request, legacy ``remove-user-*`` scripts or ``expire-user-*``
+    schedulers missing their other half, and open requests whose router
+    user is gone. Router rows must have been unchanged for
+    RECONCILE_ORPHAN_AGE and requests must be older than RECONCILE_ROW_GRACE
+    before they are touched.
+    """
+    listings = await run_router(fetch_reconcile_snapshot, router=router)
+    for listing in listings:
+        if isinstance(listing, Exception):
+            raise listing
+    now = time.time()
+    snapshots = RECONCILE_SNAPSHOTS[router]
+    for path, listing in zip(RECONCILE_TABLES, listings):
+        added, removed, changed = snapshots[path].apply(listing, now)
+        log.debug(f"Reconcile snapshot {router}{path}: +{added} -{removed} ~{changed}")
+
+    # Disabled users still marked pending whose request is no longer open
+    users = snapshots["/ip/hotspot/user"]
+    candidates = [
+        row for row in users.aged(RECONCILE_ORPHAN_AGE, now)
+        if (row.get("comment") or "").endswith("| pending") and row.get("name")
+    ]
+    open_requests = await asyncio.to_thread(PENDING_STORE.get_pending_many, [row["name"] for row in candidates])
+    orphan_users = [
+        row for row in candidates
+        if row["name"] not in open_requests or (open_requests[row["name"]]["router"] or DEFAULT_ROUTER) != router
+    ]
+
+    # Legacy expiry pairs with one half missing can never run to completion
+    scripts = {row.get("name"): row for row in snapshots["/system/script"].aged(RECONCILE_ORPHAN_AGE, now)}
+    schedulers = {row.get("name"): row for row in snapshots["/system/scheduler"].aged(RECONCILE_ORPHAN_AGE, now)}
+    all_scripts = {row.get("name") for row in snapshots["/system/script"].rows.values()}
+    all_schedulers = {row.get("name") for row in snapshots["/system/scheduler"].rows.values()}
+    orphan_scripts = [
+        row for name, row in scripts.items()
+        if name and name.startswith("remove-user-") and f"expire-user-{name[12:]}" not in all_schedulers
+    ]
+    orphan_schedulers = [
+        row for name, row in schedulers.items()
+        if name and name.startswith("expire-user-") and f"remove-user-{name[12:]}" not in all_scripts
+    ]
+
+    # Open requests whose disabled user never made it to (or vanished from) the router
+    rows = await asyncio.to_thread(PENDING_STORE.list_pending, -1)
+    disabled = {row.get("name") for row in users.rows.values()}
+    unmatched = [
+        row["username"] for row in rows
+        if (row["router"] or DEFAULT_ROUTER) == router and row["created_at"] <= now - RECONCILE_ROW_GRACE
+        and row["username"] not in disabled
+    ]
+    missing = []
+    for batch in batches(unmatched, RECONCILE_BATCH_SIZE):
+        # Enabled users are not in the snapshot; only close requests with no user at all
+        found = await run_router(existing_users, batch, router=router)
+        missing.extend(username for username in batch if username not in found)
+
+    for path, orphans in (
+        ("/ip/hotspot/user", orphan_users), ("/system/script", orphan_scripts), ("/system/scheduler", orphan_schedulers)
+    ):
+        for batch in batches(orphans, RECONCILE_BATCH_SIZE):
+            await run_router(remove_ids, path, [row["id"] for row in batch], router=router)
+    closed = await asyncio.to_thread(PENDING_STORE.transition_many, missing, "expired") if missing else []
+
+    report = {
+        "users": [row["name"] for row in orphan_users],
+        "scripts": [row["name"] for row in orphan_scripts],
+        "schedulers": [row["name"] for row in orphan_schedulers],
+        "requests": closed,
+    }
+    for kind, names in report.items():
+        if names:
+            METRICS.inc("reconcile_removed_total", len(names), kind=kind, router=router)
+    return report
+
+def format_reconcile_report(router, report):
+    labels = {
+        "users": "orphaned pending user(s)",
+        "scripts": "remove-user script(s) without scheduler",
+        "schedulers": "expire-user scheduler(s) without script",
+        "requests": "pending request(s) with no router user closed",
+    }
+    parts = []
+    for kind, names in report.items():
+        if names:
+            shown = ", ".join(names[:20]) + (f" +{len(names) - 20} more" if len(names) > 20 else "")
+            parts.append(f"{len(names)} {labels[kind]}: {shown}")
+    prefix = f"🧹 {router}: " if len(ROUTERS) > 1 else "🧹 "
+    return prefix + "; ".join(parts) if parts else None
+
+async def reconciler(app):
+    """Periodically clean up orphans left by failed or abandoned requests."""
+    log_context(handler="reconciler")
+    while True:
+        await asyncio.sleep(RECONCILE_INTERVAL)
+        results = await fan_out(reconcile_router, timeout=RECONCILE_TIMEOUT)
+        for router, result in results.items():
+            if isinstance(result, BaseException):
+                log.error(f"❌ Reconcile failed on {router}: {str(result) or type(result).__name__}")
+                ADMIN_DIGEST.add(f"❌ Reconcile failed on {router}: {str(result) or type(result).__name__}")
+                continue
+            summary = format_reconcile_report(router, result)
+            if summary:
+                log.info(f"Reconcile: {summary}")
+                ADMIN_DIGEST.add(summary)
+
+@logged
+async def reconcile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        results = await fan_out(reconcile_router, timeout=RECONCILE_TIMEOUT)
+        lines = [
+            format_reconcile_report(router, result) for router, result in results.items()
+            if not isinstance(result, BaseException)
+        ]
+        lines = [line for line in lines if line]
+        msg = "\n".join(lines) if lines else "✅ No orphans older than the age policy."
+        msg += fan_out_warnings(results)
+        if len(msg) > TELEGRAM_MESSAGE_LIMIT:
+            msg = msg[:TELEGRAM_MESSAGE_LIMIT - 1] + "…"
+        await update.message.reply_text(msg)
+    except Exception as e:
+        handler_outcome("error")
+        error_msg = f"❌ Error reconciling: {str(e)}"
+        log.error(error_msg)
+        await update.message.reply_text(error_msg)
+
+def format_pending_row(row):
+    created = datetime.datetime.fromtimestamp(row["created_at"]).strftime("%m-%d %H:%M")
+    router = f" @{row['router'] or DEFAULT_ROUTER}" if len(ROUTERS) > 1 else ""
+    return f"• `{row['username']}` `{row['package']}` bKash `{row['bkash']}` IP {row['ip']}{router} ({created}, {row['state']})"
+
+@logged
+async def pending_requests(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        if context.args:
+            # Lookup by IP, bKash number or username, any state
+            term = context.args[0]
+            if term.count(".") == 3:
+                field = "ip"
+            elif term.isdigit():
+                field = "bkash"
+            else:
+                field = "username"
+            rows = await asyncio.to_thread(PENDING_STORE.find, field, term)
+            if not rows:
+                await update.message.reply_text(f"No requests found for {field} `{term}`.", parse_mode='Markdown')
+                return
+            msg = f"*🔎 Requests for {field} `{term}`:*\n" + "\n".join(format_pending_row(row) for row in rows)
+        else:
+            rows = await asyncio.to_thread(PENDING_STORE.list_pending, 30)
+            total = await asyncio.to_thread(PENDING_STORE.count_pending)
+            if not rows:
+                await update.message.reply_text("No pending requests.")
+                return
+            msg = f"*⏳ Pending Requests ({total}):*\n" + "\n".join(format_pending_row(row) for row in rows)
+            if total > len(rows):
+                msg += f"\n…and {total - len(rows)} more"
+        await update.message.reply_text(msg, parse_mode='Markdown')
+    except Exception as e:
+        handler_outcome("error")
+        error_msg = f"❌ Error: {str(e)}"
+        log.error(error_msg)
+        await update.message.reply_text(error_msg)
+
+def batches(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+def bulk_approve_on_router(api, requests):
+    """Enable many pending users in two pipelined round-trips.
+
+    ``requests`` are pending-store rows for this router. Round-trip 1 reads
+    all their users and any legacy remove-user/expire-user entries with
+    OR'ed queries; round-trip 2 sends one "set" per valid user (each gets
+    its own comment) plus the legacy removals before reading any reply.
+    Returns ``{username: (expiry_time, display_expiry) or ApprovalError}``.
+    """
+    user_resource = api.get_resource("/ip/hotspot/user")
+    usernames = [request["username"] for request in requests]
+
+    users, legacy_scripts, legacy_schedulers = pipeline(
+        user_resource.call_async(
+            "print", {".proplist": ".id,name,password,profile,disabled"}, additional_queries=name_filter(usernames)
+        ),
+        *legacy_expiry_lookups(api, usernames),
+    )
+    if isinstance(users, Exception):
+        raise users
+    by_name = {user.get("name"): user for user in users}
+
+    results = {}
+    updates = []
+    approval_time = datetime.datetime.now()
+    for request in requests:
+        username = request["username"]
+        try:
+            user = check_pending_user(by_name.get(username), username, str(request["password"]), request["package"])
+            expiry_time, _, display_expiry = get_expiry(request["package"], approval_time)
+        except ApprovalError as e:
+            results[username] = e
+            continue
+        results[username] = (expiry_time, display_expiry)
+        updates.append((username, user_resource.call_async(
+            "set", {"id": user["id"], "disabled": "false", "comment": f"{request['bkash']} | {display_expiry}"}
+        )))
+
+    approved = {username for username, _ in updates}
+    legacy = legacy_removals(api, legacy_scripts, legacy_schedulers, approved)
+    replies = pipeline(*(promise for _, promise in updates), *legacy)
+    for (username, _), reply in zip(updates, replies):
+        if isinstance(reply, Exception):
+            results[username] = ApprovalError(f"❌ Failed to enable user {username}: {str(reply)}", reason="enable_failed")
+    return results
+
+def renew_on_router(api, usernames, package, expiries):
+    """Extend existing users by ``package`` in two round-trips.
+
+    Renewal starts from the user's current expiry in ``expiries`` (or in a
+    legacy expire-user scheduler) while it is still ahead, otherwise from
+    now. Users are re-enabled and moved to the package profile; the bKash
+    number in their comment is kept. Users still marked ``| pending`` are
+    waiting for approval and are refused, not enabled. Legacy
+    remove-user/expire-user entries are deleted in the same batch, since
+    the scheduler would otherwise remove the user at the old expiry. Returns
+    ``{username: (expiry_time, display_expiry) or ApprovalError}`` for the
+    users found on this router.
+    """
+    user_resource = api.get_resource("/ip/hotspot/user")
+    rows, legacy_scripts, legacy_schedulers = pipeline(
+        user_resource.call_async("print", {".proplist": ".id,name,comment"}, additional_queries=name_filter(usernames)),
+        *legacy_expiry_lookups(api, usernames),
+    )
+    if isinstance(rows, Exception):
+        raise rows
+    legacy_expiries = {}
+    if isinstance(legacy_schedulers, list):
+        for scheduler in legacy_schedulers:
+            expiry = parse_scheduler_time(scheduler.get("start-date", ""), scheduler.get("start-time", ""))
+            if expiry:
+                legacy_expiries[scheduler.get("name", "")[len("expire-user-"):]] = expiry
+    now = datetime.datetime.now()
+    results = {}
+    updates = []
+    for row in rows:
+        if (row.get("comment") or "").endswith("| pending"):
+            results[row["name"]] = ApprovalError(
+                f"❌ {row['name']} is waiting for approval, not renewed", reason="pending_approval"
+            )
+            continue
+        current = expiries.get(row["name"])
+        start = max(now, datetime.datetime.fromtimestamp(current)) if current else now
+        start = max(start, legacy_expiries.get(row["name"], now))
+        expiry_time, _, display_expiry = get_expiry(package, start)
+        bkash = (row.get("comment") or "").split(" | ")[0]
+        updates.append((row["name"], expiry_time, display_expiry, user_resource.call_async(
+            "set", {"id": row["id"], "disabled": "false", "profile": package, "comment": f"{bkash} | {display_expiry}"}
+        )))
+    legacy = legacy_removals(api, legacy_scripts, legacy_schedulers, {username for username, *_ in updates})
+    replies = pipeline(*(u[3] for u in updates), *legacy)
+    for (username, expiry_time, display_expiry, _), reply in zip(updates, replies):
+        if isinstance(reply, Exception):
+            results[username] = ApprovalError(f"❌ Failed to renew {username}: {str(reply)}", reason="renew_failed")
+        else:
+            results[username] = (expiry_time, display_expiry)
+    return results
+
+async def run_batches(func, batches_by_router, *args):
+    """run_router(func, batch, *args) for every batch concurrently (the
+    pools bound the parallelism). Returns ``(router, batch, result)`` tuples with
+    exceptions returned in place."""
+    calls = [(router, batch) for router, batch_list in batches_by_router.items() for batch in batch_list]
+    results = await asyncio.gather(
+        *(run_router(func, batch, *args, router=router) for router, batch in calls), return_exceptions=True
+    )
+    return [(router, batch, result) for (router, batch), result in zip(calls, results)]
+
+async def bulk_approve(requests):
+    """Approve pending-store rows on their routers, BULK_BATCH_SIZE at a time.
+
+    Returns ``{username: (ok, detail)}`` in request order.
+    """
+    outcome = {request["username"]: None for request in requests}
+    busy = [
+        request for request in requests
+        if CALLBACK_FLIGHTS.in_flight(
+            request_key(request["username"], request["bkash"], request["ip"], request["package"]))
+    ]
+    for request in busy:
+        outcome[request["username"]] = (False, "approve/reject button in progress")
+    by_router = collections.defaultdict(list)
+    for request in requests:
+        if outcome[request["username"]] is None:
+            by_router[request["router"] or DEFAULT_ROUTER].append(request)
+    approved = []
+    expiries = {}
+    results = await run_batches(
+        bulk_approve_on_router, {router: batches(rows, BULK_BATCH_SIZE) for router, rows in by_router.items()}
+    )
+    for router, batch, result in results:
+        if isinstance(result, BaseException):
+            for request in batch:
+                outcome[request["username"]] = (False, str(result) or type(result).__name__)
+            continue
+        for username, value in result.items():
+            if isinstance(value, ApprovalError):
+                outcome[username] = (False, value.reason.replace("_", " "))
+            else:
+                EXPIRY_QUEUE.add(username, value[0], router)
+                approved.append(username)
+                expiries[username] = value[0]
+                outcome[username] = (True, f"until `{value[1]}`")
+    if approved:
+        await EXPIRY_QUEUE.save()
+        # Requests a concurrent tap or the cleanup already closed are not sold twice
+        moved = set(await asyncio.to_thread(PENDING_STORE.transition_many, approved, "approved"))
+        await record_sales("approved", [
+            (request["username"], request["bkash"], request["package"], expiries[request["username"]])
+            for request in requests if request["username"] in moved
+        ])
+    log.info(f"Bulk approve: {len(approved)} of {len(requests)} approved")
+    return outcome
+
+def format_bulk_summary(title, outcome):
+    """One message for a bulk command: a totals header and one row per user."""
+    ok = sum(1 for success, _ in outcome.values() if success)
+    msg = f"*{title}:* {ok} ok, {len(outcome) - ok} failed\n"
+    for i, (username, (success, detail)) in enumerate(outcome.items()):
+        line = f"✅ `{username}` {detail}\n" if success else f"❌ `{username}`: `{detail}`\n"
+        if len(msg) + len(line) > TELEGRAM_MESSAGE_LIMIT - 30:
+            msg += f"…and {len(outcome) - i} more"
+            break
+        msg += line
+    if ok < len(outcome):
+        handler_outcome("partial")
+    return msg
+
+@logged
+async def approve_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        requests = await asyncio.to_thread(PENDING_STORE.list_pending, -1)  # -1: no limit
+        if not requests:
+            await update.message.reply_text("No pending requests.")
+            return
+        outcome = await bulk_approve(requests)
+        await update.message.reply_text(format_bulk_summary("✅ Approve all", outcome), parse_mode='Markdown')
+    except Exception as e:
+        handler_outcome("error")
+        error_msg = f"❌ Error approving users: {str(e)}"
+        log.error(error_msg)
+        await update.message.reply_text(error_msg)
+
+@logged
+async def approve_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        handler_outcome("invalid_args")
+        await update.message.reply_text("Usage: /approve <username> [username...]")
+        return
+    try:
+        usernames = list(dict.fromkeys(context.args))
+        pending = await asyncio.to_thread(PENDING_STORE.get_pending_many, usernames)
+        outcome = {username: (False, "not pending") for username in usernames}
+        outcome.update(await bulk_approve([pending[username] for username in usernames if username in pending]))
+        await update.message.reply_text(format_bulk_summary("✅ Approve", outcome), parse_mode='Markdown')
+    except Exception as e:
+        handler_outcome("error")
+        error_msg = f"❌ Error approving users: {str(e)}"
+        log.error(error_msg)
+        await update.message.reply_text(error_msg)
+
+@logged
+async def reject_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        requests = await asyncio.to_thread(PENDING_STORE.list_pending, -1)  # -1: no limit
+        if not requests:
+            await update.message.reply_text("No pending requests.")
+            return
+        outcome = {}
+        by_router = collections.defaultdict(list)
+        for request in requests:
+            if CALLBACK_FLIGHTS.in_flight(
+                request_key(request["username"], request["bkash"], request["ip"], request["package"])):
+                outcome[request["username"]] = (False, "approve/reject button in progress")
+            else:
+                by_router[request["router"] or DEFAULT_ROUTER].append(request["username"])
+        rejected = []
+        # One OR'ed print and one multi-id remove per batch
+        results = await run_batches(
+            remove_pending_on_router,
+            {router: batches(usernames, BULK_BATCH_SIZE) for router, usernames in by_router.items()}
+        )
+        for router, batch, result in results:
+            kept = set() if isinstance(result, BaseException) else set(result[1])
+            for username in batch:
+                if isinstance(result, BaseException):
+                    outcome[username] = (False, str(result) or type(result).__name__)
+                elif username in kept:
+                    outcome[username] = (False, "user is enabled on the router, not removed")
+                else:
+                    outcome[username] = (True, "rejected")
+                    rejected.append(username)
+        if rejected:
+            done = set(await asyncio.to_thread(PENDING_STORE.transition_many, rejected, "rejected"))
+            await record_sales("rejected", [
+                (request["username"], request["bkash"], request["package"], None)
+                for request in requests if request["username"] in done
+            ])
+        log.info(f"Bulk reject: {len(rejected)} of {len(requests)} rejected")
+        await update.message.reply_text(format_bulk_summary("❌ Reject all", outcome), parse_mode='Markdown')
+    except Exception as e:
+        handler_outcome("error")
+        error_msg = f"❌ Error rejecting users: {str(e)}"
+        log.error(error_msg)
+        await update.message.reply_text(error_msg)
+
+@logged
+async def renew_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = list(context.args or [])
+    if len(args) < 2:
+        handler_outcome("invalid_args")
+        await update.message.reply_text("Usage: /renew <username> [username...] <package>")
+        return
+    package = args.pop()
+    try:
+        if package not in PACKAGES:
+            # A profile added on the router since the last refresh is picked up here
+            await PACKAGES.refresh(force=True)
+        if package not in PACKAGES:
+            handler_outcome("invalid_args")
+            await update.message.reply_text(
+                f"❌ Unknown package `{package}`. Use one of: {', '.join(f'`{name}`' for name in PACKAGES)}",
+                parse_mode='Markdown'
+            )
+            return
+        package = PACKAGES.resolve(package)  # the profile name as spelled on the router
+        usernames = list(dict.fromkeys(args))
+        outcome = {username: (False, "not found") for username in usernames}
+        # A purchase still waiting for approval is approved, not renewed;
+        # renewing it would leave its request open for the pending cleanup
+        open_requests = await asyncio.to_thread(PENDING_STORE.get_pending_many, usernames)
+        for username in open_requests:
+            outcome[username] = (False, "pending approval")
+        usernames = [username for username in usernames if username not in open_requests]
+        renewed = []
+        # The user may be on any router; each one renews the users it has
+        calls = [(router, batch) for router in ROUTERS for batch in batches(usernames, BULK_BATCH_SIZE)]
+        results = await asyncio.gather(*(
+            run_router(
+                renew_on_router, batch, package,
+                {username: EXPIRY_QUEUE.expiry_of(username, router) for username in batch},
+                router=router
+            )
+            for router, batch in calls
+        ), return_exceptions=True)
+        for (router, batch), result in zip(calls, results):
+            if isinstance(result, BaseException):
+                for username in batch:
+                    if not outcome[username][0]:
+                        outcome[username] = (False, str(result) or type(result).__name__)
+                continue
+            for username, value in result.items():
+                if isinstance(value, ApprovalError):
+                    outcome[username] = (False, value.reason.replace("_", " "))
+                else:
+                    EXPIRY_QUEUE.add(username, value[0], router)
+                    renewed.append((username, None, package, value[0]))
+                    outcome[username] = (True, f"until `{value[1]}`")
+        if renewed:
+            await EXPIRY_QUEUE.save()
+            await record_sales("renewed", renewed)
+        log.info(f"Renewed {len(renewed)} of {len(usernames)} users with {package}")
+        await update.message.reply_text(
+            format_bulk_summary(f"🔄 Renew `{package}`", outcome), parse_mode='Markdown'
+        )
+    except Exception as e:
+        handler_outcome("error")
+        error_msg = f"❌ Error renewing users: {str(e)}"
+        log.error(error_msg)
+        await update.message.reply_text(error_msg)
+
+async def package_refresher(app):
+    """Keep PACKAGES within its TTL of the routers' profile lists."""
+    log_context(handler="package_refresher")
+    while True:
+        try:
+            await PACKAGES.refresh()
+        except Exception as e:
+            log.error(f"❌ Package catalog refresh failed: {str(e)}")
+        await asyncio.sleep(min(PACKAGES_TTL, 60))
+
+def format_price(price):
+    return "no price set" if price is None else f"৳{price:g}"
+
+@logged
+async def packages_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await PACKAGES.refresh(force=True)
+        lines = [
+            f"• `{name}` {entry['label']}: {entry['days']:g} day(s), {format_price(entry['price'])}"
+            for name, entry in PACKAGES.packages.items()
+        ]
+        msg = "*📦 Packages:*\n" + ("\n".join(lines) if lines else "No hotspot profiles with a known duration.")
+        await update.message.reply_text(msg, parse_mode='Markdown')
+    except Exception as e:
+        handler_outcome("error")
+        error_msg = f"❌ Error loading packages: {str(e)}"
+        log.error(error_msg)
+        await update.message.reply_text(error_msg)
+
+@logged
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "⚙️ *Commands:*\n"
+        "/activeusers [name|uptime|traffic] [prefix|ip/cidr] - List connected users\n"
+        "/usage <username> [period] - Show live traffic, or totals over e.g. 24h/7d\n"
+        "/top [period] - Heaviest users over a period (default 24h)\n"
+        "/pending [username|bkash|ip] - List or look up payment requests\n"
+        "/approve <username...> - Approve several pending requests\n"
+        "/approveall - Approve every pending request\n"
+        "/rejectall - Reject every pending request\n"
+        "/renew <username...> <package> - Extend users by a package\n"
+        "/packages - Refresh and list the package catalog\n"
+        "/report [day|week|month] - Sales, revenue and customers for the period\n"
+        "/customer <bkash> - Purchase history of one bKash number\n"
+        "/poolstats - Show MikroTik connection pool statistics\n"
+        "/stats - Handler, router, Telegram and storage latency\n"
+        "/migrateexpiry - Move router expiry schedulers into the bot\n"
+        "/reconcile - Clean up orphaned pending users, scripts and requests now\n"
+        "/help - Show this message",
+        parse_mode='Markdown'
+    )
+
+ACTIVE_PROPLIST = ".id,user,address,mac-address,uptime,bytes-in,bytes-out"
+
+def fetch_active_sessions(api):
+    """Only the columns the bot uses; the rest of each row never leaves the router."""
+    return api.get_resource('/ip/hotspot/active').call("print", {".proplist": ACTIVE_PROPLIST})
+
+class ActiveSessionIndex:
+    """In-memory index of one router's /ip/hotspot/active keyed by .id, user, IP and MAC.
+
+    Every session is tagged with the router it was read from. Each poll is
+    diffed against the previous one by .id and only changed sessions touch
+    the secondary indexes. Lookups never go to the router; ``ensure_fresh``
+    refreshes first only if the snapshot is older than the caller's
+    freshness bound, and concurrent callers share one refresh.
+    """
+
+    def __init__(self, router):
+        self.router = router
+        self.by_id = {}
+        self.by_user = {}  # user -> {id: session}; a user may have several sessions
+        self.by_ip = {}
+        self.by_mac = {}
+        self.updated_at = None  # monotonic time of the last successful poll
+        self._refresh_lock = asyncio.Lock()
+
+    def _unindex(self, session):
+        sessions = self.by_user.get(session.get("user"))
+        if sessions is not None:
+            sessions.pop(session["id"], None)
+            if not sessions:
+                del self.by_user[session.get("user")]
+        if self.by_ip.get(session.get("address")) is session:
+            del self.by_ip[session["address"]]
+        if self.by_mac.get(session.get("mac-address")) is session:
+            del self.by_mac[session["mac-address"]]
+
+    def _index(self, session):
+        self.by_user.setdefault(session.get("user"), {})[session["id"]] = session
+        if session.get("address"):
+            self.by_ip[session["address"]] = session
+        if session.get("mac-address"):
+            self.by_mac[session["mac-address"]] = session
+
+    def apply_snapshot(self, rows):
+        """Diff a full poll against the index; returns (added, removed, changed)."""
+        seen = set()
+        added = changed = 0
+        for row in rows:
+            session_id = row.get("id")
+            if not session_id:
+                continue
+            seen.add(session_id)
+            row["router"] = self.router
+            current = self.by_id.get(session_id)
+            if current is None:
+                added += 1
+            elif current == row:
+                continue
+            else:
+                changed += 1
+                self._unindex(current)
+            self.by_id[session_id] = row
+            self._index(row)
+        removed = [session_id for session_id in self.by_id if session_id not in seen]
+        for session_id in removed:
+            self._unindex(self.by_id.pop(session_id))
+        self.updated_at = time.monotonic()
+        return added, len(removed), changed
+
+    def age(self):
+        return float("inf") if self.updated_at is None else time.monotonic() - self.updated_at
+
+    async def refresh(self):
+        async with self._refresh_lock:
+            rows = await run_router(fetch_active_sessions, router=self.router)
+            return self.apply_snapshot(rows)
+
+    async def ensure_fresh(self, max_age):
+        if self.age() <= max_age:
+            return
+        async with self._refresh_lock:
+            # Another caller may have refreshed while we waited for the lock
+            if self.age() <= max_age:
+                return
+            rows = await run_router(fetch_active_sessions, router=self.router)
+            self.apply_snapshot(rows)
+
+    def sessions_for_user(self, username):
+        return list(self.by_user.get(username, {}).values())
+
+    def all(self):
+        return list(self.by_id.values())
+
+    def __len__(self):
+        return len(self.by_id)
+
+ACTIVE_SESSIONS = {name: ActiveSessionIndex(name) for name in ROUTERS}
+METRICS.gauge("active_sessions", lambda: {(("router", name),): len(index) for name, index in ACTIVE_SESSIONS.items()})
+
+async def ensure_sessions_fresh(max_age):
+    """Refresh every router's index that is older than ``max_age``, concurrently.
+
+    A router that fails keeps its last snapshot; the fan_out() result is
+    returned so callers can mention it.
+    """
+    return await fan_out(lambda name: ACTIVE_SESSIONS[name].ensure_fresh(max_age))
+
+def all_sessions():
+    return [session for index in ACTIVE_SESSIONS.values() for session in index.all()]
+
+def sessions_for_user(username):
+    return [session for index in ACTIVE_SESSIONS.values() for session in index.sessions_for_user(username)]
+
+async def session_poller(app):
+    """Keep ACTIVE_SESSIONS current between commands."""
+    log_context(handler="session_poller")
+    while True:
+        results = await fan_out(lambda name: ACTIVE_SESSIONS[name].refresh())
+        for name, result in results.items():
+            if isinstance(result, BaseException):
+                log.warning(f"Active session poll failed on {name}: {str(result) or type(result).__name__}")
+                ADMIN_DIGEST.add(f"⚠️ Active session poll failed on {name}: {str(result) or type(result).__name__}")
+                continue
+            added, removed, changed = result
+            if added or removed:
+                log.debug(f"Active sessions on {name}: +{added} -{removed} ~{changed}, {len(ACTIVE_SESSIONS[name])} total")
+        await asyncio.sleep(SESSION_POLL_INTERVAL)
+
+HISTORY_DTYPE = np.dtype([("ts", "<u4"), ("user", "<u4"), ("rx", "<u8"), ("tx", "<u8")])
+
+PERIOD_UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+def parse_period(text, default=86400):
+    """Parse "90m", "6h", "7d" or "2w" into seconds."""
+    if not text:
+        return default
+    unit = PERIOD_UNITS.get(text[-1].lower())
+    if unit is None or not text[:-1].isdigit() or int(text[:-1]) == 0:
+        raise ValueError(f"Invalid period '{text}' (use e.g. 90m, 6h, 7d, 2w)")
+    return int(text[:-1]) * unit
+
+def format_bytes(count):
+    for unit in ("B", "KB", "MB", "GB"):
+        if count < 1024:
+            return f"{count:.1f} {unit}" if unit != "B" else f"{int(count)} B"
+        count /= 1024
+    return f"{count:.2f} TB"
+
+class UsageCollector:
+    """Per-user traffic time series built from periodic active-table samples.
+
+    Recent samples live in ring buffers: one column per sample slot and one
+    row per user, holding the bytes-in/out delta of that interval. Every
+    non-zero delta is also appended to a fixed-width binary history file
+    (HISTORY_DTYPE records, in time order) that is memory-mapped for
+    periods longer than the ring. Totals are computed with numpy column
+    sums and bincount, not per-user Python loops.
+
+    Deltas are taken per router and session .id. A counter lower than the
+    previous sample (reset) or a new session counts from zero, and sessions
+    already running when the bot starts are only used as a baseline.
+    """
+
+    def __init__(self, history_file, users_file, slots, interval):
+        self.history_file = history_file
+        self.users_file = users_file
+        self.slots = slots
+        self.interval = interval
+        self.user_rows = {}  # username -> row in the ring buffers / history user id
+        self.usernames = []
+        self.ring_ts = np.zeros(slots, dtype=np.uint32)
+        self.ring_rx = np.zeros((64, slots), dtype=np.uint64)
+        self.ring_tx = np.zeros((64, slots), dtype=np.uint64)
+        self.slot = -1
+        self.last_counters = None  # "router:session id" -> (rx, tx); None until the baseline sample
+
+    def load(self):
+        if os.path.exists(self.users_file):
+            with open(self.users_file, "r") as f:
+                self.usernames = json.load(f)
+            self.user_rows = {name: row for row, name in enumerate(self.usernames)}
+            self._grow(len(self.usernames))
+
+    def _grow(self, rows):
+        capacity = self.ring_rx.shape[0]
+        if rows <= capacity:
+            return
+        while capacity < rows:
+            capacity *= 2
+        extra = capacity - self.ring_rx.shape[0]
+        self.ring_rx = np.vstack([self.ring_rx, np.zeros((extra, self.slots), dtype=np.uint64)])
+        self.ring_tx = np.vstack([self.ring_tx, np.zeros((extra, self.slots), dtype=np.uint64)])
+
+    def _row_for(self, username):
+        row = self.user_rows.get(username)
+        if row is None:
+            row = self.user_rows[username] = len(self.usernames)
+            self.usernames.append(username)
+            self._grow(len(self.usernames))
+        return row
+
+    def sample(self, sessions, now=None):
+        """Record one sample; returns the HISTORY_DTYPE records to persist."""
+        now = int(now or time.time())
+        previous = self.last_counters
+        # .id values are only unique per router
+        keys = [f"{s.get('router')}:{s.get('id')}" for s in sessions]
+        self.last_counters = {
+            key: (int(s.get("bytes-in", 0)), int(s.get("bytes-out", 0)))
+            for key, s in zip(keys, sessions) if s.get("id")
+        }
+        if previous is None:
+            return np.zeros(0, dtype=HISTORY_DTYPE)
+
+        count = len(sessions)
+        known_users = len(self.usernames)
+        rows = np.fromiter((self._row_for(s.get("user") or "") for s in sessions), dtype=np.uint32, count=count)
+        if len(self.usernames) != known_users:
+            self.save_users()
+        current = np.array([self.last_counters.get(key, (0, 0)) for key in keys], dtype=np.uint64).reshape(count, 2)
+        before = np.array([previous.get(key, (0, 0)) for key in keys], dtype=np.uint64).reshape(count, 2)
+        # A counter that went down was reset (reconnect/reset-counters): count from zero
+        delta = np.where(current >= before, current - before, current)
+
+        self.slot = (self.slot + 1) % self.slots
+        self.ring_ts[self.slot] = now
+        self.ring_rx[:, self.slot] = 0
+        self.ring_tx[:, self.slot] = 0
+        np.add.at(self.ring_rx[:, self.slot], rows, delta[:, 0])
+        np.add.at(self.ring_tx[:, self.slot], rows, delta[:, 1])
+
+        touched = np.unique(rows)
+        records = np.zeros(len(touched), dtype=HISTORY_DTYPE)
+        records["ts"] = now
+        records["user"] = touched
+        records["rx"] = self.ring_rx[touched, self.slot]
+        records["tx"] = self.ring_tx[touched, self.slot]
+        return records[(records["rx"] > 0) | (records["tx"] > 0)]
+
+    @METRICS.timed("storage_seconds", op="usage_append")
+    def append_history(self, records):
+        if len(records):
+            with open(self.history_file, "ab") as f:
+                f.write(records.tobytes())
+
+    def save_users(self):
+        tmp_path = f"{self.users_file}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.usernames, f)
+        os.replace(tmp_path, self.users_file)
+
+    def ring_span(self):
+        filled = self.ring_ts[self.ring_ts > 0]
+        return (int(time.time()) - int(filled.min())) if len(filled) else 0
+
+    def _history(self):
+        if not os.path.exists(self.history_file) or os.path.getsize(self.history_file) < HISTORY_DTYPE.itemsize:
+            return np.zeros(0, dtype=HISTORY_DTYPE)
+        usable = os.path.getsize(self.history_file) // HISTORY_DTYPE.itemsize
+        return np.memmap(self.history_file, dtype=HISTORY_DTYPE, mode="r", shape=(usable,))
+
+    def totals(self, period, now=None):
+        """Per-user (rx, tx) byte totals over the last ``period`` seconds."""
+        now = int(now or time.time())
+        since = now - period
+        users = len(self.usernames)
+        if period <= self.ring_span() + self.interval:
+            mask = self.ring_ts > since
+            rx = self.ring_rx[:users, mask].sum(axis=1)
+            tx = self.ring_tx[:users, mask].sum(axis=1)
+            return rx, tx
+        history = self._history()
+        start = np.searchsorted(history["ts"], since, side="right")
+        window = history[start:]
+        rx = np.bincount(window["user"], weights=window["rx"], minlength=users)[:users]
+        tx = np.bincount(window["user"], weights=window["tx"], minlength=users)[:users]
+        return rx.astype(np.uint64), tx.astype(np.uint64)
+
+    def top(self, period, limit=10):
+        rx, tx = self.totals(period)
+        total = rx + tx
+        order = np.argsort(total)[::-1][:limit]
+        return [(self.usernames[i], int(rx[i]), int(tx[i])) for i in order if total[i] > 0]
+
+    def user_totals(self, username, period):
+        row = self.user_rows.get(username)
+        if row is None:
+            return None
+        rx, tx = self.totals(period)
+        return int(rx[row]), int(tx[row])
+
+    def prune(self, retention):
+        """Drop history older than ``retention`` seconds (rewrites the file)."""
+        history = self._history()
+        if not len(history):
+            return 0
+        start = np.searchsorted(history["ts"], int(time.time()) - retention, side="left")
+        if start == 0:
+            return 0
+        tmp_path = f"{self.history_file}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(np.ascontiguousarray(history[start:]).tobytes())
+        del history
+        os.replace(tmp_path, self.history_file)
+        return int(start)
+
+USAGE_COLLECTOR = UsageCollector(
+    USAGE_HISTORY_FILE,
+    USAGE_USERS_FILE,
+    slots=max(int(USAGE_RING_SPAN // USAGE_SAMPLE_INTERVAL), 1),
+    interval=USAGE_SAMPLE_INTERVAL,
+)
+
+async def usage_sampler(app):
+    """Sample the active table every usage_history.sample_interval seconds."""
+    log_context(handler="usage_sampler")
+    USAGE_COLLECTOR.load()
+    last_prune = 0
+    while True:
+        try:
+            await ensure_sessions_fresh(USAGE_SAMPLE_INTERVAL / 2)
+            records = USAGE_COLLECTOR.sample(all_sessions())
+            await asyncio.to_thread(USAGE_COLLECTOR.append_history, records)
+            if time.time() - last_prune > 86400:
+                pruned = await asyncio.to_thread(USAGE_COLLECTOR.prune, USAGE_RETENTION)
+                last_prune = time.time()
+                if pruned:
+                    log.info(f"Pruned {pruned} usage history records older than {USAGE_RETENTION // 86400} days")
+        except Exception as e:
+            log.warning(f"Usage sample failed: {str(e)}")
+        await asyncio.sleep(USAGE_SAMPLE_INTERVAL)
+
+@logged
+async def top_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        period_text = context.args[0] if context.args else "24h"
+        period = parse_period(period_text)
+        top = await asyncio.to_thread(USAGE_COLLECTOR.top, period, 10)
+        if not top:
+            await update.message.reply_text(f"No traffic recorded in the last {period_text}.")
+            return
+        msg = f"*🏆 Top users ({period_text}):*\n"
+        for rank, (username, rx, tx) in enumerate(top, 1):
+            rate = (rx + tx) * 8 / period / 1000
+            msg += f"{rank}. `{username}` ⬇️ {format_bytes(rx)} ⬆️ {format_bytes(tx)} ({rate:.1f} kbit/s avg)\n"
+        await update.message.reply_text(msg, parse_mode='Markdown')
+    except ValueError as e:
+        handler_outcome("invalid_args")
+        await update.message.reply_text(f"❌ {str(e)}")
+    except Exception as e:
+        handler_outcome("error")
+        error_msg = f"❌ Error: {str(e)}"
+        log.error(error_msg)
+        await update.message.reply_text(error_msg)
+
+LEDGER_DTYPE = np.dtype([
+    ("ts", "<u4"), ("kind", "u1"), ("package", "<u2"), ("bkash", "<u4"),
+    ("user", "<u4"), ("amount", "<u4"), ("expiry", "<u4"),
+])
+
+class SalesLedger:
+    """Append-only record of approvals, rejections, renewals and expiries.
+
+    Records are fixed-width LEDGER_DTYPE rows appended in time order to a
+    binary file that is memory-mapped for queries, so a date range is two
+    binary searches on the ``ts`` column and per-package totals are a
+    bincount over that slice. bKash numbers, packages and usernames are
+    stored as ids into an append-only names file (one JSON pair per line).
+
+    The bKash index is a stable argsort of the ``bkash`` column saved as a
+    compacted snapshot; records appended since then are kept in a small
+    in-memory tail and folded into a new snapshot every ``compact_every``
+    records, so startup never rescans years of history.
+    """
+
+    KINDS = ("approved", "rejected", "expired", "renewed")
+    SALES = (0, 3)  # kinds that earn revenue: approved, renewed
+    NAME_FIELDS = ("bkash", "package", "user")
+
+    def __init__(self, ledger_file, names_file, index_file, compact_every):
+        self.ledger_file = ledger_file
+        self.names_file = names_file
+        self.index_file = index_file
+        self.compact_every = compact_every
+        self.names = {field: [] for field in self.NAME_FIELDS}
+        self.ids = {field: {} for field in self.NAME_FIELDS}
+        self.count = 0
+        self.last_ts = 0
+        self.index_count = 0  # records covered by the snapshot
+        self.bkash_keys = np.zeros(0, dtype=np.uint32)   # sorted bkash ids
+        self.bkash_order = np.zeros(0, dtype=np.uint32)  # record positions in that order
+        self.tail = collections.defaultdict(list)  # bkash id -> positions appended after the snapshot
+        self.last_sale = {}  # user id -> position of the user's latest approval or renewal
+        self._lock = threading.Lock()
+
+    def _records(self):
+        if not os.path.exists(self.ledger_file) or os.path.getsize(self.ledger_file) < LEDGER_DTYPE.itemsize:
+            return np.zeros(0, dtype=LEDGER_DTYPE)
+        usable = os.path.getsize(self.ledger_file) // LEDGER_DTYPE.itemsize
+        return np.memmap(self.ledger_file, dtype=LEDGER_DTYPE, mode="r", shape=(usable,))
+
+    def load(self):
+        """Read the names, then the snapshot, then index the tail after it.
+        Returns the number of records."""
+        if os.path.exists(self.names_file):
+            with open(self.names_file) as f:
+                for line in f:
+                    if line.strip():
+                        field, name = json.loads(line)
+                        self.ids[field][name] = len(self.names[field])
+                        self.names[field].append(name)
+        records = self._records()
+        self.count = len(records)
+        self.last_ts = int(records["ts"][-1]) if self.count else 0
+        try:
+            with np.load(self.index_file) as snapshot:
+                if int(snapshot["count"]) <= self.count:
+                    self.index_count = int(snapshot["count"])
+                    self.bkash_keys = snapshot["keys"]
+                    self.bkash_order = snapshot["order"]
+        except (OSError, KeyError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                log.warning(f"Rebuilding unreadable sales index {self.index_file}: {str(e)}")
+        if self.count - self.index_count > self.compact_every:
+            self._compact(records)
+        for position in range(self.index_count, self.count):
+            self.tail[int(records["bkash"][position])].append(position)
+        sales = np.flatnonzero(np.isin(records["kind"], self.SALES))
+        if len(sales):
+            # The last occurrence of each user among sales, found from the reversed list
+            users, first_from_end = np.unique(records["user"][sales][::-1], return_index=True)
+            positions = sales[::-1][first_from_end]
+            self.last_sale = dict(zip(users.tolist(), positions.tolist()))
+        return self.count
+
+    def _name_id(self, field, name, new_names):
+        name_id = self.ids[field].get(name)
+        if name_id is None:
+            name_id = self.ids[field][name] = len(self.names[field])
+            self.names[field].append(name)
+            new_names.append(json.dumps([field, name], ensure_ascii=False))
+        return name_id
+
+    @METRICS.timed("storage_seconds", op="ledger_append")
+    def append(self, kind, entries, now=None):
+        """Append ``(username, bkash, package, expiry)`` entries as ``kind``.
+
+        A missing bKash number or package is taken from the user's last
+        sale (renewals and expiries only know the username). ``expiry`` is
+        a datetime or None. Returns the number of records written.
+        """
+        kind_id = self.KINDS.index(kind)
+        with self._lock:
+            ts = max(int(now or time.time()), self.last_ts)  # keep ts sorted if the clock steps back
+            records = np.zeros(len(entries), dtype=LEDGER_DTYPE)
+            new_names = []
+            for i, (username, bkash, package, expiry) in enumerate(entries):
+                user_id = self._name_id("user", username, new_names)
+                last = self.last_sale.get(user_id)
+                if (bkash is None or package is None) and last is not None:
+                    previous = self._records()[last]
+                    bkash = self.names["bkash"][previous["bkash"]] if bkash is None else bkash
+                    package = self.names["package"][previous["package"]] if package is None else package
+                package = package or ""
+                price = PACKAGES.price(package) if kind_id in self.SALES else None
+                records[i] = (
+                    ts, kind_id, self._name_id("package", package, new_names),
+                    self._name_id("bkash", bkash or "", new_names), user_id,
+                    round(price or 0), int(expiry.timestamp()) if expiry else 0
+                )
+            # Names first: a crash in between leaves an unused name, never a dangling id
+            if new_names:
+                with open(self.names_file, "a") as f:
+                    f.write("".join(line + "\n" for line in new_names))
+            with open(self.ledger_file, "ab") as f:
+                f.write(records.tobytes())
+            for offset, record in enumerate(records):
+                position = self.count + offset
+                self.tail[int(record["bkash"])].append(position)
+                if kind_id in self.SALES:
+                    self.last_sale[int(record["user"])] = position
+            self.count += len(records)
+            self.last_ts = ts
+            if self.count - self.index_count > self.compact_every:
+                self._compact(self._records())
+        return len(records)
+
+    @METRICS.timed("storage_seconds", op="ledger_compact")
+    def _compact(self, records):
+        """Fold the tail into a new bKash index snapshot; called with the lock held or from load()."""
+        count = min(len(records), self.count)
+        order = np.argsort(records["bkash"][:count], kind="stable").astype(np.uint32)
+        keys = np.asarray(records["bkash"][:count])[order]
+        tmp_path = f"{self.index_file}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, count=count, keys=keys, order=order)
+        os.replace(tmp_path, self.index_file)
+        self.bkash_keys, self.bkash_order, self.index_count = keys, order, count
+        self.tail = collections.defaultdict(list)
+        log.info(f"Compacted sales ledger index at {count} records")
+
+    def _first_positions(self, bkash_ids):
+        """Position of each bKash number's first record; the argsort is
+        stable, so that is the first entry of its run in the snapshot."""
+        keys = self.bkash_keys
+        starts = np.searchsorted(keys, bkash_ids)
+        firsts = np.full(len(bkash_ids), -1, dtype=np.int64)
+        in_snapshot = starts < len(keys)
+        in_snapshot[in_snapshot] = keys[starts[in_snapshot]] == bkash_ids[in_snapshot]
+        firsts[in_snapshot] = self.bkash_order[starts[in_snapshot]]
+        for i in np.flatnonzero(~in_snapshot):
+            tail = self.tail.get(int(bkash_ids[i]))
+            firsts[i] = tail[0] if tail else -1
+        return firsts
+
+    @METRICS.timed("storage_seconds", op="ledger_report")
+    def summary(self, since, until=None):
+        """Counts, revenue and customers for records in ``[since, until)``."""
+        with self._lock:
+            return self._summary(since, until)
+
+    def _summary(self, since, until):
+        records = self._records()[:self.count]
+        ts = records["ts"]
+        start = int(np.searchsorted(ts, since, side="left"))
+        end = len(records) if until is None else int(np.searchsorted(ts, until, side="left"))
+        window = np.asarray(records[start:end])
+        kinds = np.bincount(window["kind"], minlength=len(self.KINDS))
+        sales = window[np.isin(window["kind"], self.SALES)]
+        packages = len(self.names["package"])
+        sold = np.bincount(sales["package"], minlength=packages)
+        revenue = np.bincount(sales["package"], weights=sales["amount"], minlength=packages)
+        customers = np.unique(sales["bkash"])
+        new_customers = int((self._first_positions(customers) >= start).sum()) if len(customers) else 0
+        return {
+            "kinds": dict(zip(self.KINDS, kinds.tolist())),
+            "revenue": int(revenue.sum()),
+            "packages": {
+                self.names["package"][i]: (int(sold[i]), int(revenue[i])) for i in np.flatnonzero(sold)
+            },
+            "customers": len(customers),
+            "new_customers": new_customers,
+        }
+
+    @METRICS.timed("storage_seconds", op="ledger_customer")
+    def customer(self, bkash):
+        """Every record for one bKash number, oldest first, as dicts."""
+        bkash_id = self.ids["bkash"].get(bkash)
+        if bkash_id is None:
+            return []
+        with self._lock:
+            records = self._records()[:self.count]
+            start = np.searchsorted(self.bkash_keys, bkash_id, side="left")
+            end = np.searchsorted(self.bkash_keys, bkash_id, side="right")
+            positions = np.concatenate([
+                self.bkash_order[start:end], np.array(self.tail.get(bkash_id, ()), dtype=np.uint32)
+            ])
+        return [
+            {
+                "ts": int(record["ts"]), "kind": self.KINDS[record["kind"]],
+                "package": self.names["package"][record["package"]], "user": self.names["user"][record["user"]],
+                "amount": int(record["amount"]), "expiry": int(record["expiry"]),
+            }
+            for record in np.asarray(records[np.sort(positions)])
+        ]
+
+    def __len__(self):
+        return self.count
+
+LEDGER = SalesLedger(LEDGER_FILE, LEDGER_NAMES_FILE, LEDGER_INDEX_FILE, LEDGER_COMPACT_EVERY)
+
+async def record_sales(kind, entries):
+    """Append to LEDGER off the event loop. A ledger failure is logged and
+    never fails the approval or rejection it records."""
+    if not entries:
+        return
+    try:
+        await asyncio.to_thread(LEDGER.append, kind, entries)
+    except Exception as e:
+        log.error(f"❌ Could not record {len(entries)} {kind} entries in the sales ledger: {str(e)}")
+
+def report_start(period, now=None):
+    """Start of the current calendar day, week (from Monday) or month."""
+    now = now or datetime.datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "day":
+        return today
+    if period == "week":
+        return today - datetime.timedelta(days=today.weekday())
+    if period == "month":
+        return today.replace(day=1)
+    raise ValueError(f"Invalid period '{period}' (use day, week or month)")
+
+@logged
+async def sales_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    period = (context.args[0] if context.args else "day").lower()
+    try:
+        since = report_start(period)
+    except ValueError as e:
+        handler_outcome("invalid_args")
+        await update.message.reply_text(f"❌ {str(e)}")
+        return
+    try:
+        summary = await asyncio.to_thread(LEDGER.summary, int(since.timestamp()))
+        kinds = summary["kinds"]
+        title = {"day": "today", "week": "this week", "month": "this month"}[period]
+        msg = (
+            f"*📊 Sales {title}* (since {since.strftime('%Y-%m-%d')})\n"
+            f"💰 Revenue: ৳{summary['revenue']:,} from {kinds['approved'] + kinds['renewed']} sale(s) "
+            f"({kinds['approved']} new, {kinds['renewed']} renewals)\n"
+            f"👥 Customers: {summary['customers']} ({summary['new_customers']} first-time)\n"
+            f"❌ Rejected: {kinds['rejected']} | ⌛ Expired: {kinds['expired']}"
+        )
+        if summary["packages"]:
+            msg += "\n\n*By package:*\n" + "\n".join(
+                f"• `{package}`: {sold} sold, ৳{revenue:,}"
+                for package, (sold, revenue) in sorted(summary["packages"].items(), key=lambda item: -item[1][1])
+            )
+        await update.message.reply_text(msg, parse_mode='Markdown')
+    except Exception as e:
+        handler_outcome("error")
+        error_msg = f"❌ Error building report: {str(e)}"
+        log.error(error_msg)
+        await update.message.reply_text(error_msg)
+
+@logged
+async def customer_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        handler_outcome("invalid_args")
+        await update.message.reply_text("Usage: /customer <bkash number>")
+        return
+    bkash = context.args[0]
+    try:
+        history = await asyncio.to_thread(LEDGER.customer, bkash)
+        if not history:
+            await update.message.reply_text(f"No sales recorded for bKash `{bkash}`.", parse_mode='Markdown')
+            return
+        sales = [entry for entry in history if entry["kind"] in ("approved", "renewed")]
+        day = lambda ts: datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d")
+        msg = f"*👤 Customer* `{bkash}`\nPurchases: {len(sales)}, spent ৳{sum(entry['amount'] for entry in sales):,}"
+        if sales:
+            msg += f"\nFirst: {day(sales[0]['ts'])} | Last: {day(sales[-1]['ts'])}"
+        lines = []
+        for entry in reversed(history[-15:]):
+            when = datetime.datetime.fromtimestamp(entry["ts"]).strftime("%Y-%m-%d %H:%M")
+            line = f"• {when} {entry['kind']} `{entry['package']}` `{entry['user']}`"
+            if entry["expiry"] and entry["kind"] in ("approved", "renewed"):
+                line += f" until {datetime.datetime.fromtimestamp(entry['expiry']).strftime('%Y-%m-%d %H:%M')}"
+            lines.append(line)
+        msg += "\n\n*Recent:*\n" + "\n".join(lines)
+        await update.message.reply_text(msg, parse_mode='Markdown')
+    except Exception as e:
+        handler_outcome("error")
+        error_msg = f"❌ Error loading customer history: {str(e)}"
+        log.error(error_msg)
+        await update.message.reply_text(error_msg)
+
+UPTIME_UNITS = {"w": 604800, "d": 86400, "h": 3600, "m": 60, "s": 1}
+
+def parse_uptime(text):
+    """RouterOS duration ("1w2d3h4m5s" or "03:04:05") to seconds."""
+    if not text:
+        return 0
+    if ":" in text:
+        days, _, clock = text.rpartition("d")
+        h, m, sec = (int(part) for part in clock.split(":"))
+        return (int(days) * 86400 if days else 0) + h * 3600 + m * 60 + sec
+    total, number = 0, ""
+    for char in text:
+        if char.isdigit():
+            number += char
+        elif char in UPTIME_UNITS and number:
+            total += int(number) * UPTIME_UNITS[char]
+            number = ""
+    return total
+
+class ActiveUserSnapshots:
+    """Recently built /activeusers listings, so next/prev reuse the same
+    sorted rows instead of querying the router again. Bounded LRU + TTL."""
+
+    def __init__(self, ttl, max_entries=50):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._snapshots = collections.OrderedDict()
+        self._ids = itertools.count(1)
+
+    def put(self, title, rows):
+        snapshot_id = str(next(self._ids))
+        self._snapshots[snapshot_id] = (time.monotonic(), title, rows)
+        while len(self._snapshots) > self.max_entries:
+            self._snapshots.popitem(last=False)
+        return snapshot_id
+
+    def get(self, snapshot_id):
+        entry = self._snapshots.get(snapshot_id)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self._snapshots.pop(snapshot_id, None)
+            return None
+        self._snapshots.move_to_end(snapshot_id)
+        return entry[1], entry[2]
+
+ACTIVE_SNAPSHOTS = ActiveUserSnapshots(ACTIVE_PAGE_TTL)
+
+ACTIVE_SORT_KEYS = {
+    "uptime": lambda row: -row[2],
+    "traffic": lambda row: -row[3],
+    "name": lambda row: row[0],
+}
+
+def build_active_rows(sessions, sort="name", prefix=None):
+    """Filter sessions by username prefix, IP prefix or CIDR and sort them.
+
+    Rows are (user, ip, uptime_seconds, traffic_bytes, uptime_text, router) tuples.
+    """
+    network = None
+    if prefix and "/" in prefix:
+        network = ipaddress.ip_network(prefix, strict=False)
+    rows = []
+    for u in sessions:
+        user = u.get('user') or ""
+        ip = u.get('address') or ""
+        if network is not None:
+            try:
+                if ipaddress.ip_address(ip) not in network:
+                    continue
+            except ValueError:
+                continue
+        elif prefix and not (user.startswith(prefix) or ip.startswith(prefix)):
+            continue
+        traffic = int(u.get('bytes-in', 0)) + int(u.get('bytes-out', 0))
+        rows.append((user, ip, parse_uptime(u.get('uptime')), traffic, u.get('uptime') or "", u.get('router') or ""))
+    rows.sort(key=ACTIVE_SORT_KEYS[sort])
+    return rows
+
+def render_active_page(snapshot_id, title, rows, page):
+    """Message text and next/prev keyboard for one page of a snapshot."""
+    pages = max((len(rows) + ACTIVE_PAGE_SIZE - 1) // ACTIVE_PAGE_SIZE, 1)
+    page = min(max(page, 0), pages - 1)
+    start = page * ACTIVE_PAGE_SIZE
+    msg = f"*📶 Active Users*{title} ({len(rows)}, page {page + 1}/{pages}):\n"
+    for user, ip, _, traffic, uptime, router in rows[start:start + ACTIVE_PAGE_SIZE]:
+        site = f" @{router}" if len(ROUTERS) > 1 else ""
+        line = f"• `{user}` - IP: {ip}{site}, Uptime: {uptime}, {format_bytes(traffic)}\n"
+        if len(msg) + len(line) > TELEGRAM_MESSAGE_LIMIT:
+            break
+        msg += line
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ Prev", callback_data=f"active|{snapshot_id}|{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("Next ▶️", callback_data=f"active|{snapshot_id}|{page + 1}"))
+    return msg, InlineKeyboardMarkup([buttons]) if buttons else None
+
+@logged
+async def active_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /activeusers [name|uptime|traffic] [username prefix | IP prefix | CIDR]
+    args = list(context.args or [])
+    sort = "name"
+    if args and args[0].lower() in ACTIVE_SORT_KEYS:
+        sort = args.pop(0).lower()
+    prefix = args[0] if args else None
+
+    try:
+        results = await ensure_sessions_fresh(SESSION_MAX_AGE)
+        rows = build_active_rows(all_sessions(), sort, prefix)
+        warnings = fan_out_warnings(results)
+
+        if not rows:
+            msg = "No active users." if not prefix else f"No active users matching {prefix}."
+            await update.message.reply_text(msg + warnings)
+            return
+
+        title = (f" matching `{prefix}`" if prefix else "") + f" by {sort}"
+        snapshot_id = ACTIVE_SNAPSHOTS.put(title, rows)
+        msg, keyboard = render_active_page(snapshot_id, title, rows, 0)
+        if warnings and len(msg) + len(warnings) <= TELEGRAM_MESSAGE_LIMIT:
+            msg += warnings
+        await update.message.reply_text(msg, parse_mode='Markdown', reply_markup=keyboard)
+    except ValueError as e:
+        handler_outcome("invalid_args")
+        await update.message.reply_text(f"❌ Invalid filter: {str(e)}")
+    except Exception as e:
+        handler_outcome("error")
+        error_msg = f"❌ Error: {str(e)}"
+        log.error(error_msg)
+        await update.message.reply_text(error_msg)
+
+@logged
+async def active_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    # Expected format: active|snapshot_id|page
+    _, snapshot_id, page = query.data.split('|')
+    snapshot = ACTIVE_SNAPSHOTS.get(snapshot_id)
+    if snapshot is None:
+        handler_outcome("expired")
+        await query.answer("This list has expired, run /activeusers again.", show_alert=True)
+        return
+    await query.answer()
+    title, rows = snapshot
+    msg, keyboard = render_active_page(snapshot_id, title, rows, int(page))
+    await query.edit_message_text(msg, parse_mode='Markdown', reply_markup=keyboard)
+
+@logged
+async def usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        handler_outcome("invalid_args")
+        await update.message.reply_text("Usage: /usage <username> [period]")
+        return
+
+    username = context.args[0]
+    log_context(username=username)
+
+    try:
+        if len(context.args) > 1:
+            # Historical totals: /usage <username> <period>
+            period_text = context.args[1]
+            period = parse_period(period_text)
+            totals = await asyncio.to_thread(USAGE_COLLECTOR.user_totals, username, period)
+            if totals is None:
+                await update.message.reply_text(f"No traffic recorded for `{username}`.", parse_mode='Markdown')
+                return
+            rx, tx = totals
+            rate = (rx + tx) * 8 / period / 1000
+            await update.message.reply_text(
+                f"📊 Usage for `{username}` (last {period_text}):\n"
+                f"⬆️ Upload: {format_bytes(tx)}\n"
+                f"⬇️ Download: {format_bytes(rx)}\n"
+                f"📈 Average: {rate:.1f} kbit/s",
+                parse_mode='Markdown'
+            )
+            return
+
+        results = await ensure_sessions_fresh(SESSION_MAX_AGE)
+        sessions = sessions_for_user(username)
+        warnings = fan_out_warnings(results)
+        if not sessions:
+            await update.message.reply_text(f"User `{username}` is not active.{warnings}", parse_mode='Markdown')
+            return
+
+        tx = sum(int(u.get('bytes-out', 0)) for u in sessions)
+        rx = sum(int(u.get('bytes-in', 0)) for u in sessions)
+
+        tx_mb = tx / (1024 * 1024)
+        rx_mb = rx / (1024 * 1024)
+
+        await update.message.reply_text(
+            f"📊 Usage for `{username}`:\n"
+            f"⬆️ Upload: {tx_mb:.2f} MB\n"
+            f"⬇️ Download: {rx_mb:.2f} MB"
+            + (f"\n📡 Router: `{', '.join(sorted({u['router'] for u in sessions}))}`" if len(ROUTERS) > 1 else "")
+            + warnings,
+            parse_mode='Markdown'
+        )
+
+    except ValueError as e:
+        handler_outcome("invalid_args")
+        await update.message.reply_text(f"❌ {str(e)}")
+    except Exception as e:
+        handler_outcome("error")
+        error_msg = f"❌ Error: {str(e)}"
+        log.error(error_msg)
+        await update.message.reply_text(error_msg)
+
+@logged
+async def pool_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "\n\n".join(pool.format_stats() for pool in ROUTERS.values()), parse_mode='Markdown'
+    )
+
+def format_latency_lines(name, failures=None):
+    """One line per series of histogram ``name``: labels, calls, p50/p95.
+
+    ``failures`` maps the same label tuples to ``{outcome: count}``.
+    """
+    lines = []
+    for labels, values in sorted(METRICS.histograms(name).items()):
+        calls = sum(values[:-1])
+        p50, p95 = METRICS.quantile(values, 0.5), METRICS.quantile(values, 0.95)
+        line = " ".join(f"`{value}`" for _, value in labels) + f" {calls}, {p50 * 1000:.0f}/{p95 * 1000:.0f} ms"
+        failed = (failures or {}).get(labels)
+        if failed:
+            line += f", failed {sum(failed.values())} (" + ", ".join(
+                f"`{outcome}` {count}" for outcome, count in sorted(failed.items())
+            ) + ")"
+        lines.append(line)
+    return lines
+
+def group_failures(counter, keys, outcome_key):
+    """{labels restricted to ``keys``: {outcome: count}} from a counter, skipping successes."""
+    grouped = collections.defaultdict(dict)
+    for labels, count in METRICS.counters(counter).items():
+        fields = dict(labels)
+        outcome = fields.get(outcome_key)
+        if outcome == "success":
+            continue
+        grouped[tuple((key, fields[key]) for key in keys)][outcome] = count
+    return grouped
+
+@logged
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        pending = await asyncio.to_thread(PENDING_STORE.count_pending)
+        uptime = int(time.time() - METRICS.started_at)
+        mismatches = METRICS.counters("approval_mismatches_total")
+        sections = [
+            f"*📈 Bot Stats* (up {uptime // 86400}d {uptime % 86400 // 3600}h {uptime % 3600 // 60}m)\n"
+            f"Pending: {pending} | Active sessions: {sum(len(index) for index in ACTIVE_SESSIONS.values())} | "
+            f"Expiry queue: {len(EXPIRY_QUEUE)} | Intake queue: {INTAKE_QUEUE.qsize()}",
+            ("*Handlers* (calls, p50/p95):", format_latency_lines(
+                "handler_seconds", group_failures("handler_calls_total", ("handler",), "outcome")
+            )),
+            ("*RouterOS calls* (calls, p50/p95):", format_latency_lines(
+                "routeros_call_seconds", group_failures("routeros_errors_total", ("call", "router"), "error")
+            )),
+            ("*Approval round-trips:*", format_latency_lines("routeros_roundtrip_seconds")),
+            ("*Telegram API:*", format_latency_lines("telegram_request_seconds")),
+            ("*Telegram rate-limit waits:*", format_latency_lines("telegram_queue_seconds")),
+            ("*Storage:*", format_latency_lines("storage_seconds")),
+        ]
+        if mismatches:
+            sections.append("*Mismatches:* " + ", ".join(
+                f"`{dict(labels)['field']}` {count}" for labels, count in sorted(mismatches.items())
+            ))
+        msg = ""
+        for section in sections:
+            if isinstance(section, tuple):
+                title, lines = section
+                if not lines:
+                    continue
+                section = title + "\n" + "\n".join(lines)
+            if len(msg) + len(section) + 2 > TELEGRAM_MESSAGE_LIMIT:
+                break
+            msg += ("\n\n" if msg else "") + section
+        await update.message.reply_text(msg, parse_mode='Markdown')
+    except Exception as e:
+        handler_outcome("error")
+        error_msg = f"❌ Error: {str(e)}"
+        log.error(error_msg)
+        await update.message.reply_text(error_msg)
+
+async def serve_metrics(reader, writer):
+    """Minimal HTTP/1.0 responder for GET /metrics."""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+            # Gauges read the pending store, so render off the event loop
+            body = (await asyncio.to_thread(METRICS.render)).encode()
+            status, content_type = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body, status, content_type = b"Not Found\n", "404 Not Found", "text/plain"
+        writer.write(
+            f"HTTP/1.0 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+INTAKE_QUEUE = asyncio.Queue(INTAKE_QUEUE_SIZE)
+METRICS.gauge("intake_queue_size", INTAKE_QUEUE.qsize)
+INTAKE_QUEUED = set()  # usernames waiting in INTAKE_QUEUE or being processed
+
+INTAKE_FIELDS = ("username", "password", "ip", "package", "bkash", "proof")
+
+def check_submission(submission):
+    """Validate a portal submission against its pending-store row.
+
+    Only requests submit_trx.php has already recorded are accepted, so the
+    endpoint cannot be used to create arbitrary router users. Returns the
+    submission with ``router`` and the proof image path filled in; raises
+    ValueError with the reason otherwise. Runs in a worker thread.
+    """
+    missing = [field for field in INTAKE_FIELDS if not isinstance(submission.get(field), str) or not submission[field]]
+    if missing:
+        raise ValueError(f"missing fields: {', '.join(missing)}")
+    row = PENDING_STORE.get_pending(submission["username"])
+    if not row:
+        raise LookupError(f"no pending request for {submission['username']}")
+    for field in ("password", "ip", "package", "bkash"):
+        if str(row[field]) != submission[field]:
+            raise ValueError(f"{field} does not match the pending request")
+    router = row["router"] or DEFAULT_ROUTER
+    if router not in ROUTERS:
+        raise ValueError(f"unknown router {router}")
+    proof = os.path.join(INTAKE_PROOF_DIR, os.path.basename(submission["proof"]))
+    if not os.path.isfile(proof):
+        raise ValueError(f"proof image {os.path.basename(proof)} not found")
+    return {**{field: submission[field] for field in INTAKE_FIELDS}, "router": router, "proof": proof}
+
+def add_pending_on_router(api, username, password, package, bkash):
+    """Create the disabled hotspot user for a new request.
+
+    A retry after a lost reply finds the user already there; that counts as
+    success as long as it is the same disabled user.
+    """
+    user_resource = api.get_resource("/ip/hotspot/user")
+    try:
+        user_resource.add(
+            name=username, password=password, profile=package, disabled="yes", comment=f"{bkash} | pending"
+        )
+    except RouterOsApiCommunicationError as e:
+        if "already" not in str(e):
+            raise
+        users = user_resource.get(name=username)
+        check_pending_user(users[0] if users else None, username, password, package)
+
+def request_keyboard(bkash, username, ip, package):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("Approve", callback_data=f"approve|{bkash}|{username}|{ip}|{package}"),
+        InlineKeyboardButton("Reject", callback_data=f"reject|{bkash}|{username}|{ip}|{package}"),
+    ]])
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+async def with_retries(operation, retry_on):
+    """Await ``operation()`` up to INTAKE_RETRIES times, backing off 1s, 2s, 4s..."""
+    for attempt in range(INTAKE_RETRIES):
+        try:
+            return await operation()
+        except retry_on as e:
+            if attempt == INTAKE_RETRIES - 1:
+                raise
+            log.warning(f"Attempt {attempt + 1} failed, retrying: {e}")
+            await asyncio.sleep(2 ** attempt)
+
+async def process_submission(app, submission, queued_at):
+    """Create the disabled router user for a submission and send the admin
+    the proof image with Approve/Reject buttons."""
+    username, password, ip, package, bkash, router = (
+        submission[field] for field in ("username", "password", "ip", "package", "bkash", "router")
+    )
+    log_context(username=username)
+    warning = ""
+    try:
+        await with_retries(
+            lambda: run_router(add_pending_on_router, username, password, package, bkash, router=router),
+            (RouterOsApiConnectionError, FatalRouterOsApiError, ConnectionError, asyncio.TimeoutError)
+        )
+    except ApprovalError as e:
+        # The generated name belongs to another router user, usually an
+        # active customer. This customer has paid, so the request stays open
+        # and goes to the admin with a warning instead of being closed.
+        METRICS.inc("intake_submissions_total", outcome="collision")
+        log.error(f"Username {username} is taken on {router}, request kept open: {e}")
+        warning = (
+            f"⚠️ *Username taken:* `{username}` already exists on MikroTik ({e.reason.replace('_', ' ')}), "
+            "so no user was created. Reject this request and sort it out with the customer.\n\n"
+        )
+    except Exception as e:
+        # Close the request so the customer's username is not left dangling
+        await asyncio.to_thread(PENDING_STORE.transition, username, "expired")
+        METRICS.inc("intake_submissions_total", outcome="router_failed")
+        log.error(f"Failed to create pending user {username} on {router}: {e}")
+        ADMIN_DIGEST.add(
+            f"⚠️ Could not create {username} on MikroTik for bKash {bkash}, request closed: {str(e) or type(e).__name__}"
+        )
+        return
+
+    caption = warning + (
+        "*New Payment Request:*\n\n"
+        f"bKash: `{bkash}`\n"
+        f"IP: `{'Pending' if ip == '0.0.0.0' else ip}`\n"
+        f"Package: `{package.replace('_', ' ').upper()}`\n"
+        f"Username: `{username}`\n"
+        f"Password: `{password}`"
+    )
+    if len(ROUTERS) > 1:
+        caption += f"\nRouter: `{router}`"
+    photo = await asyncio.to_thread(read_file, submission["proof"])
+    await with_retries(
+        lambda: app.bot.send_photo(
+            chat_id=ADMIN_CHAT_ID, photo=photo, caption=caption, parse_mode="Markdown",
+            reply_markup=request_keyboard(bkash, username, ip, package), rate_limit_args=BACKGROUND
+        ),
+        NetworkError
+    )
+    await asyncio.to_thread(PENDING_STORE.mark_notified, username)
+    METRICS.observe("intake_seconds", time.monotonic() - queued_at)
+    METRICS.inc("intake_submissions_total", outcome="notified")
+    log.info(f"Pending request for {username} sent to admin")
+
+async def intake_worker(app):
+    while True:
+        submission, queued_at = await INTAKE_QUEUE.get()
+        LOG_CONTEXT.set({"handler": "intake"})
+        try:
+            await process_submission(app, submission, queued_at)
+        except Exception as e:
+            METRICS.inc("intake_submissions_total", outcome="error")
+            log.error(f"Intake of {submission['username']} failed: {e}")
+        finally:
+            INTAKE_QUEUED.discard(submission["username"])
+            INTAKE_QUEUE.task_done()
+
+def find_proof(username):
+    """Proof image submit_trx.php saved as ``<username>.<ext>``, or None."""
+    try:
+        names = os.listdir(INTAKE_PROOF_DIR)
+    except FileNotFoundError:
+        return None
+    for name in names:
+        if name.rpartition(".")[0] == username:
+            return os.path.join(INTAKE_PROOF_DIR, name)
+    return None
+
+async def recover_intake(started):
+    """Re-queue submissions a previous run accepted but never finished.
+
+    The intake queue only lives in memory, so a restart drops requests that
+    were queued but whose proof never reached the admin, whether or not the
+    router user was already created. After INTAKE_RECOVER_DELAY (PHP's own
+    fallback may still be notifying for requests it made while the bot was
+    down), open requests created before ``started`` that were never
+    notified and are not queued again go back on the queue; creating the
+    router user again is a no-op when it already exists.
+    """
+    log_context(handler="intake_recovery")
+    await asyncio.sleep(INTAKE_RECOVER_DELAY)
+    rows = await asyncio.to_thread(PENDING_STORE.list_pending, -1)
+    requeued = 0
+    for row in rows:
+        username = row["username"]
+        if row["notified"] or row["created_at"] >= started or username in INTAKE_QUEUED:
+            continue
+        router = row["router"] or DEFAULT_ROUTER
+        proof = await asyncio.to_thread(find_proof, username)
+        # Anything not re-queued is left for the reconciler and the pending cleanup
+        if router not in ROUTERS:
+            log.warning(f"Not re-queueing {username}: unknown router {router}")
+            continue
+        if not proof:
+            log.warning(f"Not re-queueing {username}: no proof image in {INTAKE_PROOF_DIR}/")
+            continue
+        submission = {field: str(row[field]) for field in ("username", "password", "ip", "package", "bkash")}
+        INTAKE_QUEUED.add(username)
+        await INTAKE_QUEUE.put(({**submission, "router": router, "proof": proof}, time.monotonic()))
+        METRICS.inc("intake_submissions_total", outcome="recovered")
+        requeued += 1
+    if requeued:
+        log.info(f"Re-queued {requeued} pending requests left unfinished by the previous run")
+
+def http_response(writer, status, body, headers=()):
+    body = json.dumps(body).encode()
+    extra = "".join(f"{name}: {value}\r\n" for name, value in headers)
+    writer.write(
+        f"HTTP/1.0 {status}\r\nContent-Type: application/json\r\n{extra}"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+    )
+
+async def serve_intake(reader, writer):
+    """HTTP/1.0 endpoint for POST /submit from submit_trx.php.
+
+    Replies 202 as soon as the submission is queued. When the queue is full
+    it replies 503 with Retry-After instead of waiting, so a purchase burst
+    backs off in PHP rather than piling up router and Telegram calls.
+    """
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        length = 0
+        while (line := await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value.strip() or 0)
+        parts = request_line.split()
+        if len(parts) < 2 or parts[0] != b"POST" or parts[1] != b"/submit":
+            http_response(writer, "404 Not Found", {"error": "not found"})
+        elif not 0 < length <= INTAKE_MAX_BODY:
+            http_response(writer, "400 Bad Request", {"error": "invalid body length"})
+        elif INTAKE_QUEUE.full():
+            METRICS.inc("intake_submissions_total", outcome="busy")
+            http_response(writer, "503 Service Unavailable", {"error": "busy"},
+                          [("Retry-After", INTAKE_RETRY_AFTER)])
+        else:
+            body = await asyncio.wait_for(reader.readexactly(length), 5)
+            try:
+                submission = await asyncio.to_thread(check_submission, json.loads(body))
+            except (ValueError, LookupError, AttributeError) as e:
+                # json.JSONDecodeError is a ValueError; a non-object body has no .get
+                METRICS.inc("intake_submissions_total", outcome="rejected")
+                log.warning(f"Rejected intake submission: {e}")
+                status = "404 Not Found" if isinstance(e, LookupError) else "400 Bad Request"
+                http_response(writer, status, {"error": str(e)})
+            else:
+                try:
+                    INTAKE_QUEUE.put_nowait((submission, time.monotonic()))
+                except asyncio.QueueFull:
+                    METRICS.inc("intake_submissions_total", outcome="busy")
+                    http_response(writer, "503 Service Unavailable", {"error": "busy"},
+                                  [("Retry-After", INTAKE_RETRY_AFTER)])
+                else:
+                    INTAKE_QUEUED.add(submission["username"])
+                    METRICS.inc("intake_submissions_total", outcome="queued")
+                    http_response(writer, "202 Accepted", {"queued": INTAKE_QUEUE.qsize()})
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+def fetch_identity(api):
+    return api.get_resource('/system/identity').get()
+
+@logged
+async def startup_notify(app):
+    # Warm up every pool and test the connections by querying system identity
+    results = await fan_out(lambda name: run_router(fetch_identity, router=name))
+    failed = {}
+    for name, identity in results.items():
+        if isinstance(identity, BaseException):
+            failed[name] = str(identity) or type(identity).__name__
+        elif not identity:
+            failed[name] = "No identity data returned from MikroTik"
+
+    if not failed:
+        await app.bot.send_message(
+            chat_id=ADMIN_CHAT_ID,
+            text="✅ Bot is running and connected to MikroTik."
+            if len(ROUTERS) == 1 else f"✅ Bot is running and connected to all {len(ROUTERS)} MikroTik routers.",
+            rate_limit_args=BACKGROUND
+        )
+        log.info("Bot started and connected to MikroTik successfully")
+        return
+
+    for name, error in failed.items():
+        log.error(f"⚠️ Failed to connect to MikroTik {name}: {error}")
+    if len(ROUTERS) == 1:
+        error_msg = f"⚠️ Bot is running but failed to connect to MikroTik: {next(iter(failed.values()))}"
+    else:
+        error_msg = "⚠️ Bot is running but failed to connect to:\n" + "\n".join(
+            f"• {name}: {error}" for name, error in failed.items()
+        )
+    await app.bot.send_message(chat_id=ADMIN_CHAT_ID, text=error_msg, rate_limit_args=BACKGROUND)
+
+async def start_background_tasks(app):
+    packages = PACKAGES.load_export()
+    if packages:
+        log.info(f"Loaded {packages} packages from {PACKAGES_EXPORT_FILE}")
+    records = await asyncio.to_thread(LEDGER.load)
+    log.info(f"Loaded sales ledger with {records} records")
+    loaded = EXPIRY_QUEUE.load()
+    log.info(f"Loaded {loaded} pending expiries from {EXPIRY_QUEUE_FILE}")
+    imported = await asyncio.to_thread(PENDING_STORE.import_legacy_dir, PENDING_DIR)
+    if imported:
+        log.info(f"Imported {imported} legacy pending requests from {PENDING_DIR}/")
+    app.bot_data["expiry_task"] = asyncio.create_task(expiry_sweeper(app))
+    app.bot_data["pending_cleanup_task"] = asyncio.create_task(pending_cleanup(app))
+    app.bot_data["session_poller_task"] = asyncio.create_task(session_poller(app))
+    app.bot_data["usage_sampler_task"] = asyncio.create_task(usage_sampler(app))
+    app.bot_data["digest_task"] = asyncio.create_task(ADMIN_DIGEST.run(app))
+    app.bot_data["reconciler_task"] = asyncio.create_task(reconciler(app))
+    app.bot_data["package_refresher_task"] = asyncio.create_task(package_refresher(app))
+    if METRICS_PORT:
+        app.bot_data["metrics_server"] = await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+        log.info(f"Metrics available at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    if INTAKE_PORT:
+        app.bot_data["intake_tasks"] = [asyncio.create_task(intake_worker(app)) for _ in range(INTAKE_WORKERS)]
+        app.bot_data["intake_recovery_task"] = asyncio.create_task(recover_intake(time.time()))
+        app.bot_data["intake_server"] = await asyncio.start_server(serve_intake, INTAKE_HOST, INTAKE_PORT)
+        log.info(f"Accepting portal submissions at http://{INTAKE_HOST}:{INTAKE_PORT}/submit")
+
+async def flush_admin_digest(app):
+    # post_stop runs while the bot can still send, unlike post_shutdown
+    try:
+        await ADMIN_DIGEST.flush(app.bot)
+    except Exception as e:
+        log.error(f"Sending admin digest failed: {str(e)}")
+
+async def stop_background_tasks(app):
+    for name in ("expiry_task", "pending_cleanup_task", "session_poller_task", "usage_sampler_task", "digest_task",
+                 "reconciler_task", "package_refresher_task", "intake_recovery_task"):
+        task = app.bot_data.get(name)
+        if task:
+            task.cancel()
+    for task in app.bot_data.get("intake_tasks", ()):
+        task.cancel()
+    for name in ("metrics_server", "intake_server"):
+        server = app.bot_data.get(name)
+        if server:
+            server.close()
+
+def main():
+    log_listener = setup_logging()
+    app = (
+        ApplicationBuilder()
+        .token(API_TOKEN)
+        .request(TimedRequest())
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .rate_limiter(OUTBOX)
+        .post_init(start_background_tasks)
+        .post_stop(flush_admin_digest)
+        .post_shutdown(stop_background_tasks)
+        .build()
+    )
+
+    # Commands that change data or show customer data are only accepted in the admin chat
+    admin_only = filters.Chat(chat_id=ADMIN_CHAT_ID)
+    app.add_handler(CallbackQueryHandler(approve_inline, pattern="^approve\\|"))
+    app.add_handler(CallbackQueryHandler(reject_inline, pattern="^reject\\|"))
+    app.add_handler(CallbackQueryHandler(active_users_page, pattern="^active\\|"))
+    app.add_handler(CommandHandler("activeusers", active_users))
+    app.add_handler(CommandHandler("usage", usage))
+    app.add_handler(CommandHandler("top", top_users, filters=admin_only))
+    app.add_handler(CommandHandler("pending", pending_requests, filters=admin_only))
+    app.add_handler(CommandHandler("approve", approve_users, filters=admin_only))
+    app.add_handler(CommandHandler("approveall", approve_all, filters=admin_only))
+    app.add_handler(CommandHandler("rejectall", reject_all, filters=admin_only))
+    app.add_handler(CommandHandler("renew", renew_users, filters=admin_only))
+    app.add_handler(CommandHandler("packages", packages_command, filters=admin_only))
+    app.add_handler(CommandHandler("report", sales_report, filters=admin_only))
+    app.add_handler(CommandHandler("customer", customer_history, filters=admin_only))
+    app.add_handler(CommandHandler("poolstats", pool_stats))
+    app.add_handler(CommandHandler("stats", stats, filters=admin_only))
+    app.add_handler(CommandHandler("migrateexpiry", migrate_expiry, filters=admin_only))
+    app.add_handler(CommandHandler("reconcile", reconcile_command, filters=admin_only))
+    app.add_handler(CommandHandler("help", help_command))
+
+    for pool in ROUTERS.values():
+        pool.start()
+    asyncio.get_event_loop().create_task(startup_notify(app))
+
+    log.info("🤖 Bot is running...")
+    try:
+        app.run_polling()
+    finally:
+        for pool in ROUTERS.values():
+            pool.close()
+        log_listener.stop()
+
+if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,5 +1,6 @@
 <?php
 require_once __DIR__ . '/vendor/autoload.php';
+require_once __DIR__ . '/router_config.php';
 
 use RouterOS\Client;
 use RouterOS\Query;
@@ -9,11 +10,7 @@ session_start();
 $config = json_decode(file_get_contents(__DIR__ . '/config.json'), true);
 
 // Import creds from config
-$mikrotikConfig = $config['mikrotik'];
-$mikrotikConfig['host'];
-$mikrotikConfig['user'];
-$mikrotikConfig['pass'];
-$mikrotikConfig['port'];
+[, $mikrotikConfig] = portal_router_config($config);
 
 $error = '';
 $userInfo = null;
@@ -1,5 +1,6 @@
 <?php
 require_once __DIR__ . '/vendor/autoload.php';
+require_once __DIR__ . '/router_config.php';
 $config = json_decode(file_get_contents(__DIR__ . '/config.json'), true);
 
 use RouterOS\Client;
@@ -7,12 +8,7 @@ use RouterOS\Query;
 
 session_start();
 
-$mikrotikConfig = $config['mikrotik'];
-$mikrotikConfig['host'];
-$mikrotikConfig['user'];
-$mikrotikConfig['pass'];
-$mikrotikConfig['port'];    
-
+[, $mikrotikConfig] = portal_router_config($config);
 
 if ($_SERVER['REQUEST_METHOD'] === 'GET') {
     if (!empty($_SESSION['username'])) {
@@ -0,0 +1,32 @@
+<?php
+require_once __DIR__ . '/router_config.php';
+
+// Packages on sale, as exported by bot.py (PackageCatalog) from the routers'
+// hotspot user profiles and packages.json. Returns name => [days, label,
+// price], limited to the profiles this portal's router has; falls back to
+// the built-in packages until the bot has written the file. Keep the
+// fallback in sync with DEFAULT_PACKAGES in bot.py.
+function load_package_catalog($config) {
+    $path = $config['packages']['export_file'] ?? 'package_catalog.json';
+    if ($path[0] !== '/') {
+        $path = __DIR__ . "/$path";
+    }
+    if (is_readable($path)) {
+        $catalog = json_decode(file_get_contents($path), true);
+        if (is_array($catalog['packages'] ?? null)) {
+            // A router the bot has not listed yet is offered the whole catalog
+            [$router] = portal_router_config($config);
+            $available = $catalog['routers'][$router] ?? null;
+            if (is_array($available)) {
+                return array_intersect_key($catalog['packages'], array_flip($available));
+            }
+            return $catalog['packages'];
+        }
+        error_log("Ignoring unreadable package catalog: $path");
+    }
+    return [
+        '1_day' => ['days' => 1, 'label' => '1 Day', 'price' => 10],
+        '7_days' => ['days' => 7, 'label' => '7 Days', 'price' => 30],
+        '30_days' => ['days' => 30, 'label' => '30 Days', 'price' => 100],
+    ];
+}
@@ -1,4 +1,6 @@
 <?php
+require_once __DIR__ . '/package_catalog.php';
+
 // Set UTF-8 headers
 header('Content-Type: text/html; charset=UTF-8');
 
@@ -8,6 +10,7 @@ date_default_timezone_set('Asia/Dhaka');
 // Load config
 $config = json_decode(file_get_contents(__DIR__ . '/config.json'), true);
 $receiver_bkash_number = $config['bkash_number'] ?? 'N/A';
+$packages = load_package_catalog($config);
 
 // Detect user's IP address (for reference, not enforced)
 $user_ip = $_SERVER['REMOTE_ADDR'];
@@ -138,21 +141,13 @@ error_log("Detected IP in payment.php: $user_ip");
       <!-- Package Selection -->
       <label>Select a Package:</label>
       <div class="packages">
+<?php $first = true; foreach ($packages as $name => $package): ?>
         <label class="package">
-          <input type="radio" name="package" value="1_day" required />
-          <strong>1 Day</strong><br>
-          ৳10
-        </label>
-        <label class="package">
-          <input type="radio" name="package" value="7_days" />
-          <strong>7 Days</strong><br>
-          ৳30
-        </label>
-        <label class="package">
-          <input type="radio" name="package" value="30_days" />
-          <strong>30 Days</strong><br>
-          ৳100
+          <input type="radio" name="package" value="<?= htmlspecialchars($name) ?>"<?= $first ? ' required' : '' ?> />
+          <strong><?= htmlspecialchars($package['label']) ?></strong><br>
+          <?= $package['price'] === null ? '' : '৳' . htmlspecialchars($package['price']) ?>
         </label>
+<?php $first = false; endforeach; ?>
       </div>
 
       <!-- Receiver bKash Number -->
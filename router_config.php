@@ -0,0 +1,22 @@
+<?php
+// Pick the router this portal talks to. "mikrotik" in config.json is either
+// a single router or a list of named routers (see bot.py ROUTER_CONFIGS);
+// "portal_router" names the one serving this site, defaulting to the first.
+// Returns [name, client config]; the name is stored with pending requests so
+// the bot approves them on the right router.
+function portal_router_config($config) {
+    $routers = $config['mikrotik'];
+    if (isset($routers['host'])) {
+        return ['default', $routers];
+    }
+    $router = $routers[0];
+    foreach ($routers as $candidate) {
+        if (isset($config['portal_router']) && $candidate['name'] === $config['portal_router']) {
+            $router = $candidate;
+            break;
+        }
+    }
+    $name = $router['name'];
+    unset($router['name']); // RouterOS\Client rejects unknown keys
+    return [$name, $router];
+}
@@ -1,5 +1,7 @@
 <?php
 require_once __DIR__ . '/vendor/autoload.php';
+require_once __DIR__ . '/router_config.php';
+require_once __DIR__ . '/package_catalog.php';
 
 use RouterOS\Client;
 use RouterOS\Query;
@@ -14,10 +16,11 @@ date_default_timezone_set('Asia/Dhaka');
 $config = json_decode(file_get_contents(__DIR__ . '/config.json'), true);
 $botToken = $config['telegram']['bot_token'];
 $chatId = $config['telegram']['admin_chat_id'];
-$mikrotikConfig = $config['mikrotik'];
+[$routerName, $mikrotikConfig] = portal_router_config($config);
 
-// Valid packages (must match MikroTik profiles and bot.py get_expiry keys)
-$validPackages = ['1_day', '7_days', '30_days'];
+// Valid packages (the catalog bot.py builds from the MikroTik profiles)
+$packages = load_package_catalog($config);
+$validPackages = array_keys($packages);
 
 // Detect client IP (for reference, but not enforced during testing)
 function get_client_ip($mikrotikConfig) {
@@ -104,18 +107,105 @@ function get_client_ip($mikrotikConfig) {
     return 'invalid';
 }
 
+// Open the pending-request store shared with bot.py (schema must match PendingStore.SCHEMA)
+function open_pending_store($config) {
+    $path = $config['pending_store']['path'] ?? 'pending.db';
+    if ($path[0] !== '/') {
+        $path = __DIR__ . "/$path";
+    }
+    $db = new PDO("sqlite:$path");
+    $db->setAttribute(PDO::ATTR_ERRMODE, PDO::ERRMODE_EXCEPTION);
+    $db->exec("PRAGMA journal_mode=WAL");
+    $db->exec("PRAGMA busy_timeout=5000");
+    $db->exec("
+        CREATE TABLE IF NOT EXISTS pending_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            password TEXT NOT NULL,
+            ip TEXT NOT NULL,
+            package TEXT NOT NULL,
+            bkash TEXT NOT NULL,
+            router TEXT NOT NULL DEFAULT '',
+            state TEXT NOT NULL DEFAULT 'pending',
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL,
+            notified INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_pending_username_open
+            ON pending_requests(username) WHERE state = 'pending';
+        CREATE INDEX IF NOT EXISTS idx_pending_state_created ON pending_requests(state, created_at);
+        CREATE INDEX IF NOT EXISTS idx_pending_username ON pending_requests(username);
+        CREATE INDEX IF NOT EXISTS idx_pending_bkash ON pending_requests(bkash);
+        CREATE INDEX IF NOT EXISTS idx_pending_ip ON pending_requests(ip);
+    ");
+    $columns = $db->query("PRAGMA table_info(pending_requests)")->fetchAll(PDO::FETCH_COLUMN, 1);
+    if (!in_array('router', $columns)) {
+        // Databases created before multi-router support
+        $db->exec("ALTER TABLE pending_requests ADD COLUMN router TEXT NOT NULL DEFAULT ''");
+    }
+    if (!in_array('notified', $columns)) {
+        // Databases created before the bot tracked admin notifications; the
+        // requests already in them were sent to the admin
+        $db->exec("ALTER TABLE pending_requests ADD COLUMN notified INTEGER NOT NULL DEFAULT 0");
+        $db->exec("UPDATE pending_requests SET notified = 1");
+    }
+    return $db;
+}
+
 // Calculate validity period (matches bot.py get_expiry)
-function get_validity($package) {
-    $durations = [
-        '1_day' => 1,
-        '7_days' => 7,
-        '30_days' => 30
-    ];
-    $days = $durations[$package] ?? 1;
-    $validity_time = (new DateTime())->modify("+$days days");
+function get_validity($package, $packages) {
+    $minutes = (int)round($packages[$package]['days'] * 1440);
+    $validity_time = (new DateTime())->modify("+$minutes minutes");
     return $validity_time->format('Y-m-d H:i');
 }
 
+// Hand a recorded request to the bot's intake endpoint, which creates the
+// router user and notifies the admin in the background. Returns false when
+// the endpoint is disabled or the bot is not running, so the caller can do
+// the work itself; retries while the bot's queue is full.
+function queue_with_bot($config, $payload) {
+    $intake = $config['intake'] ?? [];
+    $port = $intake['port'] ?? 9109;
+    if (!$port) {
+        return false;
+    }
+    $url = "http://" . ($intake['host'] ?? '127.0.0.1') . ":$port/submit";
+    $deadline = microtime(true) + ($intake['submit_timeout'] ?? 15);
+    while (true) {
+        $ch = curl_init($url);
+        curl_setopt($ch, CURLOPT_POST, 1);
+        curl_setopt($ch, CURLOPT_POSTFIELDS, json_encode($payload));
+        curl_setopt($ch, CURLOPT_HTTPHEADER, ['Content-Type: application/json']);
+        curl_setopt($ch, CURLOPT_RETURNTRANSFER, true);
+        curl_setopt($ch, CURLOPT_HEADER, true);
+        curl_setopt($ch, CURLOPT_CONNECTTIMEOUT, 2);
+        curl_setopt($ch, CURLOPT_TIMEOUT, 5);
+        $response = curl_exec($ch);
+        if ($response === false) {
+            error_log("Bot intake unreachable: " . curl_error($ch));
+            curl_close($ch);
+            return false;
+        }
+        $status = curl_getinfo($ch, CURLINFO_HTTP_CODE);
+        $headers = substr($response, 0, curl_getinfo($ch, CURLINFO_HEADER_SIZE));
+        $body = substr($response, curl_getinfo($ch, CURLINFO_HEADER_SIZE));
+        curl_close($ch);
+        if ($status === 202) {
+            error_log("Queued with bot intake: $body");
+            return true;
+        }
+        if ($status !== 503) {
+            throw new Exception("Bot rejected the request: $body");
+        }
+        // Queue full: wait as long as the bot asks, up to the deadline
+        $wait = preg_match('/^Retry-After:\s*(\d+)/mi', $headers, $m) ? (int)$m[1] : 1;
+        if (microtime(true) + $wait > $deadline) {
+            throw new Exception("The system is busy processing other payments. Please try again in a minute.");
+        }
+        sleep(max(1, $wait));
+    }
+}
+
 // Generate image with user credentials
 function generate_credentials_image($username, $password, $package, $validity, $ip) {
     $width = 600;
@@ -208,36 +298,45 @@ if ($bkash_number && $package && in_array($package, $validPackages) && $proof_im
             throw new Exception("Image file size exceeds 5MB limit.");
         }
 
-        // Generate credentials
-        $username = "user" . rand(1000, 9999);
-        $password = rand(100000, 999999);
-        $comment = "$bkash_number | pending";
-        $validity = get_validity($package);
-
-        // Save to file (for bot to enable later)
-        $user_data = [
-            'username' => $username,
-            'password' => (string)$password,
-            'ip' => $ip,
-            'package' => $package,
-            'bkash' => $bkash_number
-        ];
-
-        // Create pending_users directory
-        error_log("Current directory: " . __DIR__);
-        if (!is_dir(__DIR__ . '/pending_users')) {
-            if (!mkdir(__DIR__ . '/pending_users', 0777, true)) {
-                throw new Exception("Failed to create pending_users directory at " . __DIR__ . '/pending_users');
+        // Generate credentials and record the pending request (for bot to enable later).
+        // The unique index on open requests rejects a username that is already
+        // waiting for approval, so pick another one on collision. Names approved
+        // within the longest package may still belong to an active customer,
+        // so those are skipped too.
+        $db = open_pending_store($config);
+        $insert = $db->prepare(
+            "INSERT INTO pending_requests (username, password, ip, package, bkash, router, state, created_at, updated_at)
+             VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, ?)"
+        );
+        $approved = $db->prepare(
+            "SELECT 1 FROM pending_requests WHERE username = ? AND state = 'approved' AND updated_at > ? LIMIT 1"
+        );
+        $activeSince = time() - (int)ceil(max(array_column($packages, 'days')) * 86400);
+        for ($attempt = 0; ; $attempt++) {
+            $username = "user" . rand(1000, 9999);
+            $password = rand(100000, 999999);
+            $approved->execute([$username, $activeSince]);
+            $taken = $approved->fetchColumn() !== false;
+            $approved->closeCursor();
+            if ($taken) {
+                if ($attempt >= 9) {
+                    throw new Exception("Failed to record pending request: no free username");
+                }
+                continue;
+            }
+            try {
+                $now = time();
+                $insert->execute([$username, (string)$password, $ip, $package, $bkash_number, $routerName, $now, $now]);
+                break;
+            } catch (PDOException $e) {
+                if ($e->getCode() !== '23000' || $attempt >= 9) {
+                    throw new Exception("Failed to record pending request: " . $e->getMessage());
+                }
             }
-            error_log("Created pending_users directory: " . __DIR__ . '/pending_users');
-        }
-
-        // Write JSON file
-        $json_file = __DIR__ . "/pending_users/$username.json";
-        if (file_put_contents($json_file, json_encode($user_data)) === false) {
-            throw new Exception("Failed to write JSON file for username: $username at $json_file");
         }
-        error_log("Wrote JSON file: $json_file");
+        $comment = "$bkash_number | pending";
+        $validity = get_validity($package, $packages);
+        error_log("Recorded pending request for username: $username");
 
         // Save proof image
         $proof_dir = __DIR__ . '/proof_images';
@@ -256,54 +355,81 @@ if ($bkash_number && $package && in_array($package, $validPackages) && $proof_im
         $image_path = generate_credentials_image($username, $password, $package, $validity, $ip);
         $image_url = "downloads/credentials_$username.png";
 
-        // Add disabled user to MikroTik
-        $client = new Client($mikrotikConfig);
-        $query = (new Query('/ip/hotspot/user/add'))
-            ->equal('name', $username)
-            ->equal('password', (string)$password)
-            ->equal('profile', $package)
-            ->equal('disabled', 'yes')
-            ->equal('comment', $comment);
-        $client->query($query)->read();
-
-        // Send request to bot with image
-        $message = "*New Payment Request:*\n\n"
-                 . "bKash: `$bkash_number`\n"
-                 . "IP: `" . ($ip === '0.0.0.0' ? 'Pending' : $ip) . "`\n"
-                 . "Package: `" . strtoupper(str_replace("_", " ", $package)) . "`\n"
-                 . "Username: `$username`\n"
-                 . "Password: `$password`";
-
-        $keyboard = [
-            'inline_keyboard' => [[
-                ['text' => 'Approve', 'callback_data' => "approve|$bkash_number|$username|$ip|$package"],
-                ['text' => 'Reject', 'callback_data' => "reject|$bkash_number|$username|$ip|$package"]
-            ]]
-        ];
-
-        $data = [
-            'chat_id' => $chatId,
-            'caption' => $message,
-            'parse_mode' => 'Markdown',
-            'reply_markup' => json_encode($keyboard)
-        ];
-
-        $ch = curl_init("https://api.telegram.org/bot$botToken/sendPhoto");
-        curl_setopt($ch, CURLOPT_POST, 1);
-        curl_setopt($ch, CURLOPT_POSTFIELDS, [
-            'chat_id' => $chatId,
-            'photo' => new CURLFile($proof_path),
-            'caption' => $message,
-            'parse_mode' => 'Markdown',
-            'reply_markup' => json_encode($keyboard)
-        ]);
-        curl_setopt($ch, CURLOPT_RETURNTRANSFER, true);
-        $telegram_response = curl_exec($ch);
-        if ($telegram_response === false) {
-            throw new Exception("Failed to send Telegram photo: " . curl_error($ch));
+        // Let the bot create the user and notify the admin; fall back to doing
+        // it here when the bot's intake endpoint is not available
+        try {
+            $queued = queue_with_bot($config, [
+                'username' => $username,
+                'password' => (string)$password,
+                'ip' => $ip,
+                'package' => $package,
+                'bkash' => $bkash_number,
+                'proof' => basename($proof_path),
+            ]);
+        } catch (Exception $e) {
+            $db->prepare("UPDATE pending_requests SET state = 'expired', updated_at = ? WHERE username = ? AND state = 'pending'")
+               ->execute([time(), $username]);
+            throw $e;
+        }
+
+        if (!$queued) {
+            // Add disabled user to MikroTik; close the request again if that fails
+            try {
+                $client = new Client($mikrotikConfig);
+                $query = (new Query('/ip/hotspot/user/add'))
+                    ->equal('name', $username)
+                    ->equal('password', (string)$password)
+                    ->equal('profile', $package)
+                    ->equal('disabled', 'yes')
+                    ->equal('comment', $comment);
+                $client->query($query)->read();
+            } catch (Exception $e) {
+                $db->prepare("UPDATE pending_requests SET state = 'expired', updated_at = ? WHERE username = ? AND state = 'pending'")
+                   ->execute([time(), $username]);
+                throw $e;
+            }
+
+            // Send request to bot with image
+            $message = "*New Payment Request:*\n\n"
+                     . "bKash: `$bkash_number`\n"
+                     . "IP: `" . ($ip === '0.0.0.0' ? 'Pending' : $ip) . "`\n"
+                     . "Package: `" . strtoupper(str_replace("_", " ", $package)) . "`\n"
+                     . "Username: `$username`\n"
+                     . "Password: `$password`";
+
+            $keyboard = [
+                'inline_keyboard' => [[
+                    ['text' => 'Approve', 'callback_data' => "approve|$bkash_number|$username|$ip|$package"],
+                    ['text' => 'Reject', 'callback_data' => "reject|$bkash_number|$username|$ip|$package"]
+                ]]
+            ];
+
+            $data = [
+                'chat_id' => $chatId,
+                'caption' => $message,
+                'parse_mode' => 'Markdown',
+                'reply_markup' => json_encode($keyboard)
+            ];
+
+            $ch = curl_init("https://api.telegram.org/bot$botToken/sendPhoto");
+            curl_setopt($ch, CURLOPT_POST, 1);
+            curl_setopt($ch, CURLOPT_POSTFIELDS, [
+                'chat_id' => $chatId,
+                'photo' => new CURLFile($proof_path),
+                'caption' => $message,
+                'parse_mode' => 'Markdown',
+                'reply_markup' => json_encode($keyboard)
+            ]);
+            curl_setopt($ch, CURLOPT_RETURNTRANSFER, true);
+            $telegram_response = curl_exec($ch);
+            if ($telegram_response === false) {
+                throw new Exception("Failed to send Telegram photo: " . curl_error($ch));
+            }
+            curl_close($ch);
+            error_log("Telegram photo sent: $telegram_response");
+            $db->prepare("UPDATE pending_requests SET notified = 1 WHERE username = ? AND state = 'pending'")
+               ->execute([$username]);
         }
-        curl_close($ch);
-        error_log("Telegram photo sent: $telegram_response");
 
         // Output to user
         echo "<!DOCTYPE html>